@@ -2,11 +2,18 @@ from textual.app import App, ComposeResult
 from textual.widgets import Header, Footer, Markdown, ProgressBar
 from textual.containers import VerticalScroll
 from textual.worker import get_current_worker
-import lmstudio as lms
-import json, decimal, tiktoken, asyncio, sys
+from tokenutils import truncate_to_tokens
+from summarysupport import (
+    BufferedFileLog, SummaryScheduler, SUMMARY_CONCURRENCY, fetch_texts_by_type,
+    SECTION_TEMPLATE, FINAL_TEMPLATE, SECTION_INPUT_TOKENS, FINAL_INPUT_TOKENS,
+    section_prompt, final_prompt, clip_summary
+)
+from llmstream import MarkdownStream
+from summarycache import shared_summary_cache
+from llmbackend import get_backend, LLMError
+import json, decimal, asyncio, sys
 import iris
 import traceback
-import re
 from sentence_transformers import SentenceTransformer
 
 RESOURCE_TYPES = [
@@ -18,20 +25,21 @@ RESOURCE_TYPES = [
 class FHIRSummaryAppNoVector(App):
     BINDINGS = [('d', 'toggle_dark', 'Toggle dark mode')]
 
-    def __init__(self, ptFHIRid, **kwargs):
+    def __init__(self, ptFHIRid, concurrency: int = SUMMARY_CONCURRENCY, backend: str = None, **kwargs):
         super().__init__(**kwargs)
         self.fhirId = ptFHIRid
-        self.client = lms.Client()
-        #self.model = self.client.llm.model("llama-3.2-3b-instruct")
-        self.model = self.client.llm.model("mistral-7b-instruct-v0.3")
+        self.scheduler = SummaryScheduler(concurrency)
+        self.streams = {}
+        self.llm = get_backend(backend, preferred={"lmstudio": "mistral-7b-instruct-v0.3"},
+                               concurrency=concurrency)
+        self.summary_cache = shared_summary_cache()
         self.embedding_model = SentenceTransformer("nomic-ai/nomic-embed-text-v1.5", trust_remote_code=True)
         self.conn = iris.connect("127.0.0.1", 1972, "DEMO", "_SYSTEM", "ISCDEMO")
         self.partial_summaries = {}
         self.final_summary_text = ""
 
-    def log_to_file(self, message: str, file_path: str = "rag_summary.log") -> None:
-        with open(file_path, "a", encoding="utf-8") as f:
-            f.write(message + "\n")
+    def log_to_file(self, message: str) -> None:
+        self.file_log.write(message)
 
     def compose(self) -> ComposeResult:
         yield Header()
@@ -43,137 +51,92 @@ class FHIRSummaryAppNoVector(App):
             self.summary_widgets = []
 
     async def on_mount(self) -> None:
-        open("rag_summary.log", "w", encoding="utf-8").write("")
+        self.file_log = BufferedFileLog("rag_summary.log")
         self.log_to_file("Starting resource summarization...")
         self.query_one("#partial-summary-header", Markdown).update("# Partial Summaries")
         self.run_worker(self.process_summary_with_rag, exclusive=True)
 
     async def process_summary_with_rag(self) -> None:
-        cursor = self.conn.cursor()
+        # One round trip for every resource type, grouped in Python
+        self.log_to_file(f"Executing query for patient_id={self.fhirId}, {len(RESOURCE_TYPES)} resource types")
+        try:
+            texts_by_type = await asyncio.to_thread(
+                fetch_texts_by_type, self.conn, self.fhirId, RESOURCE_TYPES, self.log_to_file)
+        except Exception as e:
+            self.log_to_file(f"Query failed: {type(e).__name__}: {e}")
+            texts_by_type = {}
 
+        jobs = []
         for rtype in RESOURCE_TYPES:
-            texts = []
-            try:
-                self.log_to_file(f"Executing query for patient_id={self.fhirId}, resource_type='{rtype}'")
-                cursor.execute("""
-                    SELECT STRING(resourcetext)
-                    FROM PatientVectors
-                    WHERE patient_id = ? AND resource_type = ?
-                """, [self.fhirId, rtype])
-
-                rows = []
-                i = 0
-                while True:
-                    try:
-                        row = cursor.fetchone()
-                        if row is None:
-                            break
-                        val = row[0]
-
-                        if isinstance(val, list):
-                            if not val:
-                                self.log_to_file(f"Row {i} for {rtype} is an empty list — skipping")
-                                i += 1
-                                continue
-                            self.log_to_file(f"Row {i} for {rtype} is a list — using first element: {repr(val[0])[:100]}")
-                            val = val[0]
-
-                        if val is None or isinstance(val, (int, float, decimal.Decimal)):
-                            self.log_to_file(f"Row {i} for {rtype} is non-string: {type(val)} — skipping")
-                            i += 1
-                            continue
-
-                        if not isinstance(val, str):
-                            self.log_to_file(f"Row {i} for {rtype} has unexpected type: {type(val)} — skipping")
-                            i += 1
-                            continue
-
-                        if not val.strip():
-                            self.log_to_file(f"Row {i} for {rtype} is blank — skipping")
-                            i += 1
-                            continue
-
-                        val.encode("utf-8")
-                        texts.append(val)
-                        self.log_to_file(f"Row {i} for {rtype} accepted: {repr(val)[:100]}")
-                        i += 1
-
-                    except Exception as row_err:
-                        self.log_to_file(f"Row fetch error at index {i} for {rtype}: {type(row_err).__name__}: {row_err}")
-                        break
-
-            except Exception as e:
-                self.log_to_file(f"fetch_rows_for_resource_type failed for {rtype}: {type(e).__name__}: {e}")
-
-            self.log_to_file(f"Texts for {rtype}: count = {len(texts)}")
+            texts = texts_by_type.get(rtype, [])
             if not texts:
                 self.log_to_file(f"No texts found for {rtype}, skipping summarization.")
                 continue
 
             context = "\n".join(texts)
-            context_truncated = self.truncate_to_tokens(context, max_tokens=1500)
-            summary = await asyncio.to_thread(self.summarize_resource_type, rtype, context_truncated)
-            self.partial_summaries[rtype] = summary.strip()
-
-            self.mount(Markdown(f"## {rtype} Summary\n\n{summary.strip()}"))
+            context_truncated = self.truncate_to_tokens(context, max_tokens=SECTION_INPUT_TOKENS)
+            # Mount the section up front so the LLM output streams into it
+            stream = self.new_stream(f"## {rtype} Summary\n\n", rtype)
+            await self.mount(stream.widget)
+            jobs.append((rtype, self.summarize_resource_type, rtype, context_truncated, stream))
+
+        def show_partial(rtype: str, summary: str) -> None:
+            self.streams[rtype].finish(summary.strip())
             self.progress.advance(1)
 
+        # Section summaries are independent, so run them concurrently
+        results = await self.scheduler.run(jobs, show_partial)
+        self.partial_summaries = {rtype: summary.strip() for rtype, summary in results.items()}
+
         if not self.partial_summaries:
             self.log_to_file("No partial summaries were generated. Skipping final summary.")
-            cursor.close()
             return
 
         all_text = "\n".join(self.partial_summaries.values())
-        final_input = self.truncate_to_tokens(all_text, max_tokens=2000)
+        final_input = self.truncate_to_tokens(all_text, max_tokens=FINAL_INPUT_TOKENS)
         self.log_to_file(f"Partial summaries combined for final summary:\n{final_input[:1000]}...")
         self.mount(Markdown("\n---\n\n# Final Summary"))
-        self.final_summary_text = await asyncio.to_thread(self.summarize_final_summary, final_input)
-        self.mount(Markdown("\n\n" + self.final_summary_text.strip()))
+        final_stream = self.new_stream("", "final summary")
+        await self.mount(final_stream.widget)
+        self.final_summary_text = await self.scheduler.run_final(
+            self.summarize_final_summary, final_input, final_stream)
+        final_stream.finish(self.final_summary_text.strip())
         self.log_to_file("Final summary updated to display.")
         self.progress.advance(1)
-        cursor.close()
-
-    def summarize_resource_type(self, rtype: str, text: str) -> str:
-        prompt = (
-            f"You are a clinical summarization AI. Your task is to generate a concise summary of the patient's {rtype} data below.\n\n"
-            "The summary must be:\n"
-            "- No more than 5 sentences.\n"
-            "- No more than 100 words.\n"
-            "- Avoid repeating metadata or codes.\n"
-            "- Use natural language.\n\n"
-            f"--- BEGIN {rtype} DATA ---\n{text}\n--- END DATA ---\n\n"
-            f"Summary:"
-        )
+        llm_stats = f"{self.llm.stats.summary()}; {self.summary_cache.summary()}"
+        self.log_to_file(f"Latency: {self.scheduler.report()}; {llm_stats}")
+        self.mount(Markdown(f"_⏱️ {self.scheduler.report()}_\n\n_⏱️ {llm_stats}_"))
+        self.file_log.flush()
+
+    def new_stream(self, header: str, label: str) -> MarkdownStream:
+        stream = MarkdownStream(self, Markdown(header + "_Waiting..._"), header=header)
+        self.streams[label] = stream
+        return stream
+
+    def summarize_resource_type(self, rtype: str, text: str, stream: MarkdownStream) -> str:
+        prompt = section_prompt(rtype, text)
         self.log_to_file(f"Summarizing {rtype} via LLM...")
         try:
-            summary = self.model.complete(prompt).content.strip()
-            words = summary.split()
-            if len(words) > 100:
-                summary = " ".join(words[:100]) + "..."
-            sentences = re.split(r'(?<=[.!?]) +', summary)
-            if len(sentences) > 5:
-                summary = " ".join(sentences[:5]) + "..."
-            return summary
-        except AssertionError as e:
+            summary = self.summary_cache.complete(self.llm, prompt, SECTION_TEMPLATE, self.fhirId, stream)
+            return clip_summary(summary)
+        except LLMError as e:
             self.log_to_file(f"LLM connection error during {rtype} summarization: {str(e)}")
             return f"[ERROR: LLM connection failed for {rtype}]"
 
-    def summarize_final_summary(self, text: str) -> str:
-        prompt = (
-            "You are a clinical summarization AI. Using the following section summaries, create a concise, readable 1–2 paragraph overview of the patient's overall clinical picture."
-            f"\n\n{text}\n\nFinal Summary:"
-        )
+    def summarize_final_summary(self, text: str, stream: MarkdownStream) -> str:
+        prompt = final_prompt(text)
         self.log_to_file("Generating final summary via LLM...")
         try:
-            return self.model.complete(prompt).content.strip()
-        except AssertionError as e:
+            return self.summary_cache.complete(self.llm, prompt, FINAL_TEMPLATE, self.fhirId, stream).strip()
+        except LLMError as e:
             self.log_to_file(f"LLM connection error during final summary: {str(e)}")
             return "[ERROR: LLM connection failed for final summary]"
 
     def truncate_to_tokens(self, text: str, max_tokens: int = 1500) -> str:
-        enc = tiktoken.encoding_for_model("gpt-3.5-turbo")
-        tokens = enc.encode(text)
-        return enc.decode(tokens[:max_tokens])
+        return truncate_to_tokens(text, max_tokens)
+
+    def on_unmount(self) -> None:
+        self.file_log.close()
 
     def action_toggle_dark(self) -> None:
         return super().action_toggle_dark()
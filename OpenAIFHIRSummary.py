@@ -2,11 +2,19 @@ from textual.app import App, ComposeResult
 from textual.widgets import Header, Footer, Markdown, ProgressBar
 from textual.containers import VerticalScroll
 from textual.worker import get_current_worker
-from openai import OpenAI
-import json, decimal, tiktoken, asyncio, sys, os, re
+from tokenutils import truncate_to_tokens
+from summarysupport import BufferedFileLog, SummaryScheduler, SUMMARY_CONCURRENCY, fetch_texts_by_type, clip_summary
+from llmstream import MarkdownStream
+from summarycache import shared_summary_cache
+from llmbackend import get_backend, LLMError
+import json, decimal, asyncio, sys, os
 import iris
 from sentence_transformers import SentenceTransformer
 
+# Summary cache keys; bump the version when a prompt's meaning changes
+SECTION_TEMPLATE = "openai-section/v1"
+FINAL_TEMPLATE = "openai-final/v1"
+
 RESOURCE_TYPES = [
     "Patient", "Condition", "MedicationRequest", "Observation",
     "Encounter", "Practitioner", "Procedure", "AllergyIntolerance",
@@ -16,21 +24,22 @@ RESOURCE_TYPES = [
 class FHIRSummaryAppOpenAI(App):
     BINDINGS = [('d', 'toggle_dark', 'Toggle dark mode')]
 
-    def __init__(self, ptFHIRid, **kwargs):
+    def __init__(self, ptFHIRid, concurrency: int = SUMMARY_CONCURRENCY, backend: str = "openai", **kwargs):
         super().__init__(**kwargs)
         self.fhirId = ptFHIRid
+        self.scheduler = SummaryScheduler(concurrency)
+        self.streams = {}
         self.embedding_model = SentenceTransformer("nomic-ai/nomic-embed-text-v1.5", trust_remote_code=True)
         self.conn = iris.connect("127.0.0.1", 1972, "DEMO", "_SYSTEM", "ISCDEMO")
         self.partial_summaries = {}
         self.final_summary_text = ""
-        self.client = OpenAI(
-        # This is the default and can be omitted
-        api_key=os.environ.get("OPENAI_API_KEY"),
-        )
+        # Sections on the small model, the final overview on the larger one
+        self.llm = get_backend(backend, preferred={"openai": "gpt-4o-mini"}, concurrency=concurrency)
+        self.final_llm = get_backend(backend, preferred={"openai": "gpt-4o"}, concurrency=concurrency)
+        self.summary_cache = shared_summary_cache()
 
-    def log_to_file(self, message: str, file_path: str = "rag_summary.log") -> None:
-        with open(file_path, "a", encoding="utf-8") as f:
-            f.write(message + "\n")
+    def log_to_file(self, message: str) -> None:
+        self.file_log.write(message)
 
     def compose(self) -> ComposeResult:
         yield Header()
@@ -42,79 +51,69 @@ class FHIRSummaryAppOpenAI(App):
             self.summary_widgets = []
 
     async def on_mount(self) -> None:
-        open("rag_summary.log", "w", encoding="utf-8").write("")
+        self.file_log = BufferedFileLog("rag_summary.log")
         self.log_to_file("Starting resource summarization...")
         self.query_one("#partial-summary-header", Markdown).update("# Partial Summaries")
         self.run_worker(self.process_summary_with_rag, exclusive=True)
 
     async def process_summary_with_rag(self) -> None:
-        cursor = self.conn.cursor()
+        # One round trip for every resource type, grouped in Python
+        self.log_to_file(f"Executing query for patient_id={self.fhirId}, {len(RESOURCE_TYPES)} resource types")
+        try:
+            texts_by_type = await asyncio.to_thread(
+                fetch_texts_by_type, self.conn, self.fhirId, RESOURCE_TYPES, self.log_to_file)
+        except Exception as e:
+            self.log_to_file(f"Query failed: {type(e).__name__}: {e}")
+            texts_by_type = {}
 
+        jobs = []
         for rtype in RESOURCE_TYPES:
-            texts = []
-            try:
-                self.log_to_file(f"Executing query for patient_id={self.fhirId}, resource_type='{rtype}'")
-                cursor.execute("""
-                    SELECT STRING(resourcetext)
-                    FROM PatientVectors
-                    WHERE patient_id = ? AND resource_type = ?
-                """, [self.fhirId, rtype])
-
-                i = 0
-                while True:
-                    try:
-                        row = cursor.fetchone()
-                        if row is None:
-                            break
-                        val = row[0]
-
-                        if isinstance(val, list):
-                            val = val[0] if val else None
-
-                        if val is None or not isinstance(val, str) or not val.strip():
-                            self.log_to_file(f"Skipping row {i} for {rtype} — type: {type(val)}")
-                            i += 1
-                            continue
-
-                        texts.append(val)
-                        self.log_to_file(f"Row {i} for {rtype} accepted: {repr(val)[:100]}")
-                        i += 1
-
-                    except Exception as row_err:
-                        self.log_to_file(f"Row fetch error at index {i} for {rtype}: {type(row_err).__name__}: {row_err}")
-                        break
-
-            except Exception as e:
-                self.log_to_file(f"Query failed for {rtype}: {type(e).__name__}: {e}")
-
-            self.log_to_file(f"Texts for {rtype}: count = {len(texts)}")
+            texts = texts_by_type.get(rtype, [])
             if not texts:
                 continue
 
             context = "\n".join(texts)
             context_truncated = self.truncate_to_tokens(context, max_tokens=7000)
-            summary = await asyncio.to_thread(self.summarize_resource_type, rtype, context_truncated)
-            self.partial_summaries[rtype] = summary.strip()
+            # Mount the section up front so the LLM output streams into it
+            stream = self.new_stream(f"## {rtype} Summary\n\n", rtype)
+            await self.mount(stream.widget)
+            jobs.append((rtype, self.summarize_resource_type, rtype, context_truncated, stream))
 
-            self.mount(Markdown(f"## {rtype} Summary\n\n{summary.strip()}"))
+        def show_partial(rtype: str, summary: str) -> None:
+            self.streams[rtype].finish(summary.strip())
             self.progress.advance(1)
 
+        # Section summaries are independent, so run them concurrently
+        results = await self.scheduler.run(jobs, show_partial)
+        self.partial_summaries = {rtype: summary.strip() for rtype, summary in results.items()}
+
         if not self.partial_summaries:
             self.log_to_file("No partial summaries were generated.")
-            cursor.close()
             return
 
         all_text = "\n".join(self.partial_summaries.values())
         final_input = self.truncate_to_tokens(all_text, max_tokens=4000)
         self.log_to_file(f"Generating final summary from combined partials...")
         self.mount(Markdown("\n---\n\n# Final Summary"))
-        self.final_summary_text = await asyncio.to_thread(self.summarize_final_summary, final_input)
-        self.mount(Markdown("\n\n" + self.final_summary_text.strip()))
+        final_stream = self.new_stream("", "final summary")
+        await self.mount(final_stream.widget)
+        self.final_summary_text = await self.scheduler.run_final(
+            self.summarize_final_summary, final_input, final_stream)
+        final_stream.finish(self.final_summary_text.strip())
         self.log_to_file("Final summary displayed.")
         self.progress.advance(1)
-        cursor.close()
-
-    def summarize_resource_type(self, rtype: str, text: str) -> str:
+        llm_stats = (f"sections: {self.llm.stats.summary()}; final: {self.final_llm.stats.summary()}; "
+                     f"{self.summary_cache.summary()}")
+        self.log_to_file(f"Latency: {self.scheduler.report()}; {llm_stats}")
+        self.mount(Markdown(f"_⏱️ {self.scheduler.report()}_\n\n_⏱️ {llm_stats}_"))
+        self.file_log.flush()
+
+    def new_stream(self, header: str, label: str) -> MarkdownStream:
+        stream = MarkdownStream(self, Markdown(header + "_Waiting..._"), header=header)
+        self.streams[label] = stream
+        return stream
+
+    def summarize_resource_type(self, rtype: str, text: str, stream: MarkdownStream) -> str:
         prompt = (
             f"You are a clinical summarization assistant.\n"
             f"Summarize the following {rtype} information for a patient.\n"
@@ -124,48 +123,31 @@ class FHIRSummaryAppOpenAI(App):
             f"--- BEGIN DATA ---\n{text}\n--- END DATA ---\n\nSummary:"
         )
         try:
-            response = self.client.chat.completions.create(
-              model="gpt-4o-mini",
-              messages=[{"role": "user", "content": prompt}],
-              max_tokens=8000,
-              temperature=0.3,
-            )
-            summary = response.choices[0].message.content.strip()
-
-            words = summary.split()
-            if len(words) > 100:
-                summary = " ".join(words[:100]) + "..."
-            sentences = re.split(r'(?<=[.!?]) +', summary)
-            if len(sentences) > 5:
-                summary = " ".join(sentences[:5]) + "..."
-
-            return summary
+            summary = self.summary_cache.complete(self.llm, prompt, SECTION_TEMPLATE, self.fhirId, stream,
+                                                  max_tokens=8000, temperature=0.3)
+            return clip_summary(summary)
 
-        except Exception as e:
+        except LLMError as e:
             self.log_to_file(f"OpenAI error during {rtype}: {e}")
             return f"[OpenAI summarization failed for {rtype}]"
 
-    def summarize_final_summary(self, text: str) -> str:
+    def summarize_final_summary(self, text: str, stream: MarkdownStream) -> str:
         prompt = (
             "You are a clinical summarization assistant. Given the following section summaries, write a concise 1–2 paragraph overview of the patient's condition."
             f"\n\n{text}\n\nFinal Summary:"
         )
         try:
-            response = self.client.chat.completions.create(
-                model="gpt-4o",
-                messages=[{"role": "user", "content": prompt}],
-                max_tokens=7000,
-                temperature=0.3,
-            )
-            return response.choices[0].message.content.strip()
-        except Exception as e:
+            return self.summary_cache.complete(self.final_llm, prompt, FINAL_TEMPLATE, self.fhirId, stream,
+                                               max_tokens=7000, temperature=0.3).strip()
+        except LLMError as e:
             self.log_to_file(f"OpenAI error during final summary: {e}")
             return "[OpenAI final summary failed]"
 
     def truncate_to_tokens(self, text: str, max_tokens: int = 1500) -> str:
-        enc = tiktoken.encoding_for_model("gpt-3.5-turbo")
-        tokens = enc.encode(text)
-        return enc.decode(tokens[:max_tokens])
+        return truncate_to_tokens(text, max_tokens)
+
+    def on_unmount(self) -> None:
+        self.file_log.close()
 
     def action_toggle_dark(self) -> None:
         return super().action_toggle_dark()
@@ -0,0 +1,147 @@
+import os
+import json
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from fhirstream import iter_bundle_file
+from vectorcodec import decode_vector
+# Only light imports at module level: spawned workers re-import this module.
+# The embedding model and IRIS engine are imported where the parent needs them.
+from fhirrows import DEFAULT_BATCH_SIZE, EMBED_MODEL, bundle_to_rows, embed_rows, print_throughput
+
+BUNDLE_DIR = "100Set"
+# Files flattened ahead of the embedder per worker process; bounds the rows
+# held in the parent
+IN_FLIGHT_PER_PROCESS = 2
+
+
+class LocalVectorStore:
+    """
+    Writes embedded rows to a JSON Lines file instead of IRIS, one object per
+    resource. Exposes the same write_rows() as FHIRVectorEngine.
+    """
+    COLUMNS = ["patient_id", "patient_lastname", "patient_firstname",
+               "resource_type", "resource_id", "embedding", "resourcetext",
+               "content_hash", "version_id", "last_updated"]
+
+    def __init__(self, path: str):
+        self.path = path
+        self.file = open(path, "w", encoding="utf-8")
+
+    def write_rows(self, rows: list) -> int:
+        for row in rows:
+            record = dict(zip(self.COLUMNS, row))
+            record["embedding"] = decode_vector(record["embedding"]).tolist()
+            self.file.write(json.dumps(record) + "\n")
+        self.file.flush()
+        return len(rows)
+
+    def close(self) -> None:
+        self.file.close()
+
+
+def list_bundle_files(directory: str) -> list:
+    return sorted(
+        os.path.join(directory, name)
+        for name in os.listdir(directory)
+        if name.endswith(".json")
+    )
+
+
+def load_bundle_rows(path: str) -> list:
+    """
+    Streams one Synthea bundle from disk and flattens it into rows ready to
+    embed. Worker entry point when the loader uses a process pool; needs
+    nothing beyond fhirrows and fhirstream.
+    """
+    return bundle_to_rows(iter_bundle_file(path))
+
+
+class BundleDirectoryLoader:
+    """
+    Rebuilds the vector index from a directory of FHIR bundles without a
+    FHIR server: files are read and flattened (optionally in a process
+    pool), embedded in batches and written to IRIS or a local store.
+
+    With processes > 0, workers are spawned (not forked from a parent
+    holding the model and a DB connection), and at most
+    IN_FLIGHT_PER_PROCESS files per worker are flattened ahead of the
+    embedder; each file's rows are written as soon as it finishes, in
+    completion order.
+    """
+    def __init__(self, directory: str = BUNDLE_DIR, batch_size: int = DEFAULT_BATCH_SIZE,
+                 processes: int = 0, local_path: str = None):
+        self.directory = directory
+        self.batch_size = batch_size
+        self.processes = processes
+        if local_path:
+            from sentence_transformers import SentenceTransformer
+            self.model = SentenceTransformer(EMBED_MODEL, trust_remote_code=True)
+            self.store = LocalVectorStore(local_path)
+        else:
+            from fhirvectorflattened import FHIRVectorEngine
+            engine = FHIRVectorEngine(batch_size=batch_size)
+            self.model = engine.model
+            self.store = engine
+        self.inserted = 0
+
+    def iter_file_rows(self, files: list):
+        """
+        Yields (path, rows, error) per file; error is the exception that
+        reading or flattening it raised, if any.
+        """
+        if self.processes <= 0:
+            for path in files:
+                try:
+                    yield path, load_bundle_rows(path), None
+                except Exception as e:
+                    yield path, [], e
+            return
+        window = self.processes * IN_FLIGHT_PER_PROCESS
+        pending = list(reversed(files))
+        in_flight = {}
+        with ProcessPoolExecutor(max_workers=self.processes,
+                                 mp_context=multiprocessing.get_context("spawn")) as pool:
+            while True:
+                while pending and len(in_flight) < window:
+                    path = pending.pop()
+                    in_flight[pool.submit(load_bundle_rows, path)] = path
+                if not in_flight:
+                    return
+                finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    path = in_flight.pop(future)
+                    error = future.exception()
+                    yield path, [] if error else future.result(), error
+
+    def run(self) -> None:
+        files = list_bundle_files(self.directory)
+        print(f"Loading {len(files)} bundles from {self.directory}")
+        started = time.perf_counter()
+        for path, rows, error in self.iter_file_rows(files):
+            if error is not None:
+                print(f"❌ Failed to read {path}: {error}")
+                continue
+            try:
+                for i in range(0, len(rows), self.batch_size):
+                    batch = embed_rows(self.model, rows[i:i + self.batch_size], self.batch_size)
+                    self.inserted += self.store.write_rows(batch)
+                print(f"✅ {os.path.basename(path)}: {len(rows)} resources")
+            except Exception as e:
+                print(f"❌ Failed to load {path}: {e}")
+        if isinstance(self.store, LocalVectorStore):
+            self.store.close()
+        print_throughput(f"{len(files)} bundles", self.inserted, time.perf_counter() - started)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Index a directory of FHIR bundles without a FHIR server")
+    parser.add_argument("directory", nargs="?", default=BUNDLE_DIR)
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--processes", type=int, default=0,
+                        help="worker processes reading and flattening files (0 = in-process)")
+    parser.add_argument("--local", metavar="PATH",
+                        help="write vectors to a JSON Lines file instead of IRIS")
+    args = parser.parse_args()
+    BundleDirectoryLoader(args.directory, args.batch_size, args.processes, args.local).run()
@@ -0,0 +1,92 @@
+import os
+import time
+import argparse
+from fhirpathpy import evaluate as fhirpath
+from fhirstream import iter_bundle_file
+from fhirrows import RESOURCE_TYPES
+
+
+class BundleIndex:
+    """
+    Groups the resources of a bundle by resourceType and by reference in a
+    single linear pass, so per-type lookups are dictionary hits instead of a
+    full FHIRPath where(resourceType = ...) scan over the bundle each time.
+
+    Accepts the list returned by get_everything_for_patient, a streaming
+    iterator of resources, or a Bundle dict (whose fullUrls are indexed too).
+    """
+    def __init__(self, resources):
+        self.by_type = {}
+        self.by_reference = {}
+        if isinstance(resources, dict) and resources.get("resourceType") == "Bundle":
+            entries = resources.get("entry", [])
+        else:
+            entries = ({"resource": res} for res in resources)
+        for entry in entries:
+            res = entry.get("resource")
+            if not res:
+                continue
+            rtype = res.get("resourceType")
+            self.by_type.setdefault(rtype, []).append(res)
+            if res.get("id"):
+                self.by_reference[f"{rtype}/{res['id']}"] = res
+            if entry.get("fullUrl"):
+                self.by_reference[entry["fullUrl"]] = res
+
+    def of_type(self, resource_type: str) -> list:
+        return self.by_type.get(resource_type, [])
+
+    def resolve(self, reference) -> dict:
+        """
+        Looks up a "Type/id" or "urn:uuid:..." reference, or a Reference
+        dict with a "reference" key. Returns None when not in the bundle.
+        """
+        if isinstance(reference, dict):
+            reference = reference.get("reference")
+        return self.by_reference.get(reference)
+
+    def types(self) -> list:
+        return list(self.by_type)
+
+    def __len__(self) -> int:
+        return sum(len(resources) for resources in self.by_type.values())
+
+
+def benchmark(directory: str, resource_types: list, limit: int = None) -> None:
+    """
+    Compares one FHIRPath where() scan per resource type against a single
+    BundleIndex pass followed by per-type lookups, over bundles on disk.
+    """
+    files = sorted(os.path.join(directory, f) for f in os.listdir(directory) if f.endswith(".json"))[:limit]
+    fhirpath_seconds = 0.0
+    index_seconds = 0.0
+    resources_seen = 0
+    for path in files:
+        resources = list(iter_bundle_file(path))
+        resources_seen += len(resources)
+
+        started = time.perf_counter()
+        scanned = [fhirpath(resources, f"where(resourceType = '{rtype}')") for rtype in resource_types]
+        fhirpath_seconds += time.perf_counter() - started
+
+        started = time.perf_counter()
+        index = BundleIndex(resources)
+        indexed = [index.of_type(rtype) for rtype in resource_types]
+        index_seconds += time.perf_counter() - started
+
+        if [len(r) for r in scanned] != [len(r) for r in indexed]:
+            print(f"❌ Mismatch between FHIRPath and BundleIndex for {path}")
+
+    print(f"{len(files)} bundles, {resources_seen} resources, {len(resource_types)} resource types")
+    print(f"  FHIRPath scan per type : {fhirpath_seconds:8.3f}s")
+    print(f"  BundleIndex single pass: {index_seconds:8.3f}s")
+    if index_seconds > 0:
+        print(f"  speedup                : {fhirpath_seconds / index_seconds:8.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark BundleIndex against per-type FHIRPath scans")
+    parser.add_argument("directory", nargs="?", default="100Set")
+    parser.add_argument("--limit", type=int, default=None, help="only use the first N bundles")
+    args = parser.parse_args()
+    benchmark(args.directory, RESOURCE_TYPES, args.limit)
@@ -0,0 +1,140 @@
+import sqlite3
+import threading
+from collections import OrderedDict
+import numpy as np
+
+DEFAULT_CAPACITY = 1024
+# On-disk tier shared by the query paths; pass disk_path=None to keep it in memory only
+DEFAULT_DISK_PATH = "query_embeddings.sqlite"
+
+
+def normalize_query(text: str) -> str:
+    """
+    Cache key form of a query: surrounding/repeated whitespace collapsed and
+    case folded, so "Does the patient have diabetes?" and
+    "does the patient  have diabetes? " share one entry.
+    """
+    return " ".join(str(text).split()).casefold()
+
+
+class EmbeddingCache:
+    """
+    LRU cache of query embeddings keyed by (model name, normalized text),
+    with an optional SQLite tier that survives restarts. The normalized text
+    is what gets embedded, so a cached vector never depends on which casing
+    or spacing of a question happened to be asked first.
+
+    Safe to share across threads (Textual apps embed via asyncio.to_thread).
+    """
+    def __init__(self, model, model_name: str, capacity: int = DEFAULT_CAPACITY,
+                 disk_path: str = DEFAULT_DISK_PATH):
+        self.model = model
+        self.model_name = model_name
+        self.capacity = capacity
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.db = None
+        if disk_path:
+            self.db = sqlite3.connect(disk_path, check_same_thread=False)
+            self.db.execute("""
+                CREATE TABLE IF NOT EXISTS query_embeddings (
+                    model TEXT NOT NULL,
+                    query TEXT NOT NULL,
+                    embedding BLOB NOT NULL,
+                    PRIMARY KEY (model, query)
+                )
+            """)
+            self.db.commit()
+
+    def _remember(self, key: str, vec: np.ndarray) -> None:
+        # caller holds self.lock
+        self.entries[key] = vec
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def _load(self, key: str):
+        row = self.db.execute(
+            "SELECT embedding FROM query_embeddings WHERE model = ? AND query = ?",
+            (self.model_name, key)
+        ).fetchone()
+        return np.frombuffer(row[0], dtype=np.float32) if row else None
+
+    def _store(self, key: str, vec: np.ndarray) -> None:
+        self.db.execute(
+            "INSERT OR REPLACE INTO query_embeddings (model, query, embedding) VALUES (?, ?, ?)",
+            (self.model_name, key, vec.tobytes())
+        )
+        self.db.commit()
+
+    def encode(self, text: str) -> np.ndarray:
+        """
+        Returns the embedding for `text`, running the model only on a miss in
+        both the memory and disk tiers. The returned array is read-only
+        because it is shared with later callers.
+        """
+        key = normalize_query(text)
+        with self.lock:
+            vec = self.entries.get(key)
+            if vec is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return vec
+            if self.db is not None:
+                vec = self._load(key)
+                if vec is not None:
+                    self.disk_hits += 1
+                    self._remember(key, vec)
+                    return vec
+
+        vec = np.asarray(self.model.encode(key), dtype=np.float32)
+        vec.setflags(write=False)
+        with self.lock:
+            self.misses += 1
+            self._remember(key, vec)
+            if self.db is not None:
+                self._store(key, vec)
+        return vec
+
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.disk_hits + self.misses
+        return (self.hits + self.disk_hits) / lookups if lookups else 0.0
+
+    def stats(self) -> dict:
+        return {
+            "hits": self.hits,
+            "disk_hits": self.disk_hits,
+            "misses": self.misses,
+            "size": len(self.entries),
+            "capacity": self.capacity,
+            "hit_rate": self.hit_rate(),
+        }
+
+    def report(self) -> None:
+        s = self.stats()
+        print(f"Query embedding cache: hits={s['hits']} disk_hits={s['disk_hits']} "
+              f"misses={s['misses']} size={s['size']}/{s['capacity']} hit_rate={s['hit_rate']:.1%}")
+
+    def close(self) -> None:
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+
+_shared = {}
+_shared_lock = threading.Lock()
+
+
+def shared_cache(model, model_name: str, capacity: int = DEFAULT_CAPACITY,
+                 disk_path: str = DEFAULT_DISK_PATH) -> EmbeddingCache:
+    """
+    Returns the process-wide cache for `model_name`, creating it around
+    `model` on first use, so every query path in the process shares one LRU.
+    """
+    with _shared_lock:
+        if model_name not in _shared:
+            _shared[model_name] = EmbeddingCache(model, model_name, capacity, disk_path)
+        return _shared[model_name]
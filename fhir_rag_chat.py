@@ -3,36 +3,35 @@ from textual.app import App, ComposeResult
 from textual.widgets import Header, Footer, Input, Button, Markdown, Static
 from textual.containers import VerticalScroll, Vertical
 import iris
-import tiktoken
 from sentence_transformers import SentenceTransformer
-import lmstudio as lms
 import asyncio
 from typing import List, Tuple
+from embeddingcache import shared_cache
+from ragretrieval import VectorRetriever, retrieve_context
+from llmstream import MarkdownStream
+from llmbackend import get_backend, LLMError
 
 VECTOR_TABLE = "PatientVectors"  # or "PatientSummaryVectors"
 EMBED_MODEL = "nomic-ai/nomic-embed-text-v1.5"
 VECTOR_DIM = 768
-TOP_K = 4
-
-def embed_text(model, text: str) -> List[float]:
-    enc = tiktoken.encoding_for_model("gpt-3.5-turbo")
-    tokens = enc.encode(text)
-    # optionally truncate tokens here
-    vec = model.encode(text).tolist()
-    return vec
+TOP_K = 4  # per searched resource type
+MAX_PASSAGES = 8
+TOKEN_BUDGET = 2000
 
 class FHIRRAGChatApp(App):
     BINDINGS = [("d", "toggle_dark", "Toggle dark mode")]
 
-    def __init__(self, **kwargs):
+    def __init__(self, backend: str = None, **kwargs):
         super().__init__(**kwargs)
-        # LLM client
-        self.client = lms.Client()
-        self.llm = self.client.llm.model("mistral-7b-instruct-v0.3")
+        # LLM backend (FHIR_LLM_BACKEND / FHIR_LLM_MODEL switch it)
+        self.llm = get_backend(backend, preferred={"lmstudio": "mistral-7b-instruct-v0.3"})
         # Embedding model
         self.embedder = SentenceTransformer(EMBED_MODEL, trust_remote_code=True)
+        # Repeated questions across patients skip the forward pass
+        self.query_cache = shared_cache(self.embedder, EMBED_MODEL)
         # IRIS connection
         self.conn = iris.connect("127.0.0.1", 1972, "DEMO", "_SYSTEM", "ISCDEMO")
+        self.retriever = VectorRetriever(self.conn, self.query_cache, VECTOR_TABLE)
 
     def compose(self) -> ComposeResult:
         yield Header()
@@ -61,12 +60,15 @@ class FHIRRAGChatApp(App):
         # Reference to the chat log area
         chat = self.query_one("#chat-log", VerticalScroll)
 
-        # This line must live inside an async function:
-        answer, first, last = await asyncio.to_thread(self.run_rag, fhir_id, query)
+        # Echo the user message and mount the bot message the answer streams into
+        chat.mount(Markdown(f"**User (Patient ID={fhir_id}):** {query}\n"))
+        stream = MarkdownStream(self, Markdown("**Bot:** _Retrieving..._"), header="**Bot:** ")
+        await chat.mount(stream.widget)
 
-        # Echo the user and bot messages
-        chat.mount(Markdown(f"**User (Patient {first} {last}, ID={fhir_id}):** {query}\n"))
-        chat.mount(Markdown(f"**Bot (for {first} {last}):** {answer}\n"))
+        # This line must live inside an async function:
+        answer, first, last = await asyncio.to_thread(self.run_rag, fhir_id, query, stream)
+        stream.finish(f"{answer}\n")
+        chat.mount(Static(f"⏱️  {self.retriever.timings.summary()}"))
 
         # Scroll to the bottom
         chat.scroll_end(animate=False)
@@ -74,44 +76,15 @@ class FHIRRAGChatApp(App):
             
       
 
-    def run_rag(self, fhir_id: str, query: str) -> str:
-        # 1) embed the query
-        vec = embed_text(self.embedder, query)
-        csv = ",".join(f"{x:.8f}" for x in vec)
-
-        # 2) retrieve top-K passages for this patient
-        sql = f"""
-          SELECT TOP {TOP_K}
-            resource_id,
-            VECTOR_COSINE(embedding, TO_VECTOR(?,DOUBLE)) AS score
-          FROM {VECTOR_TABLE}
-          WHERE patient_id = ? AND resource_type = 'Condition'
-          ORDER BY score DESC
-        """
-        cur = self.conn.cursor()
-        cur.execute(sql, [csv, fhir_id])
-        id_sim_pairs = cur.fetchall()
-
-        if not id_sim_pairs:
-            return "No matching data found for that patient."
-        
-        cur = self.conn.cursor()
-        
-
-
-       # Step 2: for each ID, fetch the text separately
-        results = []
-        text_sql = "SELECT CAST(resourcetext AS VARCHAR(4000)), patient_lastname, patient_firstname FROM PatientVectors WHERE resource_id = ?"
-        for rid, sim in id_sim_pairs:
-            cur.execute(text_sql, [rid])
-            (text, ptLastName, ptFirstName) = cur.fetchone()
-            results.append((rid, text, ptLastName, ptFirstName,sim))
-
-        # 3) assemble context
-        _, _, ptLastName, ptFirstName, _ = results[0]
-        passages = [text for (_rid, text, ptLastName, ptFirstName, _sim) in results]
-        # then join with double-newlines
-        context = "\n\n".join(passages)
+    def run_rag(self, fhir_id: str, query: str, stream: MarkdownStream) -> str:
+        # 1) embed the query, 2) search the resource types the question is
+        # about for this patient and 3) pack the best passages into the budget
+        context, results, _types = retrieve_context(
+            self.retriever, query, patient_id=fhir_id,
+            per_type_k=TOP_K, max_passages=MAX_PASSAGES, token_budget=TOKEN_BUDGET)
+        if not results:
+            return "No matching data found for that patient.", "", ""
+        ptLastName, ptFirstName = results[0].patient_lastname, results[0].patient_firstname
 
         # 4) build RAG prompt
         prompt = (
@@ -123,13 +96,23 @@ class FHIRRAGChatApp(App):
             f"Question: {query}\nAnswer:"
         )
 
-        # 5) call LLM
-        resp = self.llm.complete(prompt)
-        answer = resp.content.strip()
+        # 5) call LLM, streaming the answer into the chat as it is generated
+        stream.header = f"**Bot (for {ptFirstName} {ptLastName}):** "
+        with self.retriever.timings.stage("llm"):
+            try:
+                answer = self.llm.complete(prompt, stream).strip()
+            except LLMError as e:
+                answer = f"_LLM call failed: {e}_"
+        if stream.first_token is not None:
+            self.retriever.timings.add("first token", stream.first_token)
         return answer, ptFirstName, ptLastName
 
     def action_toggle_dark(self) -> None:
         self.dark = not self.dark
 
 if __name__ == "__main__":
-    FHIRRAGChatApp().run()
+    app = FHIRRAGChatApp()
+    app.run()
+    app.query_cache.report()
+    app.retriever.timings.report()
+    app.llm.stats.report()
@@ -1,29 +1,48 @@
 from typing import List
 from textual.app import App, ComposeResult
-from textual.containers import VerticalScroll
+from textual.containers import Vertical, VerticalScroll
 from textual.widgets import Header, Footer, Markdown, ProgressBar
-from textual.worker import Worker, get_current_worker
-import lmstudio as lms
+from tokenutils import get_encoder, truncate_to_tokens, chunk_text_tokenwise
 import json, decimal
 import sys
-import tiktoken
 import asyncio
 from rich.console import Console
-from getSearchPatients import get_everything_for_patient
+from getSearchPatients import get_everything_for_patient, iter_everything_for_patient
+from mapreduce import MapReduceSummarizer, MapReduceError, FAN_IN, MAX_DEPTH
+from summarysupport import SUMMARY_CONCURRENCY
+from llmstream import MarkdownStream
+from llmbackend import get_backend, LLMError
+from summarycache import shared_summary_cache
+
+CHUNK_TOKENS = 1500
+# Summary cache keys; bump the version when a prompt's meaning changes
+CHUNK_TEMPLATE = "mapreduce-chunk/v1"
+REDUCE_TEMPLATE = "mapreduce-reduce/v1"
+FINAL_TEMPLATE = "mapreduce-final/v1"
 
 
 class FHIRApp(App):
     BINDINGS = [('d', 'toggle_dark', 'Toggle dark mode')]
+    CSS = "#summaries { height: auto; }"
 
-    def __init__(self, ptFHIRid, **kwargs):
+    def __init__(self, ptFHIRid, chunk_tokens: int = CHUNK_TOKENS, fan_in: int = FAN_IN,
+                 max_depth: int = MAX_DEPTH, concurrency: int = SUMMARY_CONCURRENCY,
+                 backend: str = None, **kwargs):
         super().__init__(**kwargs)
         self.fhirId = ptFHIRid
-        self.client = lms.Client()
-        #self.model = self.client.llm.model("deepseek-r1-distill-qwen-7b")
-        self.model = self.client.llm.model("llama-3.2-3b-instruct")
+        self.chunk_tokens = chunk_tokens
+        self.summarizer = MapReduceSummarizer(
+            self.summarize_chunk, self.reduce_summaries, self.summarize_final,
+            fan_in=fan_in, max_depth=max_depth, concurrency=concurrency,
+            on_result=self.show_result)
+        self.streams = {}
+        self.shown = set()
+        #self.llm = get_backend(backend, "deepseek-r1-distill-qwen-7b")
+        self.llm = get_backend(backend, preferred={"lmstudio": "llama-3.2-3b-instruct"}, concurrency=concurrency)
+        self.summary_cache = shared_summary_cache()
 
         self.batch_summaries: List[str] = []
-        self.partial_summaries: List[str] = []
+        self.partial_summaries: List[List[str]] = []
         self.final_summary: str = ""
 
     def compose(self) -> ComposeResult:
@@ -31,14 +50,10 @@ class FHIRApp(App):
         yield Footer()
         with VerticalScroll():
             yield Markdown("# FHIR Batch Summaries", id="batch-title")
-            self.progress = ProgressBar(total=10, id="progress-bar")
+            self.progress = ProgressBar(total=None, id="progress-bar")
             yield self.progress
-            for i in range(10):
-                yield Markdown(f"### Batch {i+1}\n_Initializing..._", id=f"batch-{i+1}")
-            yield Markdown("## Partial Summaries (Batches 1-5):", id="partial-title1")
-            yield Markdown("...", id="partial-1")
-            yield Markdown("## Partial Summaries (Batches 6-10):", id="partial-title2")
-            yield Markdown("...", id="partial-2")
+            # Batch and intermediate summaries stream into widgets mounted here
+            yield Vertical(id="summaries")
             yield Markdown("## Final Summary:", id="final-title")
             yield Markdown("...", id="final-summary")
 
@@ -47,50 +62,85 @@ class FHIRApp(App):
             self.run_worker(self.process_summaries, exclusive=True)
 
     async def process_summaries(self) -> None:
-        bundle = self.get_patient_bundle(self.fhirId)
-        text = "\n".join(json.dumps(item, indent=2, default=self.make_json_safe) for item in bundle)
-        chunks = self.chunk_text_tokenwise(text, max_tokens=1500)[:10]
-
-        self.batch_summaries = []
-        for i, chunk in enumerate(chunks):
-            self.query_one(f"#batch-{i+1}", Markdown).update("_Loading batch summary..._")
-            await asyncio.sleep(0.1)
-            summary = await asyncio.to_thread(self.summarize_chunk, chunk, i)
-            self.batch_summaries.append(summary)
-            self.query_one(f"#batch-{i+1}", Markdown).update(f"### Batch Summary {i+1} \n {summary}")
-            self.progress.advance(1)
-            await asyncio.sleep(0.1)
-
-        self.final_summary = await asyncio.to_thread(self.merge_summaries, self.batch_summaries)
-        if len(self.partial_summaries) >= 2:
-            self.query_one("#partial-1", Markdown).update(self.partial_summaries[0].replace("**", "**").replace("- **", "- **"))
-            self.query_one("#partial-2", Markdown).update(self.partial_summaries[1].replace("**", "**").replace("- **", "- **"))
-        else:
-            self.query_one("#partial-1", Markdown).update("_Partial summary unavailable._")
-            self.query_one("#partial-2", Markdown).update("_Partial summary unavailable._")
-        self.query_one("#final-summary", Markdown).update(self.final_summary.replace("**", "**").replace("- **", "- **"))
+        # Every chunk of the record is summarized; the map-reduce tree keeps
+        # latency growing with its depth instead of the chunk count
+        resources = iter_everything_for_patient(self.fhirId)
+        chunks = await asyncio.to_thread(self.chunk_resources_tokenwise, resources, self.chunk_tokens)
+        plan = self.summarizer.plan(len(chunks))
+        self.progress.update(total=sum(plan))
+        self.query_one("#batch-title", Markdown).update(
+            f"# FHIR Batch Summaries\n{len(chunks)} chunks, merge levels: {' → '.join(map(str, plan))}")
+
+        # One widget per call of the tree, mounted before the calls start
+        widgets = []
+        for level, count in enumerate(plan[:-1]):
+            for index in range(count):
+                title = (f"### Batch Summary {index+1}\n" if level == 0
+                         else f"### Intermediate Summary {index+1} (level {level})\n")
+                stream = MarkdownStream(self, Markdown(title + "_Waiting..._"), header=title)
+                self.streams[level, index] = stream
+                widgets.append(stream.widget)
+        await self.query_one("#summaries", Vertical).mount_all(widgets)
+        self.streams["final"] = MarkdownStream(self, self.query_one("#final-summary", Markdown))
+
+        try:
+            self.final_summary = await self.summarizer.run(chunks)
+        except MapReduceError as e:
+            Console().log(f"Map-reduce summary failed: {e}")
+            self.final_summary = f"_Final summary could not be generated: {e}_"
+        self.mark_skipped()
+        self.batch_summaries = self.summarizer.levels[0] if self.summarizer.levels else []
+        self.partial_summaries = self.summarizer.levels[1:]
+        self.streams["final"].finish(
+            f"{self.final_summary or '_No resources found._'}\n\n_⏱️ {self.summarizer.report()}_\n\n"
+            f"_⏱️ {self.llm.stats.summary()}; {self.summary_cache.summary()}_")
+
+    def show_result(self, stage: str, level: int, index: int, text: str) -> None:
+        self.progress.advance(1)
+        if stage != "final":
+            self.shown.add((level, index))
+            self.streams[level, index].finish(text)
+
+    def mark_skipped(self) -> None:
+        """
+        The plan assumes every call succeeds; failed summaries leave fewer
+        groups (or levels) to merge, so the widgets of calls that never ran
+        are labelled as skipped and the progress bar is completed.
+        """
+        for key, stream in self.streams.items():
+            if key != "final" and key not in self.shown:
+                stream.finish("_Skipped: earlier summaries failed, so this merge was not needed._")
+        self.progress.update(progress=self.progress.total)
 
     def get_patient_bundle(self, patfhirid: str) -> list:
         return get_everything_for_patient(patfhirid)
 
     def chunk_text_tokenwise(self, text: str, max_tokens: int = 1000) -> List[str]:
-        enc = tiktoken.encoding_for_model("gpt-3.5-turbo")
-        tokens = enc.encode(text)
+        return chunk_text_tokenwise(text, max_tokens)
+
+    def chunk_resources_tokenwise(self, resources, max_tokens: int = 1000, max_chunks: int = None) -> List[str]:
+        """
+        Streaming counterpart of chunk_text_tokenwise: serializes resources one
+        at a time and cuts token chunks as they fill, so the whole bundle is
+        never held as one string. Stops reading once max_chunks are built.
+        """
+        enc = get_encoder()
         chunks = []
-        start = 0
-        while start < len(tokens):
-            end = start + max_tokens
-            chunk_tokens = tokens[start:end]
-            chunk_text = enc.decode(chunk_tokens)
-            chunks.append(chunk_text)
-            start = end
+        tokens = []
+        for item in resources:
+            text = json.dumps(item, indent=2, default=self.make_json_safe)
+            tokens.extend(enc.encode(text + "\n"))
+            while len(tokens) >= max_tokens:
+                chunks.append(enc.decode(tokens[:max_tokens]))
+                tokens = tokens[max_tokens:]
+                if max_chunks is not None and len(chunks) >= max_chunks:
+                    return chunks
+        if tokens:
+            chunks.append(enc.decode(tokens))
         return chunks
 
     def truncate_to_tokens(self, text: str, max_tokens: int = 700) -> str:
-        enc = tiktoken.encoding_for_model("gpt-3.5-turbo")
-        tokens = enc.encode(text)
-        clipped_tokens = tokens[:max_tokens]
-        return enc.decode(clipped_tokens)
+        return truncate_to_tokens(text, max_tokens)
 
     def summarize_chunk(self, chunk: str, chunk_index: int) -> str:
         prompt = (
@@ -101,36 +151,26 @@ class FHIRApp(App):
             f"FHIR Data Chunk:\n{chunk}\n\nSummary:"
         )
         print(f"--- Summarizing chunk {chunk_index+1} ---")
-        return self.model.complete(prompt).content
-
-    def merge_summaries(self, summaries: List[str]) -> str:
-        log = Console().log
-
-        print(f"🧠 Merging {len(summaries)} partial summaries in batches...")
-        batch_summaries = []
-        for i in range(0, len(summaries), 4):
-          batch = summaries[i:i+4]
-          clipped = [self.truncate_to_tokens(s, max_tokens=700) for s in batch]
-          batch_text = "\n\n".join(clipped)
-          log(f"Batch {i//4 + 1}: {len(batch_text)} characters")
-          batch_prompt = (
+        return self.summary_cache.complete(self.llm, prompt, CHUNK_TEMPLATE, self.fhirId,
+                                           self.streams[0, chunk_index])
+
+    def reduce_summaries(self, summaries: List[str], level: int, index: int) -> str:
+        batch_text = "\n\n".join(summaries)
+        Console().log(f"Level {level} merge {index+1}: {len(batch_text)} characters")
+        batch_prompt = (
             "You are a healthcare AI summarization assistant.\n"
             "Given the following partial summaries, combine them into a coherent intermediate summary.\n\n"
             f"{batch_text}\n\nIntermediate Summary:"
-         )
-          try:
-            result = self.model.complete(batch_prompt)
-            summary = result.content or "_LLM returned no intermediate summary._"
-            batch_summaries.append(summary)
-            log(f"Intermediate summary {i//4 + 1} complete.")
-          except Exception as e:
-            log(f"Failed to generate intermediate summary: {e}")
-            batch_summaries.append("_LLM failed to summarize batch._")
-
-        self.partial_summaries = batch_summaries[:2]
+        )
+        # Errors propagate so the summarizer leaves this group out of the merge
+        result = self.summary_cache.complete(self.llm, batch_prompt, REDUCE_TEMPLATE, self.fhirId,
+                                             self.streams[level, index])
+        if not result.strip():
+            raise LLMError("LLM returned no intermediate summary")
+        return result
 
-        clipped = [self.truncate_to_tokens(s, max_tokens=450) for s in self.partial_summaries]
-        final_text = "\n\n".join(clipped)
+    def summarize_final(self, summaries: List[str]) -> str:
+        final_text = "\n\n".join(summaries)
 
         final_prompt = f"""
            You are a clinical summarization AI.
@@ -142,14 +182,11 @@ class FHIRApp(App):
            Final Patient Summary:
            """
 
-        try:
-          final_response = self.model.complete(final_prompt)
-          final_result = final_response.content or "_LLM returned no final summary._"
-          log(" Final summary generated successfully.")
-          return final_result
-        except Exception as e:
-          log(f"Final summary generation failed: {e}")
-          return "Final summary could not be generated due to an error."
+        final_response = self.summary_cache.complete(self.llm, final_prompt, FINAL_TEMPLATE, self.fhirId,
+                                                     self.streams["final"])
+        final_result = final_response or "_LLM returned no final summary._"
+        Console().log(" Final summary generated successfully.")
+        return final_result
 
 
     def make_json_safe(self, obj):
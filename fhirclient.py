@@ -0,0 +1,245 @@
+import time
+import asyncio
+import threading
+import requests
+import httpx
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+
+# incremental bundle parsing
+from fhirstream import iter_bundle_resources, next_link
+
+FHIR_BASE_URL = "http://127.0.0.1:8080/csp/healthshare/demo/fhir/r4"
+FHIR_AUTH = ("_System", "ISCDEMO")
+FHIR_HEADERS = {
+    "Accept": "*/*",
+    "Content-Type": "application/fhir+json",
+    "Accept-Encoding": "gzip, deflate, br",
+    "Prefer": "return=representation"
+}
+DEFAULT_POOL_SIZE = 16
+DEFAULT_TIMEOUT = 120
+
+
+def bundle_next_url(bundle_dict: dict):
+    """
+    Returns Bundle.link[relation=next].url, or None on the last page.
+    """
+    return next_link([(link.get("relation"), link.get("url")) for link in bundle_dict.get("link", [])])
+
+
+def endpoint_name(base_url: str, url: str) -> str:
+    """
+    Collapses a request URL into an endpoint label for latency stats, e.g.
+    .../Patient/42/$everything?_count=50 -> "Patient/{id}/$everything".
+    """
+    path = url[len(base_url):] if url.startswith(base_url) else url
+    path = path.split("?", 1)[0].strip("/")
+    parts = path.split("/")
+    return "/".join(
+        part if i == 0 or part.startswith("$") else "{id}"
+        for i, part in enumerate(parts)
+    ) or "/"
+
+
+class LatencyHistogram:
+    """
+    Thread-safe per-endpoint latency histogram with fixed millisecond buckets.
+    """
+    BUCKETS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+    def __init__(self):
+        self.counts = {}
+        self.totals = {}
+        self.lock = threading.Lock()
+
+    def record(self, endpoint: str, seconds: float) -> None:
+        ms = seconds * 1000.0
+        bucket = next((i for i, bound in enumerate(self.BUCKETS_MS) if ms <= bound), len(self.BUCKETS_MS))
+        with self.lock:
+            counts = self.counts.setdefault(endpoint, [0] * (len(self.BUCKETS_MS) + 1))
+            counts[bucket] += 1
+            self.totals[endpoint] = self.totals.get(endpoint, 0.0) + seconds
+
+    def report(self) -> None:
+        labels = [f"<={b}ms" for b in self.BUCKETS_MS] + [f">{self.BUCKETS_MS[-1]}ms"]
+        print("FHIR request latency by endpoint:")
+        for endpoint, counts in self.counts.items():
+            calls = sum(counts)
+            mean_ms = 1000.0 * self.totals[endpoint] / calls
+            spread = ", ".join(f"{label}: {n}" for label, n in zip(labels, counts) if n)
+            print(f"  {endpoint:<32} calls={calls:<5} mean={mean_ms:8.1f}ms  [{spread}]")
+
+
+class FHIRClient:
+    """
+    Keep-alive FHIR REST client. One requests.Session with a sized
+    connection pool is reused for every call, so repeated requests skip the
+    TCP/auth handshake; it is safe to share across worker threads.
+    """
+    def __init__(self, base_url: str = FHIR_BASE_URL, auth: tuple = FHIR_AUTH,
+                 pool_size: int = DEFAULT_POOL_SIZE, timeout: float = DEFAULT_TIMEOUT):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+        self.latency = LatencyHistogram()
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers.update(FHIR_HEADERS)
+        self.session.auth = auth
+
+    def url(self, path: str) -> str:
+        if path.startswith("http://") or path.startswith("https://"):
+            return path
+        return f"{self.base_url}/{path.lstrip('/')}"
+
+    def get_json(self, path: str, params: dict = None) -> dict:
+        url = self.url(path)
+        started = time.perf_counter()
+        response = self.session.get(url, params=params, timeout=self.timeout)
+        response.raise_for_status()
+        body = response.json()
+        self.latency.record(endpoint_name(self.base_url, url), time.perf_counter() - started)
+        return body
+
+    def iter_pages(self, path: str, params: dict = None, prefetch: bool = True):
+        """
+        Yields every page of a searchset Bundle by following link[relation=next].
+        With prefetch on, the next page is requested on a background thread as
+        soon as its link is known, so it downloads while the caller works
+        through the current page. Pages are chained by their next links, so at
+        most one page can be fetched ahead.
+        """
+        url = self.url(path)
+        if not prefetch:
+            while url:
+                page = self.get_json(url, params)
+                params = None  # next links already carry the query
+                yield page
+                url = bundle_next_url(page)
+            return
+
+        with ThreadPoolExecutor(max_workers=1) as pool:
+            future = pool.submit(self.get_json, url, params)
+            while future is not None:
+                page = future.result()
+                next_url = bundle_next_url(page)
+                future = pool.submit(self.get_json, next_url) if next_url else None
+                yield page
+
+    def iter_resources(self, path: str, count: int = None, prefetch: bool = True):
+        """
+        Yields Bundle.entry.resource across all pages of a search. `count` is
+        sent as _count to tune the page size.
+        """
+        params = {"_count": count} if count else None
+        for page in self.iter_pages(path, params, prefetch):
+            for entry in page.get("entry", []):
+                if "resource" in entry:
+                    yield entry["resource"]
+
+    def stream_resources(self, path: str, count: int = None):
+        """
+        Like iter_resources, but each page body is parsed incrementally from
+        the (gzip-decoded) socket stream, so memory stays bounded regardless
+        of page size.
+        """
+        url = self.url(path)
+        params = {"_count": count} if count else None
+        while url:
+            links = []
+            started = time.perf_counter()
+            with self.session.get(url, params=params, stream=True, timeout=self.timeout) as response:
+                response.raise_for_status()
+                # Let urllib3 undo gzip/deflate while ijson reads the raw stream
+                response.raw.decode_content = True
+                yield from iter_bundle_resources(response.raw, links)
+            self.latency.record(endpoint_name(self.base_url, url), time.perf_counter() - started)
+            url = next_link(links)
+            params = None
+
+    def close(self) -> None:
+        self.session.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class AsyncFHIRClient:
+    """
+    asyncio counterpart of FHIRClient built on httpx, for keeping many
+    requests (e.g. hundreds of Patient/{id}/$everything) in flight at once
+    over a shared keep-alive pool.
+    """
+    def __init__(self, base_url: str = FHIR_BASE_URL, auth: tuple = FHIR_AUTH,
+                 pool_size: int = DEFAULT_POOL_SIZE, timeout: float = DEFAULT_TIMEOUT):
+        self.base_url = base_url.rstrip("/")
+        self.latency = LatencyHistogram()
+        self.client = httpx.AsyncClient(
+            auth=auth,
+            headers=FHIR_HEADERS,
+            timeout=timeout,
+            limits=httpx.Limits(max_connections=pool_size, max_keepalive_connections=pool_size),
+        )
+
+    def url(self, path: str) -> str:
+        if path.startswith("http://") or path.startswith("https://"):
+            return path
+        return f"{self.base_url}/{path.lstrip('/')}"
+
+    async def get_json(self, path: str, params: dict = None) -> dict:
+        url = self.url(path)
+        started = time.perf_counter()
+        response = await self.client.get(url, params=params)
+        response.raise_for_status()
+        body = response.json()
+        self.latency.record(endpoint_name(self.base_url, url), time.perf_counter() - started)
+        return body
+
+    async def iter_resources(self, path: str, count: int = None):
+        """
+        Async generator over Bundle.entry.resource across all pages.
+        """
+        url = self.url(path)
+        params = {"_count": count} if count else None
+        while url:
+            page = await self.get_json(url, params)
+            params = None
+            for entry in page.get("entry", []):
+                if "resource" in entry:
+                    yield entry["resource"]
+            url = bundle_next_url(page)
+
+    async def get_everything(self, fhir_id: str, count: int = None) -> list:
+        return [res async for res in self.iter_resources(f"Patient/{fhir_id}/$everything", count)]
+
+    async def get_everything_many(self, fhir_ids: list, concurrency: int = DEFAULT_POOL_SIZE,
+                                  count: int = None) -> dict:
+        """
+        Fetches $everything for many patients with at most `concurrency`
+        requests in flight. Returns {fhir_id: resources}; a failed patient
+        maps to the exception it raised.
+        """
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def one(fhir_id):
+            async with semaphore:
+                try:
+                    return fhir_id, await self.get_everything(fhir_id, count)
+                except Exception as e:
+                    return fhir_id, e
+
+        return dict(await asyncio.gather(*(one(fhir_id) for fhir_id in fhir_ids)))
+
+    async def aclose(self) -> None:
+        await self.client.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
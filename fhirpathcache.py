@@ -0,0 +1,32 @@
+from functools import lru_cache
+import fhirpathpy
+
+# Maximum number of distinct compiled expressions kept in memory
+CACHE_SIZE = 256
+
+# Parameterized expression for selecting resources of one type; bind the
+# type through the context, e.g. evaluate(bundle, RESOURCE_TYPE_FILTER, {"rtype": "Condition"})
+RESOURCE_TYPE_FILTER = "where(resourceType = %rtype)"
+
+
+@lru_cache(maxsize=CACHE_SIZE)
+def compile_expression(expression: str):
+    """
+    Parses a FHIRPath expression once and returns the compiled callable.
+    Values that vary per call belong in %variables bound at evaluation
+    time, so one compiled entry serves every parameter value.
+    """
+    return fhirpathpy.compile(expression)
+
+
+def evaluate(resource, expression: str, context: dict = None) -> list:
+    """
+    Drop-in replacement for fhirpathpy.evaluate that reuses compiled
+    expressions from the LRU cache.
+    """
+    return compile_expression(expression)(resource, context or {})
+
+
+def cache_stats() -> dict:
+    info = compile_expression.cache_info()
+    return {"hits": info.hits, "misses": info.misses, "size": info.currsize, "maxsize": info.maxsize}
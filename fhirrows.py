@@ -0,0 +1,133 @@
+import hashlib
+import tokenutils
+from vectorcodec import encode_vectors
+
+# Turning FHIR resources into vector-table rows. Only tokenizer and NumPy
+# dependencies, so process-pool workers (bulkloader) can import it without
+# the embedding model, IRIS driver or FHIR client.
+
+EMBED_MODEL = "nomic-ai/nomic-embed-text-v1.5"
+DEFAULT_BATCH_SIZE = 32
+MAX_TEXT_BYTES = 4000
+
+RESOURCE_TYPES = [
+    "Patient", "Condition", "MedicationRequest", "Observation", "Encounter",
+    "Practitioner", "Procedure", "AllergyIntolerance", "Immunization",
+    "DiagnosticReport", "DocumentReference", "CarePlan"
+]
+
+
+def truncate_to_tokens(text: str, max_tokens: int = 1500) -> str:
+    if not isinstance(text, str):
+        raise TypeError(f"Expected a string, but got {type(text).__name__}: {text}")
+    return tokenutils.truncate_to_tokens(text, max_tokens)
+
+
+def flatten_fhir_resource(resource: dict) -> str:
+    def recurse(obj, prefix=""):
+        lines = []
+        if isinstance(obj, dict):
+            for k, v in obj.items():
+                lines.extend(recurse(v, prefix + k.capitalize() + ": "))
+        elif isinstance(obj, list):
+            for item in obj:
+                lines.extend(recurse(item, prefix))
+        else:
+            lines.append(f"{prefix}{str(obj)}")
+        return lines
+    return "\n".join(recurse(resource))
+
+
+def prepare_text(text) -> str:
+    # Ensure text is UTF-8, max 4000 bytes to fit the resourcetext column
+    if not isinstance(text, str):
+        text = str(text)
+    text_bytes = text.encode('utf-8', errors='ignore')
+    return text_bytes[:MAX_TEXT_BYTES].decode('utf-8', errors='ignore')
+
+
+def content_hash(last_name: str, first_name: str, text: str) -> str:
+    """
+    Fingerprint of everything that ends up in a vector row besides the ids:
+    the embedding model, the patient name columns and the embedded text.
+    """
+    payload = "\0".join([EMBED_MODEL, last_name or "", first_name or "", text])
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def resource_version(resource: dict) -> tuple:
+    meta = resource.get("meta") or {}
+    return meta.get("versionId"), meta.get("lastUpdated")
+
+
+class BundleError(ValueError):
+    """
+    A patient bundle that cannot be indexed as a whole (no Patient resource,
+    or more than one).
+    """
+
+
+def iter_bundle_rows(resources, patient_id: str = None, seen: set = None):
+    """
+    Single pass over a single-patient bundle's resources (a list or a
+    streaming generator). Yields rows [patient_id, last, first, rtype, rid,
+    text, content_hash, version_id, last_updated] for the RESOURCE_TYPES
+    resources; patient_id defaults to the id of the bundle's Patient
+    resource. Resources seen before the Patient are held back until its name
+    is known.
+
+    Every RESOURCE_TYPES resource's (resourceType, id) goes into `seen`
+    before it is flattened, so resources that fail to flatten or have blank
+    text still count as present. Raises BundleError if the bundle has no
+    Patient or more than one, after which `seen` is incomplete.
+    """
+    wanted = set(RESOURCE_TYPES)
+    patient = None
+    held = []
+    for res in resources:
+        rtype = res.get('resourceType')
+        if rtype not in wanted:
+            continue
+        if seen is not None:
+            seen.add((rtype, res.get('id')))
+        if rtype == "Patient":
+            if patient is not None:
+                raise BundleError(f"Found more than one patient resource for {patient_id}, vector creation terminated")
+            patient = res
+            patient_id = patient_id or res['id']
+            name = res['name'][0]
+            firstName = name['given'][0] if name['given'] else ""
+            lastName = name['family'] if name['family'] else ""
+        if patient is None:
+            held.append(res)
+            continue
+        for pending in held + [res]:
+            try:
+                text = prepare_text(truncate_to_tokens(flatten_fhir_resource(pending)))
+                if text.strip():
+                    yield [patient_id, lastName, firstName, pending['resourceType'], pending['id'], text,
+                           content_hash(lastName, firstName, text), *resource_version(pending)]
+            except Exception as e:
+                print(f"❌ Skipping invalid resource {pending.get('resourceType')}/{pending.get('id')}: {e}")
+        held = []
+    if patient is None:
+        raise BundleError(f"Can not find the patient resource for {patient_id}, vector creation terminated")
+
+
+def bundle_to_rows(resources, patient_id: str = None) -> list:
+    return list(iter_bundle_rows(resources, patient_id))
+
+
+def embed_rows(model, rows: list, batch_size: int = DEFAULT_BATCH_SIZE) -> list:
+    """
+    Embeds rows from bundle_to_rows() in one encode() call and returns
+    insert rows matching INSERT_SQL.
+    """
+    embeddings = model.encode([row[5] for row in rows], batch_size=batch_size)
+    return [row[:5] + [embedding] + row[5:]
+            for row, embedding in zip(rows, encode_vectors(embeddings))]
+
+
+def print_throughput(label: str, count: int, seconds: float) -> None:
+    rate = count / seconds if seconds > 0 else 0.0
+    print(f"⏱️  {label}: {count} resources in {seconds:.2f}s ({rate:.1f} resources/sec)")
@@ -0,0 +1,56 @@
+import ijson
+
+# ijson prefixes for Bundle.entry[].resource and Bundle.link[]
+ENTRY_RESOURCE_PREFIX = "entry.item.resource"
+LINK_PREFIX = "link.item"
+
+
+def iter_bundle_resources(fp, links: list = None):
+    """
+    Incrementally parses a FHIR Bundle from a binary file-like object and
+    yields each entry's resource as a dict, one at a time, so peak memory is
+    bounded by the largest single resource rather than the whole bundle.
+
+    If `links` is given, the Bundle's (relation, url) link pairs are appended
+    to it as they are parsed, so callers can follow paging links.
+    """
+    if links is None:
+        yield from ijson.items(fp, ENTRY_RESOURCE_PREFIX, use_float=True)
+        return
+
+    builder = None
+    relation = url = None
+    for prefix, event, value in ijson.parse(fp, use_float=True):
+        if builder is not None:
+            builder.event(event, value)
+            if prefix == ENTRY_RESOURCE_PREFIX and event == "end_map":
+                yield builder.value
+                builder = None
+        elif prefix == ENTRY_RESOURCE_PREFIX and event == "start_map":
+            builder = ijson.ObjectBuilder()
+            builder.event(event, value)
+        elif prefix == LINK_PREFIX + ".relation":
+            relation = value
+        elif prefix == LINK_PREFIX + ".url":
+            url = value
+        elif prefix == LINK_PREFIX and event == "end_map":
+            links.append((relation, url))
+            relation = url = None
+
+
+def next_link(links: list):
+    """
+    Returns the url of the relation="next" link, or None on the last page.
+    """
+    for relation, url in links:
+        if relation == "next":
+            return url
+    return None
+
+
+def iter_bundle_file(path: str):
+    """
+    Streams the resources of a Bundle stored on disk.
+    """
+    with open(path, "rb") as fp:
+        yield from iter_bundle_resources(fp)
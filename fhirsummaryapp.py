@@ -3,24 +3,33 @@ from textual.app import App, ComposeResult
 from textual.containers import VerticalScroll
 from textual.widgets import Header, Footer, Markdown, ProgressBar
 from textual.worker import get_current_worker
-import lmstudio as lms
+from tokenutils import truncate_to_tokens
 import json, decimal
 import sys
-import tiktoken
 import asyncio
-from fhirpathpy import evaluate as fhirpath
+from fhirpathcache import evaluate as fhirpath, RESOURCE_TYPE_FILTER
 from getSearchPatients import get_everything_for_patient
+from bundleindex import BundleIndex
+from summarysupport import SummaryScheduler, SUMMARY_CONCURRENCY
+from llmstream import MarkdownStream
+from summarycache import shared_summary_cache
+from llmbackend import get_backend
+
+# Summary cache keys; bump the version when a prompt's meaning changes
+SECTION_TEMPLATE = "summaryapp-section/v1"
+FINAL_TEMPLATE = "summaryapp-final/v1"
 
 RESOURCE_TYPES = ["Patient", "Condition", "MedicationRequest", "Observation", "Encounter", "Practitioner"]
 
 class FHIRSummaryApp(App):
     BINDINGS = [('d', 'toggle_dark', 'Toggle dark mode')]
 
-    def __init__(self, ptFHIRid, **kwargs):
+    def __init__(self, ptFHIRid, concurrency: int = SUMMARY_CONCURRENCY, backend: str = None, **kwargs):
         super().__init__(**kwargs)
         self.fhirId = ptFHIRid
-        self.client = lms.Client()
-        self.model = self.client.llm.model("llama-3.2-3b-instruct")
+        self.scheduler = SummaryScheduler(concurrency)
+        self.llm = get_backend(backend, preferred={"lmstudio": "llama-3.2-3b-instruct"}, concurrency=concurrency)
+        self.summary_cache = shared_summary_cache()
         self.final_summaries: Dict[str, str] = {}
         self.final_summary_text: str = ""
 
@@ -41,29 +50,45 @@ class FHIRSummaryApp(App):
 
     async def process_summaries(self) -> None:
         bundle = self.get_patient_bundle(self.fhirId)
+        index = BundleIndex(bundle)
+
+        def show_summary(rtype: str, summary_text: str) -> None:
+            self.final_summaries[rtype] = summary_text
+            self.query_one(f"#{rtype}-summary", Markdown).update(f"### {rtype} Summary\n{summary_text}")
+            self.progress.advance(1)
+
+        jobs = []
         for rtype in RESOURCE_TYPES:
-            resources = self.extract_resources(bundle, rtype)
+            resources = index.of_type(rtype)
             if not resources:
-                summary_text = f"_No {rtype} resources found._"
+                show_summary(rtype, f"_No {rtype} resources found._")
             else:
                 json_text = json.dumps(resources, indent=2, default=self.make_json_safe)
                 chunked = self.truncate_to_tokens(json_text, max_tokens=1500)
-                summary_text = await asyncio.to_thread(self.summarize_resource_type, chunked, rtype)
-            self.final_summaries[rtype] = summary_text
-            self.query_one(f"#{rtype}-summary", Markdown).update(f"### {rtype} Summary\n{summary_text}")
-            self.progress.advance(1)
-            await asyncio.sleep(0.1)
+                stream = self.new_stream(f"#{rtype}-summary", f"### {rtype} Summary\n")
+                jobs.append((rtype, self.summarize_resource_type, chunked, rtype, stream))
+
+        # Section summaries are independent, so run them concurrently
+        await self.scheduler.run(jobs, show_summary)
+        # Keep the final prompt in RESOURCE_TYPES order whatever order the calls finished in
+        self.final_summaries = {rtype: self.final_summaries[rtype] for rtype in RESOURCE_TYPES}
 
         # Generate a final summary from all individual summaries
         summary_texts = "\n\n".join(
             f"{rtype}:\n{summary}" for rtype, summary in self.final_summaries.items() if "No" not in summary
         )
         truncated = self.truncate_to_tokens(summary_texts, max_tokens=1500)
-        self.final_summary_text = await asyncio.to_thread(self.summarize_final_summary, truncated)
-        self.query_one("#final-summary", Markdown).update(self.final_summary_text)
+        final_stream = self.new_stream("#final-summary", "## Final Patient Summary\n")
+        self.final_summary_text = await self.scheduler.run_final(
+            self.summarize_final_summary, truncated, final_stream)
+        final_stream.finish(f"{self.final_summary_text}\n\n_⏱️ {self.scheduler.report()}_\n\n"
+                            f"_⏱️ {self.llm.stats.summary()}; {self.summary_cache.summary()}_")
         self.progress.advance(1)
 
-    def summarize_final_summary(self, text: str) -> str:
+    def new_stream(self, widget_id: str, header: str) -> MarkdownStream:
+        return MarkdownStream(self, self.query_one(widget_id, Markdown), header=header)
+
+    def summarize_final_summary(self, text: str, stream: MarkdownStream) -> str:
         prompt = (
             "You are a clinical summarization AI.\n"
             "Using the following individual FHIR resource summaries, produce a concise overall summary of the patient's status in 1–2 paragraphs.\n"
@@ -71,19 +96,19 @@ class FHIRSummaryApp(App):
             f"{text}\n\nFinal Summary:"
         )
         print("🔄 Summarizing final patient summary...")
-        return self.model.complete(prompt).content
+        return self.summary_cache.complete(self.llm, prompt, FINAL_TEMPLATE, self.fhirId, stream)
 
     def extract_resources(self, bundle: list, resource_type: str) -> list:
-        return fhirpath(bundle, f"where(resourceType = '{resource_type}')")
+        return fhirpath(bundle, RESOURCE_TYPE_FILTER, {"rtype": resource_type})
 
-    def summarize_resource_type(self, text: str, rtype: str) -> str:
+    def summarize_resource_type(self, text: str, rtype: str, stream: MarkdownStream) -> str:
         prompt = (
             f"You are a clinical summarization AI.\n"
             f"Summarize the key information from the following FHIR {rtype} resources.\n"
             f"Be concise and clear. Do not explain your reasoning.\n\nFHIR {rtype} Data:\n{text}\n\nSummary:"
         )
         print(f"Summarizing {rtype}...")
-        return self.model.complete(prompt).content
+        return self.summary_cache.complete(self.llm, prompt, SECTION_TEMPLATE, self.fhirId, stream)
 
     def get_patient_bundle(self, patfhirid: str) -> list:
         return get_everything_for_patient(patfhirid)
@@ -92,9 +117,7 @@ class FHIRSummaryApp(App):
         return get_everything_for_patient(patfhirid)
 
     def truncate_to_tokens(self, text: str, max_tokens: int = 1500) -> str:
-        enc = tiktoken.encoding_for_model("gpt-3.5-turbo")
-        tokens = enc.encode(text)
-        return enc.decode(tokens[:max_tokens])
+        return truncate_to_tokens(text, max_tokens)
 
     def make_json_safe(self, obj):
         if isinstance(obj, decimal.Decimal):
@@ -0,0 +1,261 @@
+import os
+import json
+import time
+import argparse
+from datetime import datetime, timedelta, timezone
+from getSearchPatients import search_patients_get_ids, fhir_client
+from fhirvectorflattened import (
+    DEFAULT_BATCH_SIZE, RESOURCE_TYPES, FHIRVectorEngine
+)
+from summarycache import SummaryCache, shared_summary_cache
+
+STATE_PATH = "fhirsync_state.json"
+DEFAULT_INTERVAL = 60
+# Only the fields needed to map a changed resource back to its patient
+CHANGE_ELEMENTS = "id,meta,subject,patient"
+# Clock-skew margin applied when the high-water mark comes from this host's clock
+CLOCK_SKEW = timedelta(minutes=5)
+
+
+def parse_instant(value: str) -> datetime:
+    """
+    Parses a FHIR instant/dateTime ("2024-05-01T12:00:00.123Z") as an aware
+    datetime; values without an offset are taken as UTC.
+    """
+    parsed = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+def format_instant(value: datetime) -> str:
+    return value.astimezone(timezone.utc).isoformat(timespec="milliseconds").replace("+00:00", "Z")
+
+
+def patient_for(resource: dict):
+    """
+    Returns the id of the patient a changed resource belongs to, or None
+    for resources (e.g. Practitioner) that are not tied to one patient.
+    """
+    if resource.get("resourceType") == "Patient":
+        return resource.get("id")
+    for field in ("subject", "patient"):
+        reference = (resource.get(field) or {}).get("reference", "")
+        if "Patient/" in reference:
+            return reference.rsplit("Patient/", 1)[1].split("/", 1)[0]
+    return None
+
+
+def version_key(resource: dict) -> str:
+    meta = resource.get("meta") or {}
+    return f"{resource.get('resourceType')}/{resource.get('id')}/{meta.get('versionId', '')}"
+
+
+class SyncState:
+    """
+    High-water mark persisted as JSON: the largest meta.lastUpdated already
+    seen and the resource versions already handled at exactly that instant,
+    plus the patients whose re-index failed and are retried on the next
+    cycle. Written atomically so a crash mid-write keeps the old state.
+    """
+    def __init__(self, path: str = STATE_PATH):
+        self.path = path
+        self.high_water_mark = None
+        self.last_sync = None
+        self.retry = []
+        self.at_mark = []
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                saved = json.load(f)
+            self.high_water_mark = saved.get("high_water_mark")
+            self.last_sync = saved.get("last_sync")
+            self.retry = saved.get("retry", [])
+            self.at_mark = saved.get("at_mark", [])
+
+    def save(self) -> None:
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"high_water_mark": self.high_water_mark, "last_sync": self.last_sync,
+                       "retry": self.retry, "at_mark": self.at_mark}, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+
+class FHIRSync:
+    """
+    Keeps the vector table current by polling the FHIR server for resources
+    with _lastUpdated at or after the high-water mark, mapping them to their
+    patients and re-indexing only those patients. Re-indexing goes through
+    the engine's incremental path, so within a touched patient only
+    resources whose content hash changed are re-embedded. Cached LLM
+    summaries of touched patients are dropped from `summary_cache`.
+
+    The poll is inclusive (ge), so a resource committed later with the same
+    lastUpdated as the mark is not missed; versions already handled at the
+    mark instant are skipped so they do not re-touch their patients.
+
+    Patients whose re-index failed (fetch, embed or write errors) are kept
+    in the state and re-indexed again on every cycle until they succeed,
+    so the mark can move on without losing them.
+
+    Deletions are not seen: a deleted resource no longer matches a
+    _lastUpdated search. Its row goes away the next time its patient is
+    re-indexed for some other change, or on a full fhirvectorflattened run;
+    a deleted patient keeps its rows until then.
+    """
+    def __init__(self, engine: FHIRVectorEngine, state: SyncState,
+                 interval: float = DEFAULT_INTERVAL, workers: int = 0,
+                 summary_cache: SummaryCache = None):
+        self.engine = engine
+        self.state = state
+        self.interval = interval
+        self.workers = workers
+        self.summary_cache = summary_cache
+        self.cycles = 0
+
+    def changed_resources(self, since: str):
+        for rtype in RESOURCE_TYPES:
+            params = {"_lastUpdated": f"ge{since}", "_elements": CHANGE_ELEMENTS}
+            for page in fhir_client.iter_pages(rtype, params):
+                for entry in page.get("entry", []):
+                    if "resource" in entry:
+                        yield entry["resource"]
+
+    def reindex(self, patient_ids: list) -> tuple:
+        """
+        Re-indexes `patient_ids`; returns (rows upserted, sorted ids of the
+        patients that failed).
+        """
+        before = self.engine.inserted
+        self.engine.failed.difference_update(patient_ids)
+        if self.workers > 0:
+            self.engine.ingest_pipelined(patient_ids, workers=self.workers)
+        else:
+            self.engine.ingest(patient_ids)
+        return self.engine.inserted - before, sorted(self.engine.failed.intersection(patient_ids))
+
+    def initial_sync(self) -> None:
+        # No mark yet: index everyone, and take the mark from before the scan
+        # (less a skew margin) so changes made during it are picked up next poll
+        started = datetime.now(timezone.utc) - CLOCK_SKEW
+        print("ℹ️  No high-water mark, running a full index of every patient")
+        _, failed = self.reindex(search_patients_get_ids(''))
+        if failed:
+            print(f"❌ {len(failed)} patients failed to index, retrying next cycle: {', '.join(failed)}")
+        self.state.retry = failed
+        self.state.high_water_mark = format_instant(started)
+        self.state.at_mark = []
+        self.state.last_sync = format_instant(datetime.now(timezone.utc))
+        self.state.save()
+
+    def poll_once(self) -> dict:
+        """
+        Runs one sync cycle and returns its metrics. The mark only moves
+        forward after the touched patients were re-indexed, with the ones
+        that failed saved for retry, and it is taken from the server's own
+        lastUpdated values, so server/client clock differences cannot skip
+        changes.
+        """
+        if self.state.high_water_mark is None:
+            self.initial_sync()
+            return {}
+
+        poll_started = datetime.now(timezone.utc)
+        since = self.state.high_water_mark
+        touched = set()
+        # The server's own lastUpdated string becomes the next mark verbatim,
+        # so reformatting cannot round it below a change already indexed
+        newest, newest_mark = parse_instant(since), since
+        oldest = None
+        changes = 0
+        handled = set(self.state.at_mark)
+        at_newest = set(handled)
+        for res in self.changed_resources(since):
+            updated = (res.get("meta") or {}).get("lastUpdated")
+            key = version_key(res)
+            if updated:
+                updated_at = parse_instant(updated)
+                if updated_at == newest and key in handled:
+                    continue
+                if updated_at > newest:
+                    newest, newest_mark = updated_at, updated
+                    at_newest = set()
+                if updated_at == newest:
+                    at_newest.add(key)
+                oldest = updated_at if oldest is None else min(oldest, updated_at)
+            changes += 1
+            patient_id = patient_for(res)
+            if patient_id:
+                touched.add(patient_id)
+
+        retried = set(self.state.retry) - touched
+        touched |= retried
+        upserted, failed = self.reindex(sorted(touched)) if touched else (0, [])
+        if failed:
+            print(f"❌ {len(failed)} patients failed to re-index, retrying next cycle: {', '.join(failed)}")
+        if self.summary_cache is not None:
+            for patient_id in touched:
+                self.summary_cache.invalidate_patient(patient_id)
+        finished = datetime.now(timezone.utc)
+        self.state.high_water_mark = newest_mark
+        self.state.at_mark = sorted(at_newest)
+        self.state.retry = failed
+        self.state.last_sync = format_instant(finished)
+        self.state.save()
+        self.cycles += 1
+
+        metrics = {
+            "changes": changes,
+            "patients": len(touched),
+            "upserted": upserted,
+            "retried": len(retried),
+            "failed": len(failed),
+            "poll_seconds": (finished - poll_started).total_seconds(),
+            # oldest change picked up this cycle -> now: worst-case staleness of the index
+            "max_lag_seconds": (finished - oldest).total_seconds() if oldest else 0.0,
+            # how far the mark trails the wall clock (grows while idle, by design)
+            "mark_age_seconds": (finished - newest).total_seconds(),
+        }
+        print(f"🔄 Sync cycle {self.cycles}: {changes} changed resources, {len(touched)} patients, "
+              f"{upserted} upserted ({len(retried)} retried, {len(failed)} failed) in {metrics['poll_seconds']:.1f}s; "
+              f"max lag {metrics['max_lag_seconds']:.1f}s; high-water mark {self.state.high_water_mark}")
+        return metrics
+
+    def run(self, cycles: int = None) -> None:
+        """
+        Polls every `interval` seconds (measured from the start of each
+        cycle) until interrupted or `cycles` have run. A failed cycle is
+        reported and retried on the next tick with the mark unchanged.
+        """
+        ran = 0
+        while cycles is None or ran < cycles:
+            started = time.monotonic()
+            try:
+                self.poll_once()
+            except Exception as e:
+                print(f"❌ Sync cycle failed, will retry from {self.state.high_water_mark}: {e}")
+            ran += 1
+            if cycles is not None and ran >= cycles:
+                break
+            time.sleep(max(0.0, self.interval - (time.monotonic() - started)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Keep the IRIS vector table in sync with FHIR changes")
+    parser.add_argument("--interval", type=float, default=DEFAULT_INTERVAL, help="seconds between polls")
+    parser.add_argument("--state", default=STATE_PATH, help="file holding the high-water mark")
+    parser.add_argument("--since", help="override the high-water mark (FHIR instant)")
+    parser.add_argument("--once", action="store_true", help="run a single sync cycle and exit")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE)
+    parser.add_argument("--workers", type=int, default=0,
+                        help="fetch/flatten threads for re-indexing (0 = sequential)")
+    args = parser.parse_args()
+
+    state = SyncState(args.state)
+    if args.since:
+        state.high_water_mark = format_instant(parse_instant(args.since))
+    engine = FHIRVectorEngine(batch_size=args.batch_size, incremental=True)
+    sync = FHIRSync(engine, state, interval=args.interval, workers=args.workers,
+                    summary_cache=shared_summary_cache())
+    try:
+        sync.run(cycles=1 if args.once else None)
+    except KeyboardInterrupt:
+        print(f"Stopped; high-water mark {state.high_water_mark}")
+    fhir_client.latency.report()
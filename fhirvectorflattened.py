@@ -1,121 +1,422 @@
-from fhir.resources.bundle import Bundle
-from fhir.resources.patient import Patient
-import os
 import iris
-import json
-import tiktoken
-from typing import List, Dict
-import lmstudio as lms
-import decimal
-import sys
-import asyncio
-from fhirpathpy import evaluate as fhirpath
-from getSearchPatients import get_everything_for_patient, search_patients_get_ids
+from typing import Dict
+import time
+import queue
+import threading
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from fhirpathcache import cache_stats
+from getSearchPatients import get_everything_for_patient, iter_everything_for_patient, search_patients_get_ids, fhir_client
 from sentence_transformers import SentenceTransformer
+from bundleindex import BundleIndex
+from vectorcodec import encode_vector, encode_vectors
+from vectorschema import INGEST_VECTOR_PARAM, ensure_vector_table
+from fhirrows import (
+    EMBED_MODEL, DEFAULT_BATCH_SIZE, RESOURCE_TYPES, BundleError,
+    truncate_to_tokens, flatten_fhir_resource, prepare_text, content_hash, resource_version,
+    iter_bundle_rows, embed_rows, print_throughput
+)
 
 VECTOR_TABLE = "PatientVectorsDemo"
+DEFAULT_QUEUE_SIZE = 8
 
-RESOURCE_TYPES = [
-    "Patient", "Condition", "MedicationRequest", "Observation", "Encounter",
-    "Practitioner", "Procedure", "AllergyIntolerance", "Immunization",
-    "DiagnosticReport", "DocumentReference", "CarePlan"
-]
+INSERT_SQL = f"""
+     INSERT INTO {VECTOR_TABLE} (patient_id, patient_lastname, patient_firstname, resource_type, resource_id, embedding, resourcetext, content_hash, version_id, last_updated) VALUES (?, ?, ?, ?, ?, {INGEST_VECTOR_PARAM}, ?, ?, ?, ?)
+     """
+DELETE_RESOURCE_SQL = f"""
+     DELETE FROM {VECTOR_TABLE} WHERE patient_id = ? AND resource_type = ? AND resource_id = ?
+     """
+INDEXED_STATE_SQL = f"""
+     SELECT resource_type, resource_id, content_hash FROM {VECTOR_TABLE} WHERE patient_id = ?
+     """
 
 
 class FHIRVectors:
-    def __init__(self):
-        patientIds = search_patients_get_ids('')
+    def __init__(self, batch_size: int = DEFAULT_BATCH_SIZE, workers: int = 0,
+                 queue_size: int = DEFAULT_QUEUE_SIZE, incremental: bool = True):
+        engine = FHIRVectorEngine(batch_size=batch_size, incremental=incremental)
+        with engine.timer.phase("fetch patient ids"):
+            patientIds = search_patients_get_ids('')
         print("Patient Ids in the FHIR Repository")
         print(patientIds)
         print("")
-        for patientId in patientIds:
-            FHIRVector(patientId)
+        if workers > 0:
+            engine.ingest_pipelined(patientIds, workers=workers, queue_size=queue_size)
+        else:
+            engine.ingest(patientIds)
         print("All patients in the repository processed")
+        fhir_client.latency.report()
+        print(f"FHIRPath expression cache: {cache_stats()}")
+
+
+def format_embedding(embedding) -> str:
+    return encode_vector(embedding)
+
+
+class PhaseTimer:
+    """
+    Accumulates wall-clock time per named ingestion phase so a run can
+    report where its time went (model load, fetch, embed, insert, ...).
+    """
+    def __init__(self):
+        self.totals: Dict[str, float] = {}
+        self.calls: Dict[str, int] = {}
+
+    @contextmanager
+    def phase(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.totals[name] = self.totals.get(name, 0.0) + time.perf_counter() - started
+            self.calls[name] = self.calls.get(name, 0) + 1
+
+    def report(self) -> None:
+        overall = sum(self.totals.values())
+        print("Phase timing breakdown:")
+        for name, seconds in self.totals.items():
+            share = 100.0 * seconds / overall if overall > 0 else 0.0
+            print(f"  {name:<24} {seconds:9.2f}s  {share:5.1f}%  ({self.calls[name]} calls)")
+        print(f"  {'total':<24} {overall:9.2f}s")
+
+
+class StageMetrics:
+    """
+    Per-stage counters for the pipelined ingest: time spent working, time
+    starved waiting on the input queue, time blocked on a full output queue
+    (backpressure) and the deepest the output queue got.
+    """
+    def __init__(self, name: str):
+        self.name = name
+        self.items = 0
+        self.busy = 0.0
+        self.starved = 0.0
+        self.blocked = 0.0
+        self.max_depth = 0
+        self.lock = threading.Lock()
+
+    def add(self, field: str, seconds: float) -> None:
+        with self.lock:
+            setattr(self, field, getattr(self, field) + seconds)
+
+    def get(self, q: queue.Queue):
+        started = time.perf_counter()
+        item = q.get()
+        self.add("starved", time.perf_counter() - started)
+        return item
+
+    def put(self, q: queue.Queue, item) -> None:
+        started = time.perf_counter()
+        q.put(item)
+        with self.lock:
+            self.blocked += time.perf_counter() - started
+            self.max_depth = max(self.max_depth, q.qsize())
+
+    def report(self) -> None:
+        print(f"  {self.name:<8} items={self.items:<6} busy={self.busy:8.2f}s "
+              f"starved={self.starved:8.2f}s blocked={self.blocked:8.2f}s max_queue={self.max_depth}")
+
+
+class FHIRVectorEngine:
+    """
+    Owns the embedding model, the IRIS connection and the vector table check,
+    so their startup cost is paid once per run instead of once per patient.
+
+    With incremental on (the default), each resource row carries a content
+    hash; resources whose hash matches the indexed row are not re-embedded,
+    changed ones replace their old row and resources no longer in the
+    patient's bundle are deleted. With it off every resource is re-embedded,
+    but rows are still replaced rather than duplicated.
+    """
+    def __init__(self, batch_size: int = DEFAULT_BATCH_SIZE, incremental: bool = True):
+        self.batch_size = batch_size
+        self.incremental = incremental
+        self.timer = PhaseTimer()
+        self.inserted = 0
+        self.unchanged = 0
+        self.removed = 0
+        # Patients with a resource that could not be fetched, embedded or
+        # written this run; their index may be stale (see fhirsync)
+        self.failed = set()
+        self.elapsed = 0.0
+        # The IRIS connection is shared by the fetch workers (state lookups,
+        # deletes) and the writer, so every use of it goes through this lock
+        self.db_lock = threading.Lock()
+        with self.timer.phase("startup: model load"):
+            self.model = SentenceTransformer(EMBED_MODEL, trust_remote_code=True)
+        with self.timer.phase("startup: connect"):
+            self.conn = self.get_connection()
+        with self.timer.phase("startup: schema check"):
+            self.ensure_patient_vectors_table(self.conn.cursor())
+
+    def get_connection(self):
+        return iris.connect("127.0.0.1", 1972, "DEMO", "_SYSTEM", "ISCDEMO")
+
+    def ensure_patient_vectors_table(self, cursor):
+        # Table, HNSW index, tracking columns and secondary indexes/unique key
+        ensure_vector_table(self.conn, VECTOR_TABLE)
+
+    def indexed_state(self, patient_id: str) -> dict:
+        """
+        Returns {(resource_type, resource_id): [content_hash, ...]} for the
+        rows currently indexed for a patient. More than one hash for a key
+        means duplicate rows from a pre-incremental run.
+        """
+        with self.db_lock:
+            cursor = self.conn.cursor()
+            cursor.execute(INDEXED_STATE_SQL, [patient_id])
+            rows = cursor.fetchall()
+        state = {}
+        for rtype, rid, digest in rows:
+            state.setdefault((rtype, rid), []).append(digest)
+        return state
+
+    def is_unchanged(self, state: dict, resource_type: str, resource_id: str, digest: str) -> bool:
+        return self.incremental and state.get((resource_type, resource_id)) == [digest]
+
+    def finish_patient(self, patient_id: str, state: dict, seen: set, unchanged: int) -> None:
+        """
+        Deletes the indexed resources that no longer appear in the patient's
+        bundle and records the refresh counts. Only call it once the bundle
+        was read in full; `seen` must hold every resource in it, including
+        those that failed to flatten. Nothing is deleted if `seen` is empty,
+        so a bad fetch cannot wipe a patient.
+        """
+        removed = [key for key in state if key not in seen] if seen else []
+        if removed:
+            self.delete_resources(patient_id, removed)
+        with self.db_lock:
+            self.unchanged += unchanged
+            self.removed += len(removed)
+
+    def filter_changed(self, patient_id: str, rows, seen: set):
+        """
+        Passes through only the rows that need embedding, then cleans up
+        resources removed from the patient's bundle once it has been read in
+        full. `seen` is filled by the iter_bundle_rows() producing `rows`;
+        if that raises (an aborted bundle, a failed fetch), the error
+        propagates and nothing is deleted.
+        """
+        state = self.indexed_state(patient_id)
+        unchanged = 0
+        for row in rows:
+            if self.is_unchanged(state, row[3], row[4], row[6]):
+                unchanged += 1
+                continue
+            yield row
+        self.finish_patient(patient_id, state, seen, unchanged)
+
+    def report_changes(self) -> None:
+        mode = "incremental" if self.incremental else "full"
+        print(f"Index refresh ({mode}): {self.inserted} upserted, "
+              f"{self.unchanged} unchanged, {self.removed} removed")
+
+    def delete_resources(self, patient_id: str, keys: list) -> None:
+        with self.db_lock:
+            cursor = self.conn.cursor()
+            cursor.executemany(DELETE_RESOURCE_SQL, [[patient_id, rtype, rid] for rtype, rid in keys])
+            self.conn.commit()
+        print(f"🗑️  Removed {len(keys)} resources no longer present for patient {patient_id}")
+
+    def write_rows(self, rows: list) -> int:
+        """
+        Upserts prepared rows: any existing rows for the same
+        (patient_id, resource_type, resource_id) are deleted and the new rows
+        inserted, with one executemany() each and one commit.
+        Returns the number of rows written.
+        """
+        keys = [row[:1] + row[3:5] for row in rows]
+        with self.db_lock:
+            cursor = self.conn.cursor()
+            try:
+                cursor.executemany(DELETE_RESOURCE_SQL, keys)
+                cursor.executemany(INSERT_SQL, rows)
+                self.conn.commit()
+                print(f"✅ Upserted batch of {len(rows)} resources")
+                return len(rows)
+            except Exception as e:
+                # Fall back to row-by-row so one bad resource does not drop the whole batch
+                print(f"❌ Batch upsert failed ({e}), retrying {len(rows)} rows individually")
+                self.conn.rollback()
+                written = 0
+                for key, row in zip(keys, rows):
+                    try:
+                        cursor.execute(DELETE_RESOURCE_SQL, key)
+                        cursor.execute(INSERT_SQL, row)
+                        self.conn.commit()
+                        written += 1
+                    except Exception as row_err:
+                        self.conn.rollback()
+                        self.failed.add(row[0])
+                        print(f"❌ Failed to upsert resource {row[3]}/{row[4]}: {row_err}")
+                        print(f"    Text preview: {row[6][:200]}")
+                return written
+
+    def prepare_patient(self, patient_id: str):
+        """
+        Streams one patient's $everything bundle and yields the flattened
+        rows that need (re-)embedding.
+        """
+        seen = set()
+        rows = iter_bundle_rows(iter_everything_for_patient(patient_id), patient_id, seen)
+        return self.filter_changed(patient_id, rows, seen)
+
+    def ingest_pipelined(self, patient_ids: list, workers: int = 4,
+                         queue_size: int = DEFAULT_QUEUE_SIZE) -> None:
+        """
+        Overlaps network fetch, flattening, embedding and IRIS writes:
+        a pool of `workers` threads fetches and flattens bundles, a single
+        embedding stage encodes batches, and a writer stage inserts them.
+        Bounded queues between the stages provide backpressure.
+        """
+        done = object()
+        to_embed = queue.Queue(maxsize=queue_size)
+        to_write = queue.Queue(maxsize=queue_size)
+        fetch_stats = StageMetrics("fetch")
+        embed_stats = StageMetrics("embed")
+        write_stats = StageMetrics("write")
+        started = time.perf_counter()
+
+        def fetch(patient_id):
+            try:
+                batch = []
+                work_started = time.perf_counter()
+                for row in self.prepare_patient(patient_id):
+                    batch.append(row)
+                    if len(batch) >= self.batch_size:
+                        fetch_stats.add("busy", time.perf_counter() - work_started)
+                        fetch_stats.put(to_embed, batch)
+                        batch = []
+                        work_started = time.perf_counter()
+                fetch_stats.add("busy", time.perf_counter() - work_started)
+                fetch_stats.add("items", 1)
+                if batch:
+                    fetch_stats.put(to_embed, batch)
+            except BundleError as e:
+                print(f"❌ {e}")
+            except Exception as e:
+                with self.db_lock:
+                    self.failed.add(patient_id)
+                print(f"❌ Failed to prepare patient {patient_id}: {e}")
+
+        def produce():
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                list(pool.map(fetch, patient_ids))
+            to_embed.put(done)
+
+        def embed():
+            while True:
+                batch = embed_stats.get(to_embed)
+                if batch is done:
+                    to_write.put(done)
+                    return
+                try:
+                    work_started = time.perf_counter()
+                    rows = embed_rows(self.model, batch, self.batch_size)
+                    embed_stats.add("busy", time.perf_counter() - work_started)
+                    embed_stats.add("items", len(rows))
+                    embed_stats.put(to_write, rows)
+                except Exception as e:
+                    with self.db_lock:
+                        self.failed.update(row[0] for row in batch)
+                    print(f"❌ Failed to embed batch of {len(batch)} resources: {e}")
+
+        def write():
+            while True:
+                rows = write_stats.get(to_write)
+                if rows is done:
+                    return
+                work_started = time.perf_counter()
+                try:
+                    written = self.write_rows(rows)
+                except Exception as e:
+                    # e.g. the rollback itself failing on a dropped connection;
+                    # keep draining so the upstream stages never block
+                    written = 0
+                    with self.db_lock:
+                        self.failed.update(row[0] for row in rows)
+                    print(f"❌ Failed to write batch of {len(rows)} resources: {e}")
+                write_stats.add("busy", time.perf_counter() - work_started)
+                write_stats.add("items", written)
+
+        threads = [threading.Thread(target=produce, name="fetch"),
+                   threading.Thread(target=embed, name="embed"),
+                   threading.Thread(target=write, name="write")]
+        with self.timer.phase("pipelined ingest"):
+            for t in threads:
+                t.start()
+            for t in threads:
+                t.join()
+
+        elapsed = time.perf_counter() - started
+        self.inserted += write_stats.items
+        self.elapsed += elapsed
+        print_throughput(f"repository ({workers} workers)", write_stats.items, elapsed)
+        print("Stage metrics (starved = waiting for input, blocked = waiting on a full queue):")
+        for stats in (fetch_stats, embed_stats, write_stats):
+            stats.report()
+        self.report_changes()
+        self.timer.report()
+
+    def ingest(self, patient_ids: list) -> None:
+        for patient_id in patient_ids:
+            try:
+                vector = FHIRVector(patient_id, engine=self)
+            except Exception as e:
+                self.failed.add(patient_id)
+                print(f"❌ Failed to index patient {patient_id}: {e}")
+                continue
+            self.inserted += vector.inserted
+            self.elapsed += vector.elapsed
+        print_throughput("repository", self.inserted, self.elapsed)
+        self.report_changes()
+        self.timer.report()
+
 
 class FHIRVector:
-    def __init__(self, ptFHIRid, **kwargs):
+    def __init__(self, ptFHIRid, batch_size: int = DEFAULT_BATCH_SIZE, engine: "FHIRVectorEngine" = None, **kwargs):
         super().__init__(**kwargs)
-        self.model = SentenceTransformer("nomic-ai/nomic-embed-text-v1.5", trust_remote_code=True)
-        self.conn = self.get_connection()
-        cursor = self.conn.cursor()
-        self.ensure_patient_vectors_table(cursor)
+        # A standalone FHIRVector still works; FHIRVectors shares one engine across patients
+        self.engine = engine if engine is not None else FHIRVectorEngine(batch_size=batch_size)
+        # batch_size <= 1 keeps the original one-row-per-commit behaviour
+        self.batch_size = self.engine.batch_size
+        self.timer = self.engine.timer
+        self.inserted = 0
+        self.elapsed = 0.0
+        self.model = self.engine.model
+        self.conn = self.engine.conn
         self.fhirId = ptFHIRid
         self.patientId = self.fhirId
         self.lastName = ''
         self.firstName = ''
         self.create_vectors()
 
-    def get_connection(self):
-        return iris.connect("127.0.0.1", 1972, "DEMO", "_SYSTEM", "ISCDEMO")
-
-    def ensure_patient_vectors_table(self, cursor):
-        cursor.execute(f"""
-            SELECT COUNT(*) 
-            FROM INFORMATION_SCHEMA.TABLES 
-            WHERE TABLE_NAME = '{VECTOR_TABLE}'
-        """)
-        (count,) = cursor.fetchone()
-
-        if count == 0:
-            cursor.execute(f"""
-                CREATE TABLE {VECTOR_TABLE} (
-                    patient_id VARCHAR(75),
-                    patient_lastname VARCHAR(75),
-                    patient_firstname VARCHAR(75),
-                    resource_type VARCHAR(50),
-                    resource_id VARCHAR(75),
-                    embedding VECTOR(DOUBLE, 768),
-                    resourcetext VARCHAR(4000)
-                )
-            """)
-            cursor.execute(f"""
-            CREATE INDEX vector_index
-            ON TABLE {VECTOR_TABLE} (embedding)
-            AS HNSW(Distance='Cosine')
-             """)
-            print(f"Table '{VECTOR_TABLE}' and HNSW index created.")
-        else:
-            print(f"Table '{VECTOR_TABLE}' already exists.")
-
     def get_patient_bundle(self, patfhirid: str) -> list:
         return get_everything_for_patient(patfhirid)
 
-    def extract_resources(self, bundle: list, resource_type: str) -> list:
-        return fhirpath(bundle, f"where(resourceType = '{resource_type}')")
-
     def truncate_to_tokens(self, text: str, max_tokens: int = 1500) -> str:
-        if not isinstance(text, str):
-            raise TypeError(f"Expected a string, but got {type(text).__name__}: {text}")
-        enc = tiktoken.encoding_for_model("gpt-3.5-turbo")
-        tokens = enc.encode(text)
-        return enc.decode(tokens[:max_tokens])
+        return truncate_to_tokens(text, max_tokens)
 
     def flatten_fhir_resource(self, resource: dict) -> str:
-        def recurse(obj, prefix=""):
-            lines = []
-            if isinstance(obj, dict):
-                for k, v in obj.items():
-                    lines.extend(recurse(v, prefix + k.capitalize() + ": "))
-            elif isinstance(obj, list):
-                for item in obj:
-                    lines.extend(recurse(item, prefix))
-            else:
-                lines.append(f"{prefix}{str(obj)}")
-            return lines
-        return "\n".join(recurse(resource))
-    
-    
+        return flatten_fhir_resource(resource)
+
+    def prepare_text(self, text) -> str:
+        return prepare_text(text)
+
+    def format_embedding(self, embedding) -> str:
+        return format_embedding(embedding)
+
+    def row_params(self, resource: dict, embedding_csv: str, text: str) -> list:
+        return [self.patientId, self.lastName, self.firstName,
+                resource['resourceType'], resource['id'], embedding_csv, text,
+                content_hash(self.lastName, self.firstName, text), *resource_version(resource)]
+
     def create_one_vector(self, resource, text):
       cursor = self.conn.cursor()
-      max_chars = 4000
 
       try:
-        # Ensure text is UTF-8, max 4000 characters
-        if not isinstance(text, str):
-            text = str(text)
-
-        text_bytes = text.encode('utf-8', errors='ignore')
-        text = text_bytes[:max_chars].decode('utf-8', errors='ignore')
+        text = self.prepare_text(text)
 
             # Skip blank or invalid text
         if not text.strip():
@@ -123,39 +424,60 @@ class FHIRVector:
             return
 
         # Generate embedding
-        embedding = self.model.encode(text).tolist()
-        embedding_strs = [f"{x:.8f}" for x in embedding]
-        embedding_csv = ",".join(embedding_strs)
-
-        # Escape strings for SQL
-        pid = self.patientId.replace("'", "''")
-        last = self.lastName.replace("'", "''")
-        first = self.firstName.replace("'", "''")
-        rtype = resource['resourceType'].replace("'", "''")
-        rid = resource['id'].replace("'", "''")
-        text_sql = text.replace("'", "''")
-        params = [pid, last, first, rtype, rid, embedding_csv, text_sql]
-
-        # Final SQL INSERT
-        sql = f"""
-             INSERT INTO {VECTOR_TABLE} (patient_id, patient_lastname, patient_firstname, resource_type, resource_id, embedding, resourcetext) VALUES (?, ?, ?, ?, ?, TO_VECTOR(?,FLOAT), ?)
-             """
-
-        cursor.execute(sql, params)
-        #print("DEBUG SQL PREVIEW:", sql)
-        self.conn.commit()
-        print(f"✅ Inserted {rtype}/{rid}")
+        with self.timer.phase("embed"):
+            embedding = self.model.encode(text)
+        embedding_csv = self.format_embedding(embedding)
+        params = self.row_params(resource, embedding_csv, text)
+
+        with self.timer.phase("insert"), self.engine.db_lock:
+            cursor.execute(DELETE_RESOURCE_SQL, [self.patientId, resource['resourceType'], resource['id']])
+            cursor.execute(INSERT_SQL, params)
+            self.conn.commit()
+        self.inserted += 1
+        print(f"✅ Upserted {resource['resourceType']}/{resource['id']}")
 
       except Exception as e:
+          self.engine.failed.add(self.patientId)
           print(f"❌ Failed to insert resource {resource.get('resourceType')}/{resource.get('id')}: {e}")
           print(f"    Text preview: {text[:200]}")
 
-    
+    def create_vector_batch(self, batch: list) -> None:
+        """
+        Embeds a batch of (resource, text) pairs with a single encode() call
+        and writes them with one executemany() and one commit.
+        """
+        items = []
+        for resource, text in batch:
+            text = self.prepare_text(text)
+            if not text.strip():
+                print(f"❌ Skipping insert of {resource.get('resourceType')}/{resource.get('id')}: text is empty.")
+                continue
+            items.append((resource, text))
+        if not items:
+            return
+
+        texts = [text for _, text in items]
+        try:
+            with self.timer.phase("embed"):
+                embeddings = self.model.encode(texts, batch_size=self.batch_size)
+        except Exception as e:
+            self.engine.failed.add(self.patientId)
+            print(f"❌ Failed to embed batch of {len(items)} resources for patient {self.patientId}: {e}")
+            return
+        rows = [self.row_params(resource, embedding, text)
+                for (resource, text), embedding in zip(items, encode_vectors(embeddings))]
+
+        with self.timer.phase("insert"):
+            self.inserted += self.engine.write_rows(rows)
 
     def create_vectors(self) -> None:
         counter = 0
-        bundle = self.get_patient_bundle(self.fhirId)
-        patientResources = self.extract_resources(bundle, "Patient")
+        started = time.perf_counter()
+        with self.timer.phase("fetch bundle"):
+            bundle = self.get_patient_bundle(self.fhirId)
+        with self.timer.phase("extract"):
+            index = BundleIndex(bundle)
+            patientResources = index.of_type("Patient")
         if not patientResources:
             print("Can not find the patient resource, vector creation terminated")
             return
@@ -168,25 +490,59 @@ class FHIRVector:
             self.firstName = name['given'][0] if name['given'] else ""
             self.lastName = name['family'] if name['family'] else ""
 
+        state = self.engine.indexed_state(self.patientId)
+        seen = set()
+        unchanged = 0
+        pending = []
         for rtype in RESOURCE_TYPES:
-            resources = self.extract_resources(bundle, rtype)
+            resources = index.of_type(rtype)
             if not resources:
                 print(f"_No {rtype} resources found._ for {self.patientId}")
             else:
                 for res in resources:
+                    # counted as present even if it fails to flatten below
+                    seen.add((rtype, res.get('id')))
                     try:
-                        flat_text = self.flatten_fhir_resource(res)
-                        flat_text.encode('utf-8')  # validate encoding
-                        chunked = self.truncate_to_tokens(flat_text)
-                        self.create_one_vector(res, chunked)
+                        with self.timer.phase("flatten"):
+                            flat_text = self.flatten_fhir_resource(res)
+                            flat_text.encode('utf-8')  # validate encoding
+                            chunked = self.truncate_to_tokens(flat_text)
+                        digest = content_hash(self.lastName, self.firstName, self.prepare_text(chunked))
+                        if self.engine.is_unchanged(state, rtype, res['id'], digest):
+                            unchanged += 1
+                            continue
+                        if self.batch_size > 1:
+                            pending.append((res, chunked))
+                            if len(pending) >= self.batch_size:
+                                self.create_vector_batch(pending)
+                                pending = []
+                        else:
+                            self.create_one_vector(res, chunked)
                         counter += 1
                         if counter % 10 == 0:
                             print(f"{counter} vectors processed.")
                     except Exception as e:
                         print(f"❌ Skipping invalid resource {res.get('resourceType')}/{res.get('id')}: {e}")
 
+        if pending:
+            self.create_vector_batch(pending)
+        self.engine.finish_patient(self.patientId, state, seen, unchanged)
+
+        self.elapsed = time.perf_counter() - started
         print(f"All vectors processed for patient with id = {self.patientId}")
+        print_throughput(f"patient {self.patientId}", self.inserted, self.elapsed)
         
 if __name__ == '__main__':
-    app = FHIRVectors()
+    parser = argparse.ArgumentParser(description="Embed every patient in the FHIR repository into IRIS")
+    parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE,
+                        help="resources per encode()/executemany() batch")
+    parser.add_argument("--workers", type=int, default=0,
+                        help="fetch/flatten threads for pipelined ingest (0 = sequential)")
+    parser.add_argument("--queue-size", type=int, default=DEFAULT_QUEUE_SIZE,
+                        help="batches buffered between pipeline stages")
+    parser.add_argument("--full", action="store_true",
+                        help="re-embed every resource instead of only changed ones")
+    args = parser.parse_args()
+    app = FHIRVectors(batch_size=args.batch_size, workers=args.workers, queue_size=args.queue_size,
+                      incremental=not args.full)
 
@@ -1,14 +1,43 @@
 import requests
 from pathlib import Path
 
-# fhirpathpy library
-from fhirpathpy import evaluate as fhirpath
+# fhirpathpy, with compiled expressions cached
+from fhirpathcache import evaluate as fhirpath
+
+# pooled FHIR REST client
+from fhirclient import FHIRClient, FHIR_BASE_URL
 
 # fhir.resources
 from fhir.resources.patient import Patient
 from fhir.resources.observation import Observation
 from fhir.resources.bundle import Bundle
 
+# One keep-alive session shared by every function in this module
+fhir_client = FHIRClient()
+
+
+def fetch_bundle_page(url: str, params: dict = None) -> dict:
+    """
+    Fetches a single Bundle page and returns it as a Python dictionary.
+    """
+    return fhir_client.get_json(url, params)
+
+
+def iter_bundle_pages(url: str, params: dict = None, prefetch: bool = True):
+    """
+    Yields every page of a searchset Bundle by following link[relation=next],
+    prefetching the next page while the current one is consumed.
+    """
+    return fhir_client.iter_pages(url, params, prefetch)
+
+
+def iter_search_resources(url: str, count: int = None, prefetch: bool = True):
+    """
+    Yields Bundle.entry.resource across all pages of a search. `count` is
+    sent as _count to tune the page size.
+    """
+    return fhir_client.iter_resources(url, count, prefetch)
+
 
 def get_patient_from_server(patient_id: str) -> Patient:
     """
@@ -16,51 +45,23 @@ def get_patient_from_server(patient_id: str) -> Patient:
     using a REST GET request and returns a Patient object.
     """
     # FHIR base URL for individual Patient read
-    url = f"http://127.0.0.1:8080/csp/healthshare/demo/fhir/r4/Patient/{patient_id}"
-    headers = {
-        "Accept": "*/*",
-        "Content-Type": "application/fhir+json",
-        "Accept-Encoding": "gzip, deflate, br",
-        "Prefer": "return=representation"
-    }
-
-    response = requests.get(url, headers=headers, auth=("_System", "ISCDEMO"))
-    response.raise_for_status()
+    url = f"{FHIR_BASE_URL}/Patient/{patient_id}"
 
     # Convert JSON to Python dict
-    json_data = response.json()
+    json_data = fhir_client.get_json(url)
     # Parse into a fhir.resources Patient object
     patient = Patient.parse_obj(json_data)
     return patient
 
-def get_patients_from_server() -> list:
+def get_patients_from_server(count: int = None) -> list:
     """
     Executes a request to retrieve all the patients from the FHIR server and uses fhirpathpy
-    to extract an array of Patient.
+    to extract an array of Patient. Follows paging links until every page has been read.
     """
-    # Construct search URL (e.g., /Patient?name=Smith)
-    base_url = "http://127.0.0.1:8080/csp/healthshare/demo/fhir/r4"
-    url = f"{base_url}/Patient"
+    url = f"{FHIR_BASE_URL}/Patient"
 
-    headers = {
-        "Accept": "*/*",
-        "Content-Type": "application/fhir+json",
-        "Accept-Encoding": "gzip, deflate, br",
-        "Prefer": "return=representation"
-    }
-
-    response = requests.get(url, headers=headers, auth=("_System", "ISCDEMO"))
-    response.raise_for_status()
-
-    # Parse response JSON into a Python dictionary
-    bundle_dict = response.json()
-
-    # Optional: parse into a Bundle resource for validation (not strictly required for fhirpath)
-    # bundle_resource = Bundle.parse_obj(bundle_dict)
-
-    # Use FHIRPath to gather all Patient objects
-    # The path "Bundle.entry.resource.id" will collect each resource within the entries
-    rawpatients = fhirpath(bundle_dict, "Bundle.entry.resource")
+    # Use FHIRPath to gather all Patient objects on every page
+    rawpatients = iter_search_resources(url, count)
     # Parse into a fhir.resources Patient object
     
     patients = [Patient.parse_obj(p) for p in rawpatients if p.get("resourceType") == "Patient"]
@@ -72,121 +73,65 @@ def get_patient_from_server(patient_id: str) -> Patient:
     using a REST GET request and returns a Patient object.
     """
     # FHIR base URL for individual Patient read
-    url = f"http://127.0.0.1:8080/csp/healthshare/demo/fhir/r4/Patient/{patient_id}"
-    headers = {
-        "Accept": "*/*",
-        "Content-Type": "application/fhir+json",
-        "Accept-Encoding": "gzip, deflate, br",
-        "Prefer": "return=representation"
-    }
-
-    response = requests.get(url, headers=headers, auth=("_System", "ISCDEMO"))
-    response.raise_for_status()
+    url = f"{FHIR_BASE_URL}/Patient/{patient_id}"
 
     # Convert JSON to Python dict
-    json_data = response.json()
+    json_data = fhir_client.get_json(url)
     # Parse into a fhir.resources Patient object
     patient = Patient.parse_obj(json_data)
     return patient
 
-def search_patients_get_ids(search_params: str) -> list:
+def search_patients_get_ids(search_params: str, count: int = None) -> list:
     """
     Executes a FHIR search for Patients based on `search_params`
-    (e.g., "name=Smith"), retrieves a Bundle, and uses fhirpathpy
+    (e.g., "name=Smith"), retrieves every Bundle page, and uses fhirpathpy
     to extract an array of Patient IDs.
     """
     # Construct search URL (e.g., /Patient?name=Smith)
-    base_url = "http://127.0.0.1:8080/csp/healthshare/demo/fhir/r4"
-    url = f"{base_url}/Patient?{search_params}"
-
-    headers = {
-        "Accept": "*/*",
-        "Content-Type": "application/fhir+json",
-        "Accept-Encoding": "gzip, deflate, br",
-        "Prefer": "return=representation"
-    }
-
-    response = requests.get(url, headers=headers, auth=("_System", "ISCDEMO"))
-    response.raise_for_status()
-
-    # Parse response JSON into a Python dictionary
-    bundle_dict = response.json()
-
-    # Optional: parse into a Bundle resource for validation (not strictly required for fhirpath)
-    # bundle_resource = Bundle.parse_obj(bundle_dict)
+    url = f"{FHIR_BASE_URL}/Patient?{search_params}"
+    params = {"_count": count} if count else None
 
     # Use FHIRPath to gather all Patient IDs
     # The path "Bundle.entry.resource.id" will collect "id" from each resource within the entries
-    patient_ids = fhirpath(bundle_dict, "Bundle.entry.resource.id")
+    patient_ids = []
+    for page in iter_bundle_pages(url, params):
+        patient_ids.extend(fhirpath(page, "Bundle.entry.resource.id"))
 
     return patient_ids
 
-def get_observations_for_patient(fhir_id: str) -> list:
+def get_observations_for_patient(fhir_id: str, count: int = None) -> list:
     """
     Executes a request to retrieve all the observations from the FHIR server and uses fhirpathpy
     to extract an array of Observations. The parameter is the fhir_id of the Patient
     """
-    # Construct search URL (e.g., /Patient?name=Smith)
-    base_url = "http://127.0.0.1:8080/csp/healthshare/demo/fhir/r4"
-    url = f"{base_url}/Observation?subject=Patient/{fhir_id}"
+    url = f"{FHIR_BASE_URL}/Observation?subject=Patient/{fhir_id}"
 
-    headers = {
-        "Accept": "*/*",
-        "Content-Type": "application/fhir+json",
-        "Accept-Encoding": "gzip, deflate, br",
-        "Prefer": "return=representation"
-    }
-
-    response = requests.get(url, headers=headers, auth=("_System", "ISCDEMO"))
-    response.raise_for_status()
-
-    # Parse response JSON into a Python dictionary
-    bundle_dict = response.json()
-
-    # Optional: parse into a Bundle resource for validation (not strictly required for fhirpath)
-    # bundle_resource = Bundle.parse_obj(bundle_dict)
-
-    # Use FHIRPath to gather all Observation objects
-    # The path "Bundle.entry.resource.id" will collect each resource within the entries
-    rawobservations = fhirpath(bundle_dict, "Bundle.entry.resource")
+    # Use FHIRPath to gather all Observation objects on every page
+    rawobservations = iter_search_resources(url, count)
     # Parse into a fhir.resources Observation object
     
     observations = [Observation.parse_obj(obs) for obs in rawobservations if obs.get("resourceType") == "Observation"]
     return observations
 
-
-def get_everything_for_patient(fhir_id: str) -> list:
+def get_everything_for_patient(fhir_id: str, count: int = None) -> list:
     """
     Executes a request to retrieve of $everything from the FHIR server and uses fhirpathpy
-    to extract an array of Resources. The parameter is the fhir_id of the Patient
+    to extract an array of Resources across all pages. The parameter is the fhir_id of the Patient
     """
-    # Construct search URL (e.g., /Patient?name=Smith)
-    base_url = "http://127.0.0.1:8080/csp/healthshare/demo/fhir/r4"
-    url = f"{base_url}/Patient/{fhir_id}/$everything"
-
-    headers = {
-        "Accept": "*/*",
-        "Content-Type": "application/fhir+json",
-        "Accept-Encoding": "gzip, deflate, br",
-        "Prefer": "return=representation"
-    }
-
-    response = requests.get(url, headers=headers, auth=("_System", "ISCDEMO"))
-    response.raise_for_status()
-
-    # Parse response JSON into a Python dictionary
-    bundle_dict = response.json()
-
-    # Optional: parse into a Bundle resource for validation (not strictly required for fhirpath)
-    # bundle_resource = Bundle.parse_obj(bundle_dict)
+    url = f"{FHIR_BASE_URL}/Patient/{fhir_id}/$everything"
 
     # Use FHIRPath to gather all Resource objects
-    rawresources = fhirpath(bundle_dict, "Bundle.entry.resource")
-    # Parse into a fhir.resources Observation object
-    
-    # observations = [Observation.parse_obj(obs) for obs in rawobservations if obs.get("resourceType") == "Observation"]
+    rawresources = list(iter_search_resources(url, count))
     return rawresources
 
+def iter_everything_for_patient(fhir_id: str, count: int = None):
+    """
+    Streaming variant of get_everything_for_patient: parses each $everything
+    page incrementally and yields one resource at a time, following next
+    links, so memory stays bounded regardless of bundle size.
+    """
+    return fhir_client.stream_resources(f"{FHIR_BASE_URL}/Patient/{fhir_id}/$everything", count)
+
 def print_fhir_resource(resource):
     """
     Recursively prints all non-None fields (including nested fields)
@@ -0,0 +1,360 @@
+import os
+import time
+import random
+import hashlib
+import argparse
+import threading
+import statistics
+from concurrent.futures import ThreadPoolExecutor
+from tokenutils import count_tokens
+
+# Selected with FHIR_LLM_BACKEND / FHIR_LLM_MODEL when an app does not pass one
+DEFAULT_BACKEND = os.environ.get("FHIR_LLM_BACKEND", "lmstudio")
+DEFAULT_MODELS = {
+    "lmstudio": "mistral-7b-instruct-v0.3",
+    "openai": "gpt-4o-mini",
+    "stub": "stub",
+}
+DEFAULT_CONCURRENCY = 4
+DEFAULT_RETRIES = 3
+DEFAULT_BACKOFF = 1.0
+DEFAULT_TIMEOUT = 120.0
+MAX_BACKOFF = 30.0
+
+
+class LLMError(RuntimeError):
+    """
+    Raised by LLMBackend.complete once a call failed and its retries are
+    used up (or the error is not worth retrying).
+    """
+
+
+class LLMTimeout(TimeoutError):
+    pass
+
+
+class LLMStats:
+    """
+    Thread-safe per-call accounting for one backend: prompt/completion
+    tokens, time to first token, total latency, retries and failures.
+    """
+    def __init__(self):
+        self.calls = []
+        self.retries = 0
+        self.failures = 0
+        self.lock = threading.Lock()
+
+    def record(self, prompt_tokens: int, completion_tokens: int, first_token: float, total: float) -> None:
+        with self.lock:
+            self.calls.append((prompt_tokens, completion_tokens, first_token, total))
+
+    def retried(self) -> None:
+        with self.lock:
+            self.retries += 1
+
+    def failed(self) -> None:
+        with self.lock:
+            self.failures += 1
+
+    def summary(self) -> str:
+        with self.lock:
+            calls = list(self.calls)
+            retries, failures = self.retries, self.failures
+        if not calls:
+            return f"no LLM calls completed ({failures} failed)"
+        firsts = [first for _p, _c, first, _t in calls if first is not None]
+        totals = [total for _p, _c, _f, total in calls]
+        prompt_tokens = sum(p for p, _c, _f, _t in calls)
+        completion_tokens = sum(c for _p, c, _f, _t in calls)
+        first_text = f"first token median {statistics.median(firsts):.2f}s, " if firsts else ""
+        return (f"{len(calls)} LLM calls: {first_text}total median {statistics.median(totals):.1f}s "
+                f"(max {max(totals):.1f}s); {prompt_tokens} prompt + {completion_tokens} completion tokens, "
+                f"{completion_tokens / max(sum(totals), 1e-9):.1f} tok/s; {retries} retries, {failures} failed")
+
+    def report(self) -> None:
+        print(f"⏱️  {self.summary()}")
+
+
+class LLMBackend:
+    """
+    Common front for the LLM servers the apps talk to. complete() streams
+    the completion (into a llmstream.MarkdownStream when one is passed),
+    holds one of `concurrency` slots for the duration of the call, retries
+    transient errors with exponential backoff and jitter, and records the
+    call in self.stats. Subclasses implement _stream(), which yields text
+    fragments, and list their transient errors in retryable().
+    """
+    name = "base"
+
+    def __init__(self, model: str, concurrency: int = DEFAULT_CONCURRENCY,
+                 retries: int = DEFAULT_RETRIES, backoff: float = DEFAULT_BACKOFF,
+                 timeout: float = DEFAULT_TIMEOUT):
+        self.model = model
+        self.concurrency = concurrency
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.slots = threading.BoundedSemaphore(concurrency)
+        self.stats = LLMStats()
+        # per-thread scratch space: token usage reported by the server for the current call
+        self.local = threading.local()
+
+    def retryable(self) -> tuple:
+        return (ConnectionError, TimeoutError)
+
+    def _stream(self, prompt: str, max_tokens: int = None, temperature: float = None):
+        raise NotImplementedError
+
+    def complete(self, prompt: str, stream=None, max_tokens: int = None, temperature: float = None) -> str:
+        """
+        Returns the full completion text for `prompt`; raises LLMError.
+        """
+        attempt = 0
+        while True:
+            try:
+                with self.slots:
+                    return self._complete_once(prompt, stream, max_tokens, temperature)
+            except self.retryable() as e:
+                if attempt >= self.retries:
+                    self.stats.failed()
+                    raise LLMError(f"{self.name}/{self.model} failed after {attempt + 1} attempts: {e}") from e
+                delay = min(MAX_BACKOFF, self.backoff * 2 ** attempt) * random.uniform(0.5, 1.0)
+                print(f"⚠️  {self.name} call failed ({type(e).__name__}: {e}), retrying in {delay:.1f}s")
+                self.stats.retried()
+                attempt += 1
+                time.sleep(delay)
+            except Exception as e:
+                self.stats.failed()
+                raise LLMError(f"{self.name}/{self.model} failed: {type(e).__name__}: {e}") from e
+
+    def _complete_once(self, prompt: str, stream, max_tokens: int, temperature: float) -> str:
+        self.local.usage = None
+        parts = []
+        started = time.perf_counter()
+        first_token = None
+        if stream is not None:
+            stream.begin()
+        try:
+            for fragment in self._stream(prompt, max_tokens, temperature):
+                if not fragment:
+                    continue
+                if first_token is None:
+                    first_token = time.perf_counter() - started
+                parts.append(fragment)
+                if stream is not None:
+                    stream.push(fragment)
+        finally:
+            if stream is not None:
+                stream.end()
+        text = "".join(parts)
+        # servers that do not report usage are counted with tiktoken
+        usage = self.local.usage or (count_tokens(prompt), count_tokens(text))
+        self.stats.record(usage[0], usage[1], first_token, time.perf_counter() - started)
+        return text
+
+
+class LMStudioBackend(LLMBackend):
+    """
+    LM Studio through the lmstudio SDK. The SDK client (one websocket) and
+    the model handle are shared by every backend in the process.
+    """
+    name = "lmstudio"
+    _client = None
+    _models = {}
+    _lock = threading.Lock()
+
+    def __init__(self, model: str = DEFAULT_MODELS["lmstudio"], **kwargs):
+        super().__init__(model, **kwargs)
+        self.handle = self.model_handle(model)
+
+    @classmethod
+    def model_handle(cls, model: str):
+        import lmstudio as lms
+        with cls._lock:
+            if cls._client is None:
+                cls._client = lms.Client()
+            if model not in cls._models:
+                cls._models[model] = cls._client.llm.model(model)
+            return cls._models[model]
+
+    def retryable(self) -> tuple:
+        # the SDK reports a dropped websocket as an AssertionError
+        return (ConnectionError, TimeoutError, AssertionError)
+
+    def _stream(self, prompt: str, max_tokens: int = None, temperature: float = None):
+        config = {}
+        if max_tokens is not None:
+            config["maxTokens"] = max_tokens
+        if temperature is not None:
+            config["temperature"] = temperature
+        prediction = self.handle.complete_stream(prompt, config=config or None)
+        # The deadline runs on its own timer: a model that stalls before the
+        # first token or between tokens sends no fragment to check it on
+        expired = threading.Event()
+
+        def expire():
+            expired.set()
+            prediction.cancel()
+
+        timer = threading.Timer(self.timeout, expire)
+        timer.daemon = True
+        timer.start()
+        try:
+            for fragment in prediction:
+                if expired.is_set():
+                    break
+                yield fragment.content
+            if expired.is_set():
+                raise LLMTimeout(f"no complete answer after {self.timeout:.0f}s")
+            result = prediction.result()
+        except LLMTimeout:
+            raise
+        except Exception as e:
+            # a cancelled prediction may end in an SDK error rather than a clean stop
+            if expired.is_set():
+                raise LLMTimeout(f"no complete answer after {self.timeout:.0f}s") from e
+            raise
+        finally:
+            timer.cancel()
+        stats = getattr(result, "stats", None)
+        if stats is not None and getattr(stats, "predicted_tokens_count", None) is not None:
+            self.local.usage = (stats.prompt_tokens_count or 0, stats.predicted_tokens_count)
+
+
+class OpenAIBackend(LLMBackend):
+    """
+    OpenAI or any OpenAI-compatible chat completions server (base_url, e.g.
+    LM Studio's http://localhost:1234/v1). One OpenAI client, and with it
+    one HTTP connection pool, is shared per (base_url, api_key). Retries
+    are done here, so the client's own retries are turned off.
+    """
+    name = "openai"
+    _clients = {}
+    _lock = threading.Lock()
+
+    def __init__(self, model: str = DEFAULT_MODELS["openai"], base_url: str = None,
+                 api_key: str = None, **kwargs):
+        super().__init__(model, **kwargs)
+        self.base_url = base_url or os.environ.get("OPENAI_BASE_URL")
+        self.api_key = api_key or os.environ.get("OPENAI_API_KEY")
+        self.client = self.shared_client(self.base_url, self.api_key, self.timeout)
+
+    @classmethod
+    def shared_client(cls, base_url: str, api_key: str, timeout: float):
+        from openai import OpenAI
+        key = (base_url, api_key)
+        with cls._lock:
+            if key not in cls._clients:
+                cls._clients[key] = OpenAI(base_url=base_url, api_key=api_key, timeout=timeout, max_retries=0)
+            return cls._clients[key]
+
+    def retryable(self) -> tuple:
+        import openai
+        return (ConnectionError, TimeoutError, openai.APIConnectionError, openai.APITimeoutError,
+                openai.RateLimitError, openai.InternalServerError)
+
+    def _stream(self, prompt: str, max_tokens: int = None, temperature: float = None):
+        request = {"model": self.model, "messages": [{"role": "user", "content": prompt}]}
+        if max_tokens is not None:
+            request["max_tokens"] = max_tokens
+        if temperature is not None:
+            request["temperature"] = temperature
+        # include_usage adds a final chunk with token counts and no choices
+        for chunk in self.client.chat.completions.create(
+                stream=True, stream_options={"include_usage": True}, **request):
+            if chunk.usage is not None:
+                self.local.usage = (chunk.usage.prompt_tokens, chunk.usage.completion_tokens)
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+
+class StubBackend(LLMBackend):
+    """
+    Deterministic local stand-in for load tests and benchmarks: the answer
+    is derived from a hash of the prompt, and the server is simulated with
+    a fixed time to first token and generation speed. Needs no server.
+    """
+    name = "stub"
+
+    def __init__(self, model: str = DEFAULT_MODELS["stub"], first_token: float = 0.2,
+                 tokens_per_second: float = 50.0, completion_words: int = 60, **kwargs):
+        super().__init__(model, **kwargs)
+        self.first_token = first_token
+        self.tokens_per_second = tokens_per_second
+        self.completion_words = completion_words
+
+    def answer(self, prompt: str, max_tokens: int = None) -> list:
+        digest = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+        words = prompt.split()
+        count = min(self.completion_words, max_tokens or self.completion_words)
+        picked = [words[int(digest[i % 32 * 2:i % 32 * 2 + 2], 16) % len(words)] if words else "summary"
+                  for i in range(count)]
+        return [f"[stub {digest[:8]}]"] + picked
+
+    def _stream(self, prompt: str, max_tokens: int = None, temperature: float = None):
+        time.sleep(self.first_token)
+        for i, word in enumerate(self.answer(prompt, max_tokens)):
+            if i:
+                time.sleep(1.0 / self.tokens_per_second)
+            yield word if i == 0 else " " + word
+
+
+BACKENDS = {
+    "lmstudio": LMStudioBackend,
+    "openai": OpenAIBackend,
+    "stub": StubBackend,
+}
+_shared = {}
+_shared_lock = threading.Lock()
+
+
+def get_backend(name: str = None, model: str = None, preferred: dict = None, **kwargs) -> LLMBackend:
+    """
+    Returns the process-wide backend for (name, model), creating it on
+    first use, so every app and worker in a process shares its connection,
+    concurrency limit and stats. `name` defaults to FHIR_LLM_BACKEND; the
+    model is `model`, else FHIR_LLM_MODEL, else the caller's `preferred`
+    model for that backend ({backend: model}), else DEFAULT_MODELS.
+    `kwargs` only apply when the backend is created.
+    """
+    name = name or DEFAULT_BACKEND
+    if name not in BACKENDS:
+        raise ValueError(f"unknown LLM backend '{name}' (choose from {', '.join(BACKENDS)})")
+    model = (model or os.environ.get("FHIR_LLM_MODEL") or (preferred or {}).get(name)
+             or DEFAULT_MODELS[name])
+    with _shared_lock:
+        if (name, model) not in _shared:
+            _shared[name, model] = BACKENDS[name](model, **kwargs)
+        return _shared[name, model]
+
+
+def load_test(backend: LLMBackend, requests: int, prompt_words: int = 400) -> float:
+    """
+    Fires `requests` distinct prompts through `backend` from as many threads
+    as it has slots; returns the wall time. Results are in backend.stats.
+    """
+    rng = random.Random(0)
+    vocabulary = ["patient", "glucose", "metformin", "hypertension", "encounter", "observation",
+                  "a1c", "lisinopril", "asthma", "allergy", "procedure", "visit"]
+    prompts = [f"Summarize request {i}: " + " ".join(rng.choice(vocabulary) for _ in range(prompt_words))
+               for i in range(requests)]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=backend.concurrency) as pool:
+        list(pool.map(lambda prompt: backend.complete(prompt, max_tokens=128), prompts))
+    return time.perf_counter() - started
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Load-test an LLM backend")
+    parser.add_argument("--backend", choices=list(BACKENDS), default=DEFAULT_BACKEND)
+    parser.add_argument("--model", help="model name (default: the backend's default)")
+    parser.add_argument("--requests", type=int, default=16)
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY)
+    parser.add_argument("--prompt-words", type=int, default=400)
+    args = parser.parse_args()
+
+    backend = get_backend(args.backend, args.model, concurrency=args.concurrency)
+    wall = load_test(backend, args.requests, args.prompt_words)
+    print(f"{args.requests} requests to {backend.name}/{backend.model} at concurrency "
+          f"{backend.concurrency} in {wall:.1f}s ({args.requests / wall:.2f} req/s)")
+    backend.stats.report()
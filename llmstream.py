@@ -0,0 +1,59 @@
+import time
+
+# Minimum seconds between re-renders of a streaming widget; each render
+# re-parses the whole Markdown document, so per-token updates would stall the UI
+RENDER_INTERVAL = 0.1
+
+
+class MarkdownStream:
+    """
+    Feeds a streamed completion into a Textual Markdown widget.
+
+    The worker thread running the LLM call (llmbackend.LLMBackend.complete)
+    uses begin(), push(fragment) and end(); pushes are collected and the
+    widget is re-rendered (header plus the text so far) through
+    app.call_from_thread at most every `interval` seconds. finish(text) runs
+    on the event loop once the call returned and renders the final, possibly
+    post-processed, text.
+
+    Keeps time to first token and total time of the last call.
+    """
+    def __init__(self, app, widget, header: str = "", interval: float = RENDER_INTERVAL):
+        self.app = app
+        self.widget = widget
+        self.header = header
+        self.interval = interval
+        self.parts = []
+        self.started = None
+        self.first_token = None
+        self.total = None
+        self.last_render = 0.0
+
+    @property
+    def text(self) -> str:
+        return "".join(self.parts)
+
+    def begin(self) -> None:
+        self.parts = []
+        self.started = time.perf_counter()
+        self.first_token = None
+        self.last_render = 0.0
+
+    def push(self, fragment: str) -> None:
+        if not fragment:
+            return
+        now = time.perf_counter()
+        if self.first_token is None:
+            self.first_token = now - self.started
+        self.parts.append(fragment)
+        if now - self.last_render >= self.interval:
+            self.last_render = now
+            self.app.call_from_thread(self.widget.update, self.header + self.text)
+
+    def end(self) -> None:
+        self.total = time.perf_counter() - self.started
+        self.app.call_from_thread(self.widget.update, self.header + self.text)
+
+    def finish(self, text: str = None) -> None:
+        self.widget.update(self.header + (self.text if text is None else text))
+
@@ -0,0 +1,154 @@
+from typing import Callable, List
+from tokenutils import truncate_batch
+from summarysupport import SummaryScheduler, SUMMARY_CONCURRENCY
+
+FAN_IN = 4
+MAX_DEPTH = 3
+# Tokens each summary may contribute to an intermediate merge prompt
+REDUCE_INPUT_TOKENS = 700
+# Token budget shared by all inputs of the final prompt
+FINAL_INPUT_TOKENS = 1800
+
+
+class MapReduceError(RuntimeError):
+    """
+    Raised by MapReduceSummarizer.run when no summary is left to merge or
+    the final call failed.
+    """
+
+
+class _Failed:
+    # Returned in place of a summary by a map/reduce call that raised
+    def __init__(self, error: Exception):
+        self.error = error
+
+    def __str__(self) -> str:
+        return f"[ERROR: {type(self.error).__name__}: {self.error}]"
+
+
+class MapReduceSummarizer:
+    """
+    Tree summarization of any number of chunks:
+
+      map     map_fn(chunk, index) for every chunk, in parallel
+      reduce  reduce_fn(texts, level, index) over groups of `fan_in`
+              summaries, every group of a level in parallel, repeated until
+              at most `fan_in` summaries remain or `max_depth` levels ran
+      final   final_fn(texts) over what is left
+
+    All calls are blocking LLM calls run through one SummaryScheduler, so at
+    most `concurrency` are in flight. Latency grows with the number of
+    levels (log base fan_in of the chunk count) rather than with the number
+    of chunks. `on_result(stage, level, index, text)` is called on the event
+    loop as each summary finishes (stage is "map", "reduce" or "final"), so
+    a Textual app can stream them to its widgets.
+
+    A map or reduce call that raises is left out of the merge rather than
+    passed on as text; the chunks it covered are listed in `left_out`, in
+    a note appended to the final summary and in report().
+    """
+    def __init__(self, map_fn: Callable, reduce_fn: Callable, final_fn: Callable,
+                 fan_in: int = FAN_IN, max_depth: int = MAX_DEPTH,
+                 concurrency: int = SUMMARY_CONCURRENCY, on_result: Callable = None):
+        self.map_fn = map_fn
+        self.reduce_fn = reduce_fn
+        self.final_fn = final_fn
+        self.fan_in = max(2, fan_in)
+        self.max_depth = max_depth
+        self.scheduler = SummaryScheduler(concurrency)
+        self.on_result = on_result
+        self.levels: List[List[str]] = []
+        self.chunk_count = 0
+        self.left_out: List[int] = []
+
+    def notify(self, stage: str, level: int, index: int, text) -> None:
+        if self.on_result is not None:
+            self.on_result(stage, level, index, str(text))
+
+    @staticmethod
+    def guarded(fn: Callable) -> Callable:
+        def call(*args):
+            try:
+                return fn(*args)
+            except Exception as e:
+                return _Failed(e)
+        return call
+
+    def plan(self, chunk_count: int) -> List[int]:
+        """
+        Number of calls at each level (map, reduces..., final) for
+        `chunk_count` chunks, e.g. for sizing a progress bar.
+        """
+        counts = [chunk_count]
+        current = chunk_count
+        depth = 0
+        while current > self.fan_in and depth < self.max_depth:
+            current = -(-current // self.fan_in)
+            counts.append(current)
+            depth += 1
+        return counts + [1]
+
+    def keep(self, results: list, covered: list) -> tuple:
+        """
+        Drops failed results, recording the chunks they covered as left out;
+        returns the remaining (texts, covered).
+        """
+        texts, kept = [], []
+        for result, chunks in zip(results, covered):
+            if isinstance(result, _Failed):
+                self.left_out.extend(chunks)
+            else:
+                texts.append(result)
+                kept.append(chunks)
+        return texts, kept
+
+    def left_out_note(self) -> str:
+        if not self.left_out:
+            return ""
+        chunks = ", ".join(str(i + 1) for i in sorted(self.left_out))
+        return (f"{len(self.left_out)} of {self.chunk_count} chunks could not be summarized "
+                f"and are not covered by this summary (chunks {chunks}).")
+
+    async def run(self, chunks: List[str]) -> str:
+        self.levels = []
+        self.chunk_count = len(chunks)
+        self.left_out = []
+        if not chunks:
+            return ""
+        summaries = await self.scheduler.run(
+            [(i, self.guarded(self.map_fn), chunk, i) for i, chunk in enumerate(chunks)],
+            lambda i, text: self.notify("map", 0, i, text))
+        current, covered = self.keep([summaries[i] for i in range(len(chunks))],
+                                     [[i] for i in range(len(chunks))])
+        self.levels = [current]
+
+        level = 0
+        while len(current) > self.fan_in and level < self.max_depth:
+            level += 1
+            starts = range(0, len(current), self.fan_in)
+            groups = [truncate_batch(current[start:start + self.fan_in], max_tokens=REDUCE_INPUT_TOKENS)
+                      for start in starts]
+            merged = await self.scheduler.run(
+                [(i, self.guarded(self.reduce_fn), group, level, i) for i, group in enumerate(groups)],
+                lambda i, text, level=level: self.notify("reduce", level, i, text))
+            current, covered = self.keep(
+                [merged[i] for i in range(len(groups))],
+                [sum(covered[start:start + self.fan_in], []) for start in starts])
+            self.levels.append(current)
+
+        if not current:
+            raise MapReduceError(f"all {len(chunks)} chunks failed to summarize")
+        per_input = max(REDUCE_INPUT_TOKENS // 4, FINAL_INPUT_TOKENS // len(current))
+        try:
+            final = await self.scheduler.run_final(self.final_fn, truncate_batch(current, max_tokens=per_input))
+        except Exception as e:
+            raise MapReduceError(f"final summary failed: {type(e).__name__}: {e}") from e
+        if self.left_out:
+            final = f"{final}\n\n_⚠️ {self.left_out_note()}_"
+        self.notify("final", level + 1, 0, final)
+        return final
+
+    def report(self) -> str:
+        shape = " → ".join(str(len(texts)) for texts in self.levels) + " → 1"
+        missing = f"; {self.left_out_note().rstrip('.')}" if self.left_out else ""
+        return f"map-reduce {shape}{missing}; {self.scheduler.report()}"
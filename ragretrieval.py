@@ -0,0 +1,392 @@
+import re
+import time
+import decimal
+from collections import namedtuple
+from contextlib import contextmanager
+from vectorcodec import encode_vector
+from vectorschema import SUMMARY_VECTOR_TABLE, TEXT_COLUMN
+from tokenutils import count_tokens_batch, truncate_to_tokens
+
+VECTOR_TABLE = "PatientVectors"
+TOP_K = 4
+MAX_PASSAGES = 8
+TOKEN_BUDGET = 2000
+# Don't bother squeezing a truncated passage into less room than this
+MIN_PASSAGE_TOKENS = 64
+
+# Cohort search: distinct patients returned, resources shown per patient,
+# and how many ANN rows are fetched per wanted patient before widening
+COHORT_SIZE = 10
+MATCHES_PER_PATIENT = 3
+COHORT_OVERFETCH = 20
+COHORT_MAX_FETCH = 5000
+COHORT_MODES = ("ann", "exact", "summaries")
+
+# Cheap question classifier: a resource type is searched when any of its
+# keyword stems starts a word in the question.
+TYPE_KEYWORDS = {
+    "Condition": ["diagnos", "condition", "disease", "problem", "history", "diabet",
+                  "hypertens", "asthma", "cancer", "copd", "chf", "heart failure"],
+    "MedicationRequest": ["medic", "med", "drug", "prescri", "dose", "dosage", "taking",
+                          "insulin", "metformin", "statin", "pill", "therap"],
+    "Observation": ["lab", "result", "level", "vital", "blood pressure", "bp", "a1c",
+                    "hba1c", "glucose", "cholesterol", "weight", "bmi", "heart rate",
+                    "measure", "value"],
+    "Encounter": ["visit", "encounter", "admi", "hospital", "appointment", "emergency"],
+    "Procedure": ["procedure", "surg", "operation"],
+    "AllergyIntolerance": ["allerg", "reaction", "intoleran"],
+    "Immunization": ["vaccin", "immuniz", "shot", "booster"],
+    "DiagnosticReport": ["report", "imaging", "x-ray", "xray", "mri", "scan", "panel", "pathology"],
+    "DocumentReference": ["note", "document", "discharge"],
+    "CarePlan": ["care plan", "plan", "goal", "follow-up", "follow up"],
+    "Practitioner": ["doctor", "physician", "provider", "practitioner", "nurse"],
+}
+# Searched when the question matches none of the keywords
+DEFAULT_RESOURCE_TYPES = ["Condition", "MedicationRequest", "Observation",
+                          "Procedure", "AllergyIntolerance"]
+_TYPE_PATTERNS = {
+    rtype: re.compile(r"\b(?:" + "|".join(re.escape(k) for k in keywords) + ")", re.IGNORECASE)
+    for rtype, keywords in TYPE_KEYWORDS.items()
+}
+
+Passage = namedtuple("Passage", [
+    "resource_id", "resource_type", "text", "score",
+    "patient_lastname", "patient_firstname", "patient_id"
+])
+
+CohortMatch = namedtuple("CohortMatch", [
+    "patient_id", "patient_lastname", "patient_firstname", "score", "passages"
+])
+
+
+def text_value(val) -> str:
+    """
+    Normalizes a resourcetext value as returned by the IRIS driver into a
+    str: unwraps one-element lists, decodes bytes, reads stream objects and
+    maps NULL/numeric junk to "".
+    """
+    if isinstance(val, list):
+        val = val[0] if val else None
+    if hasattr(val, "read"):
+        val = val.read()
+    if isinstance(val, bytes):
+        val = val.decode("utf-8", errors="ignore")
+    if val is None or isinstance(val, (int, float, decimal.Decimal)):
+        return ""
+    return val if isinstance(val, str) else str(val)
+
+
+class StageTimings:
+    """
+    Wall-clock time per retrieval stage (embed, search, fetch, llm, ...) for
+    the most recent request, plus running totals across requests.
+    """
+    def __init__(self):
+        self.last = {}
+        self.totals = {}
+        self.requests = 0
+
+    def start_request(self) -> None:
+        self.last = {}
+        self.requests += 1
+
+    @contextmanager
+    def stage(self, name: str):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - started)
+
+    def add(self, name: str, seconds: float) -> None:
+        self.last[name] = self.last.get(name, 0.0) + seconds
+        self.totals[name] = self.totals.get(name, 0.0) + seconds
+
+    def summary(self) -> str:
+        return " · ".join(f"{name} {seconds * 1000:.0f}ms" for name, seconds in self.last.items())
+
+    def report(self) -> None:
+        print(f"Retrieval latency, mean over {self.requests} requests:")
+        for name, seconds in self.totals.items():
+            print(f"  {name:<8} {1000.0 * seconds / max(self.requests, 1):9.1f}ms")
+
+
+class VectorRetriever:
+    """
+    Top-K cosine retrieval over a patient vector table that returns each
+    hit's ids, text, score and patient names from a single query, instead
+    of looking the text up again per hit by resource_id.
+
+    `embedder` is anything with encode(text) -> vector: a SentenceTransformer
+    or an EmbeddingCache wrapping one.
+    """
+    def __init__(self, conn, embedder, table: str = VECTOR_TABLE):
+        self.conn = conn
+        self.embedder = embedder
+        self.table = table
+        self.timings = StageTimings()
+
+    def build_sql(self, top_k: int, patient_id: str = None, resource_types: list = None,
+                  with_text: bool = True) -> str:
+        filters = []
+        if patient_id is not None:
+            filters.append("patient_id = ?")
+        if resource_types:
+            filters.append(f"resource_type IN ({', '.join('?' for _ in resource_types)})")
+        where = f"WHERE {' AND '.join(filters)}" if filters else ""
+        return f"""
+          SELECT TOP {int(top_k)}
+            resource_id,
+            resource_type,
+            {TEXT_COLUMN if with_text else "''"},
+            VECTOR_COSINE(embedding, TO_VECTOR(?,DOUBLE)) AS score,
+            patient_lastname,
+            patient_firstname,
+            patient_id
+          FROM {self.table}
+          {where}
+          ORDER BY score DESC
+        """
+
+    def embed(self, query: str):
+        with self.timings.stage("embed"):
+            return self.embedder.encode(query)
+
+    def search(self, query: str, patient_id: str = None, resource_types: list = None,
+               top_k: int = TOP_K) -> list:
+        """
+        Embeds `query` and returns up to top_k Passages ordered by descending
+        cosine similarity, optionally restricted to one patient and to some
+        resource types. Starts a new entry in self.timings.
+        """
+        self.timings.start_request()
+        return self.search_vector(self.embed(query), patient_id, resource_types, top_k)
+
+    def search_vector(self, vec, patient_id: str = None, resource_types: list = None,
+                      top_k: int = TOP_K, with_text: bool = True) -> list:
+        """
+        Top-K for an already embedded query. with_text=False leaves the
+        passage texts empty, for wide candidate scans that only need ids and
+        scores.
+        """
+        params = [encode_vector(vec)]
+        if patient_id is not None:
+            params.append(patient_id)
+        params.extend(resource_types or [])
+
+        cur = self.conn.cursor()
+        with self.timings.stage("search"):
+            cur.execute(self.build_sql(top_k, patient_id, resource_types, with_text), params)
+        with self.timings.stage("fetch"):
+            rows = cur.fetchall()
+        return [Passage(rid, rtype, text_value(text), float(score), last, first, pid)
+                for rid, rtype, text, score, last, first, pid in rows]
+
+
+def infer_resource_types(question: str) -> list:
+    """
+    Picks the resource types a question is about from TYPE_KEYWORDS, in
+    TYPE_KEYWORDS order, falling back to DEFAULT_RESOURCE_TYPES.
+    """
+    matched = [rtype for rtype, pattern in _TYPE_PATTERNS.items() if pattern.search(question)]
+    return matched or list(DEFAULT_RESOURCE_TYPES)
+
+
+def merge_passages(result_sets, limit: int = MAX_PASSAGES) -> list:
+    """
+    Merges per-type result lists into one list ranked by descending score,
+    dropping repeats of the same patient/type/resource.
+    """
+    best = {}
+    for passages in result_sets:
+        for passage in passages:
+            key = (passage.patient_id, passage.resource_type, passage.resource_id)
+            if key not in best or passage.score > best[key].score:
+                best[key] = passage
+    return sorted(best.values(), key=lambda p: p.score, reverse=True)[:limit]
+
+
+def assemble_context(passages: list, token_budget: int = TOKEN_BUDGET) -> tuple:
+    """
+    Takes passages in rank order until `token_budget` tokens are used. The
+    first passage that does not fit is truncated into the remaining room
+    (if at least MIN_PASSAGE_TOKENS are left) and assembly stops there.
+    Returns (context, passages_used).
+    """
+    used, texts, remaining = [], [], token_budget
+    for passage, tokens in zip(passages, count_tokens_batch([p.text for p in passages])):
+        if tokens <= remaining:
+            texts.append(passage.text)
+            used.append(passage)
+            remaining -= tokens
+            continue
+        if remaining >= MIN_PASSAGE_TOKENS:
+            texts.append(truncate_to_tokens(passage.text, remaining))
+            used.append(passage)
+        break
+    return "\n\n".join(texts), used
+
+
+def retrieve_context(retriever: VectorRetriever, question: str, patient_id: str = None,
+                     resource_types: list = None, per_type_k: int = TOP_K,
+                     max_passages: int = MAX_PASSAGES, token_budget: int = TOKEN_BUDGET) -> tuple:
+    """
+    Retrieval planner shared by the RAG entry points. Searches each resource
+    type (given, or inferred from the question) with its own filtered top-K
+    so one dominant type cannot crowd out the rest, reusing a single query
+    embedding; merges and reranks the hits by score and packs them into a
+    context within `token_budget`.
+
+    Returns (context, passages_used, resource_types_searched).
+    """
+    resource_types = list(resource_types) if resource_types else infer_resource_types(question)
+    retriever.timings.start_request()
+    vec = retriever.embed(question)
+    result_sets = [retriever.search_vector(vec, patient_id, [rtype], per_type_k)
+                   for rtype in resource_types]
+    with retriever.timings.stage("assemble"):
+        passages = merge_passages(result_sets, max_passages)
+        context, used = assemble_context(passages, token_budget)
+    return context, used, resource_types
+
+
+def group_by_patient(passages: list, matches_per_patient: int = MATCHES_PER_PATIENT) -> list:
+    """
+    Groups passages into one CohortMatch per patient, scored by the
+    patient's best passage and ranked by descending score. Each match keeps
+    its `matches_per_patient` best passages.
+    """
+    by_patient = {}
+    for passage in sorted(passages, key=lambda p: p.score, reverse=True):
+        by_patient.setdefault(passage.patient_id, []).append(passage)
+    return [CohortMatch(pid, hits[0].patient_lastname, hits[0].patient_firstname, hits[0].score,
+                        hits[:matches_per_patient])
+            for pid, hits in by_patient.items()]
+
+
+class CohortSearch:
+    """
+    Top-N distinct patients for a question, each with its best matching
+    resources. A plain top-K over the whole table collapses onto the one or
+    two patients with the most similar resources; the modes trade recall
+    for latency differently:
+
+      ann        HNSW top-(N * overfetch) rows without texts, grouped by
+                 patient; the fetch is widened 4x (up to max_fetch) while
+                 fewer than N patients turn up. Fast, approximate.
+      exact      MAX(VECTOR_COSINE) per patient with GROUP BY on the server:
+                 exact per-patient best scores, but a full scan.
+      summaries  one HNSW query over PatientSummaryVectors (one row per
+                 patient, from summarybatch); ranks by the overall summary.
+
+    With refine on (always for exact), each selected patient's best
+    resources are then fetched with a per-patient top-K query, which the
+    patient_id-led indexes serve, giving texts and exact scores.
+    """
+    def __init__(self, retriever: VectorRetriever, overfetch: int = COHORT_OVERFETCH,
+                 max_fetch: int = COHORT_MAX_FETCH, summary_table: str = SUMMARY_VECTOR_TABLE):
+        self.retriever = retriever
+        self.overfetch = overfetch
+        self.max_fetch = max_fetch
+        self.summary_table = summary_table
+        self.fetched = 0
+
+    def search(self, question: str, patients: int = COHORT_SIZE, resource_types: list = None,
+               matches_per_patient: int = MATCHES_PER_PATIENT, mode: str = "ann",
+               refine: bool = True) -> list:
+        if mode not in COHORT_MODES:
+            raise ValueError(f"unknown cohort search mode '{mode}' (choose from {', '.join(COHORT_MODES)})")
+        self.retriever.timings.start_request()
+        vec = self.retriever.embed(question)
+        with self.retriever.timings.stage("candidates"):
+            if mode == "ann":
+                candidates = self.candidates_ann(vec, patients, resource_types, matches_per_patient,
+                                                 with_text=not refine)
+            elif mode == "exact":
+                candidates = self.candidates_exact(vec, patients, resource_types)
+            else:
+                candidates = self.candidates_summaries(vec, patients)
+        if not (refine or mode == "exact"):
+            return candidates
+        with self.retriever.timings.stage("refine"):
+            return self.refine(vec, candidates, resource_types, matches_per_patient,
+                               rescore=mode != "summaries")
+
+    def candidates_ann(self, vec, patients: int, resource_types: list = None,
+                       matches_per_patient: int = MATCHES_PER_PATIENT, with_text: bool = False) -> list:
+        fetch = min(self.max_fetch, patients * self.overfetch)
+        while True:
+            passages = self.retriever.search_vector(vec, None, resource_types, fetch, with_text)
+            self.fetched = len(passages)
+            grouped = group_by_patient(passages, matches_per_patient)
+            # stop once enough patients turned up, the cap is hit, or the
+            # table (or type filter) has no more rows to give
+            if len(grouped) >= patients or fetch >= self.max_fetch or len(passages) < fetch:
+                return grouped[:patients]
+            fetch = min(self.max_fetch, fetch * 4)
+
+    def candidates_exact(self, vec, patients: int, resource_types: list = None) -> list:
+        params = [encode_vector(vec)] + list(resource_types or [])
+        where = f"WHERE resource_type IN ({', '.join('?' for _ in resource_types)})" if resource_types else ""
+        cur = self.retriever.conn.cursor()
+        cur.execute(f"""
+          SELECT TOP {int(patients)}
+            patient_id,
+            MAX(patient_lastname),
+            MAX(patient_firstname),
+            MAX(VECTOR_COSINE(embedding, TO_VECTOR(?,DOUBLE))) AS score
+          FROM {self.retriever.table}
+          {where}
+          GROUP BY patient_id
+          ORDER BY score DESC
+        """, params)
+        rows = cur.fetchall()
+        self.fetched = len(rows)
+        return [CohortMatch(pid, last, first, float(score), []) for pid, last, first, score in rows]
+
+    def candidates_summaries(self, vec, patients: int) -> list:
+        cur = self.retriever.conn.cursor()
+        cur.execute(f"""
+          SELECT TOP {int(patients)}
+            summary_id,
+            CAST(summary_text AS VARCHAR(4000)),
+            VECTOR_COSINE(embedding, TO_VECTOR(?,DOUBLE)) AS score,
+            patient_lastname,
+            patient_firstname,
+            patient_id
+          FROM {self.summary_table}
+          WHERE patient_id IS NOT NULL
+          ORDER BY score DESC
+        """, [encode_vector(vec)])
+        rows = cur.fetchall()
+        self.fetched = len(rows)
+        return [CohortMatch(pid, last, first, float(score),
+                            [Passage(sid, "Summary", text_value(text), float(score), last, first, pid)])
+                for sid, text, score, last, first, pid in rows]
+
+    def refine(self, vec, candidates: list, resource_types: list = None,
+               matches_per_patient: int = MATCHES_PER_PATIENT, rescore: bool = True) -> list:
+        """
+        Replaces each candidate's passages with its top resources (with
+        text) from a per-patient query. With rescore, the patient's score
+        becomes its best resource score and the cohort is re-ranked.
+        """
+        refined = []
+        for match in candidates:
+            passages = self.retriever.search_vector(vec, match.patient_id, resource_types, matches_per_patient)
+            if match.passages and match.passages[0].resource_type == "Summary":
+                passages = match.passages[:1] + passages
+            best = max([match.score] + [p.score for p in passages]) if rescore else match.score
+            refined.append(match._replace(score=best, passages=passages))
+        if rescore:
+            refined.sort(key=lambda m: m.score, reverse=True)
+        return refined
+
+
+def cohort_overlap(found: list, reference: list) -> float:
+    """
+    Share of the reference cohort's patients that `found` also returned,
+    e.g. ann against exact to pick overfetch.
+    """
+    wanted = {m.patient_id for m in reference}
+    return len(wanted & {m.patient_id for m in found}) / len(wanted) if wanted else 1.0
@@ -3,25 +3,31 @@ from textual.app import App, ComposeResult
 from textual.containers import VerticalScroll, Horizontal
 from textual.widgets import Header, Footer, Markdown, Button, Input, Select
 from textual.worker import get_current_worker
-import lmstudio as lms
+from tokenutils import truncate_to_tokens
 import json, decimal
 import sys
-import tiktoken
 import asyncio
-from fhirpathpy import evaluate as fhirpath
+from fhirpathcache import evaluate as fhirpath, RESOURCE_TYPE_FILTER
 from getSearchPatients import get_everything_for_patient
+from bundleindex import BundleIndex
+from llmstream import MarkdownStream
+from summarycache import shared_summary_cache
+from llmbackend import get_backend
+
+# Summary cache keys; bump the version when a prompt's meaning changes
+SECTION_TEMPLATE = "simple-section/v1"
 
 RESOURCE_TYPES = ["Patient", "Condition", "MedicationRequest", "Observation", "Encounter", "Practitioner"]
 
 class FHIRSummaryApp(App):
     BINDINGS = [('d', 'toggle_dark', 'Toggle dark mode')]
 
-    def __init__(self, **kwargs):
+    def __init__(self, backend: str = None, **kwargs):
         super().__init__(**kwargs)
         self.fhirId = ""
         self.selected_resource = "Patient"
-        self.client = lms.Client()
-        self.model = self.client.llm.model("mistral-7b-instruct-v0.3")
+        self.llm = get_backend(backend, preferred={"lmstudio": "mistral-7b-instruct-v0.3"})
+        self.summary_cache = shared_summary_cache()
 
     def compose(self) -> ComposeResult:
         yield Header()
@@ -46,19 +52,22 @@ class FHIRSummaryApp(App):
     async def process_summary(self) -> None:
         bundle = self.get_patient_bundle(self.fhirId)
         rtype = self.selected_resource
-        resources = self.extract_resources(bundle, rtype)
+        resources = BundleIndex(bundle).of_type(rtype)
         if not resources:
             summary_text = f"_No {rtype} resources found._"
         else:
             json_text = json.dumps(resources, indent=2, default=self.make_json_safe)
             chunked = self.truncate_to_tokens(json_text, max_tokens=1500)
-            summary_text = await asyncio.to_thread(self.summarize_resource_type, chunked, rtype)
+            stream = MarkdownStream(self, self.query_one("#resource-summary", Markdown),
+                                    header=f"### {rtype} Summary\n")
+            summary_text = await asyncio.to_thread(self.summarize_resource_type, chunked, rtype, stream)
+            summary_text += f"\n\n_⏱️ first token {stream.first_token or 0.0:.2f}s, total {stream.total:.1f}s_"
         self.query_one("#resource-summary", Markdown).update(f"### {rtype} Summary\n{summary_text}")
 
     def extract_resources(self, bundle: list, resource_type: str) -> list:
-        return fhirpath(bundle, f"where(resourceType = '{resource_type}')")
+        return fhirpath(bundle, RESOURCE_TYPE_FILTER, {"rtype": resource_type})
 
-    def summarize_resource_type(self, text: str, rtype: str) -> str:
+    def summarize_resource_type(self, text: str, rtype: str, stream: MarkdownStream) -> str:
         prompt = (
          f"[INST] You are a clinical summarization AI. "
          f"Summarize the key information from the following FHIR {rtype} resources. "
@@ -66,15 +75,13 @@ class FHIRSummaryApp(App):
         f"{text}\n\n[/INST]"
         )
         print(f"Summarizing {rtype}...")
-        return self.model.complete(prompt).content.strip()
+        return self.summary_cache.complete(self.llm, prompt, SECTION_TEMPLATE, self.fhirId, stream).strip()
 
     def get_patient_bundle(self, patfhirid: str) -> list:
         return get_everything_for_patient(patfhirid)
 
     def truncate_to_tokens(self, text: str, max_tokens: int = 1000) -> str:
-        enc = tiktoken.encoding_for_model("gpt-3.5-turbo")
-        tokens = enc.encode(text)
-        return enc.decode(tokens[:max_tokens])
+        return truncate_to_tokens(text, max_tokens)
 
     def make_json_safe(self, obj):
         if isinstance(obj, decimal.Decimal):
@@ -1,4 +1,4 @@
-import tiktoken
+from tokenutils import count_tokens, count_tokens_batch
 from sentence_transformers import SentenceTransformer
 import numpy as np
 import logging
@@ -120,9 +120,7 @@ summaries = [
 
 def embed_text(model, text):
     # count tokens
-    enc = tiktoken.encoding_for_model("gpt-3.5-turbo")
-    tokens = enc.encode(text)
-    token_count = len(tokens)
+    token_count = count_tokens(text)
     # compute embedding
     vec = model.encode(text).tolist()
     return vec, token_count
@@ -131,8 +129,9 @@ def embed_text(model, text):
 # Generate & store embeddings
 def build_index(model, summaries):
     index = []
-    for s in summaries:
-        vec, count = embed_text(model, s["text"])
+    counts = count_tokens_batch([s["text"] for s in summaries])
+    vecs = model.encode([s["text"] for s in summaries])
+    for s, vec, count in zip(summaries, vecs, counts):
         index.append({
             "id": s["id"],
             "text": s["text"],
@@ -151,8 +150,7 @@ def cosine_sim(a: np.ndarray, b: np.ndarray) -> float:
 
 # Search function
 def search(query: str, model, index, top_k=1):
-    q_vec, _ = embed_text(model, query)
-    q_vec = np.array(q_vec)
+    q_vec = model.encode(query)
     # compute similarity against each indexed summary
     sims = [
         (item["id"], cosine_sim(q_vec, item["embedding"]))
@@ -1,8 +1,10 @@
 import os
 import iris
-import tiktoken
 import numpy as np
 from sentence_transformers import SentenceTransformer
+from vectorcodec import encode_vector
+from embeddingcache import shared_cache
+from vectorschema import SUMMARY_VECTOR_TABLE, INGEST_VECTOR_PARAM, ensure_summary_table
 
 MODEL_NAME= "nomic-ai/nomic-embed-text-v1.5"
 
@@ -115,12 +117,9 @@ SUMMARIES = [
 ]
 
 def embed_text(model, text):
-    enc = tiktoken.encoding_for_model("gpt-3.5-turbo")
-    tokens = enc.encode(text)
-    vec = model.encode(text).tolist()
-    return vec, len(tokens)
+    return model.encode(text)
 
-VECTOR_TABLE = "PatientSummaryVectors"
+VECTOR_TABLE = SUMMARY_VECTOR_TABLE
 
 class PatientSummaryIndexer:
     MODEL_NAME = "nomic-ai/nomic-embed-text-v1.5"
@@ -131,39 +130,14 @@ class PatientSummaryIndexer:
                  namespace="DEMO", username="_SYSTEM", password="ISCDEMO"):
         # load model once
         self.model = SentenceTransformer(self.MODEL_NAME, trust_remote_code=True)
+        self.query_cache = shared_cache(self.model, self.MODEL_NAME)
 
         # connect to IRIS
         self.conn = iris.connect(iris_host, iris_port, namespace, username, password)
         self._ensure_table()
         
     def _ensure_table(self):
-        cur = self.conn.cursor()
-        # check for existing table
-        cur.execute(f"""
-            SELECT COUNT(*) 
-            FROM INFORMATION_SCHEMA.TABLES 
-            WHERE TABLE_NAME = '{VECTOR_TABLE}'
-        """)
-        (count,) = cur.fetchone()
-        
-        if count == 0:
-            cur.execute(f"""
-            CREATE TABLE {VECTOR_TABLE} (
-                summary_id   VARCHAR(10)   PRIMARY KEY,
-                summary_text VARCHAR(4000),
-                embedding VECTOR(DOUBLE, 768)
-                )
-            """)
-            
-            cur.execute(f"""
-            CREATE INDEX idx_summary_vectors
-            ON {VECTOR_TABLE} (embedding)
-            AS HNSW(Distance='Cosine')
-            """)
-            self.conn.commit()
-            print(f"✅ Created {VECTOR_TABLE} + HNSW index")
-        else:
-            print(f"ℹ️  Table {VECTOR_TABLE} already exists")
+        ensure_summary_table(self.conn, VECTOR_TABLE)
             
     def load_summaries(self, summaries=SUMMARIES):
         """Embeds & bulk-inserts each summary into IRIS."""
@@ -174,13 +148,13 @@ class PatientSummaryIndexer:
               s['text'] = str(s['text'])
 
             text_bytes = s['text'].encode('utf-8', errors='ignore')
-            vec, _ = embed_text(self.model,  s['text'])
+            vec = embed_text(self.model,  s['text'])
             # format as CSV of floats
-            csv = ",".join(f"{v:.8f}" for v in vec)
+            csv = encode_vector(vec)
             params = [s["id"],  s['text'], csv]
             sql = f"""
                   INSERT INTO {VECTOR_TABLE} (summary_id, summary_text, embedding)
-                  VALUES (?, ?, TO_VECTOR(?,FLOAT))
+                  VALUES (?, ?, {INGEST_VECTOR_PARAM})
                   """
             cur.execute(sql, params)
             print(f"Inserted/Updated summary {s['id']}")
@@ -188,11 +162,11 @@ class PatientSummaryIndexer:
         
     def search(self, query: str, top_k: int = 3):
         #Runs a vector‐similarity search in IRIS and returns top_k matches."""
-        # 1) Embed the query to get a Python list of floats
-          vec, _ = embed_text(self.model, query)
+        # 1) Embed the query (cached, repeated questions skip the model)
+          vec = embed_text(self.query_cache, query)
         
         # 2) Turn that list into the comma-joined string format IRIS expects
-          emb_csv = ",".join(f"{x:.8f}" for x in vec)
+          emb_csv = encode_vector(vec)
 
         # 3) Execute select
           sql = f"""
@@ -226,6 +200,7 @@ if __name__ == "__main__":
         print("\nTop matches:")
         for sid, score in results:
             print(f" • {sid} (score={score}): ")
+        idx.query_cache.report()
         
     
         
\ No newline at end of file
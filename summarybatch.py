@@ -0,0 +1,284 @@
+import os
+import json
+import time
+import hashlib
+import argparse
+import threading
+from datetime import datetime, timezone
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import iris
+from sentence_transformers import SentenceTransformer
+from tokenutils import truncate_to_tokens
+from vectorcodec import encode_vectors
+from fhirrows import RESOURCE_TYPES
+from vectorschema import SUMMARY_VECTOR_TABLE, INGEST_VECTOR_PARAM, ensure_summary_table
+from llmbackend import get_backend
+from summarycache import shared_summary_cache
+from summarysupport import (
+    SUMMARY_TABLE, SECTION_TEMPLATE, FINAL_TEMPLATE, SECTION_INPUT_TOKENS, FINAL_INPUT_TOKENS,
+    fetch_texts_by_type, section_prompt, final_prompt, clip_summary
+)
+
+EMBED_MODEL = "nomic-ai/nomic-embed-text-v1.5"
+CHECKPOINT_PATH = "summarybatch_checkpoint.json"
+DEFAULT_WORKERS = 4
+# Summaries embedded and written per IRIS round trip
+DEFAULT_WRITE_BATCH = 16
+# Patients submitted per worker ahead of time; keeps an interrupted run from
+# having a queue of LLM calls to drain
+IN_FLIGHT_PER_WORKER = 2
+MAX_SUMMARY_CHARS = 4000
+# summary_id namespace, so batch rows never collide with the demo summaries
+# simplevectorstorage loads into the same table
+SUMMARY_ID_PREFIX = "batch:"
+
+PATIENTS_SQL = f"""
+     SELECT patient_id, MAX(patient_lastname), MAX(patient_firstname)
+     FROM {SUMMARY_TABLE}
+     GROUP BY patient_id
+     ORDER BY patient_id
+     """
+DELETE_SUMMARY_SQL = f"DELETE FROM {SUMMARY_VECTOR_TABLE} WHERE summary_id = ?"
+INSERT_SUMMARY_SQL = f"""
+     INSERT INTO {SUMMARY_VECTOR_TABLE} (summary_id, summary_text, embedding, patient_id, patient_lastname, patient_firstname, source_hash, model, generated_at) VALUES (?, ?, {INGEST_VECTOR_PARAM}, ?, ?, ?, ?, ?, ?)
+     """
+
+PatientSummary = namedtuple("PatientSummary", [
+    "patient_id", "patient_lastname", "patient_firstname", "source_hash", "text"
+])
+
+
+class BatchCheckpoint:
+    """
+    Progress of the batch job persisted as JSON: the source hash each
+    patient's stored summary was built from, and the last error of patients
+    that failed. A patient is only marked done once its summary row is
+    committed, so an interrupted run resumes where it stopped. Written
+    atomically like fhirsync's state file.
+    """
+    def __init__(self, path: str = CHECKPOINT_PATH):
+        self.path = path
+        self.done = {}
+        self.failed = {}
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                saved = json.load(f)
+            self.done = saved.get("done", {})
+            self.failed = saved.get("failed", {})
+
+    def save(self) -> None:
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"done": self.done, "failed": self.failed}, f, indent=2)
+        os.replace(tmp_path, self.path)
+
+
+class PatientSummaryBatch:
+    """
+    Headless version of FHIRSummaryRevised for every patient in the vector
+    table: per-resource-type summaries and a final summary per patient,
+    with the same prompts, through the same LLM backend and summary cache,
+    so the interactive app reuses what this job generated (and the other
+    way round). Final summaries are embedded and upserted into
+    PatientSummaryVectors for cohort search.
+
+    Patients run on a thread pool (the work is waiting on the LLM server;
+    the backend's concurrency limit caps in-flight calls). Embedding, IRIS
+    writes and checkpointing happen on the calling thread in batches.
+    A patient whose source texts are unchanged since its stored summary is
+    skipped.
+    """
+    def __init__(self, backend: str = None, model: str = None, workers: int = DEFAULT_WORKERS,
+                 checkpoint: BatchCheckpoint = None, write_batch: int = DEFAULT_WRITE_BATCH,
+                 resource_types: list = RESOURCE_TYPES):
+        self.workers = workers
+        self.write_batch = write_batch
+        self.resource_types = resource_types
+        self.checkpoint = checkpoint or BatchCheckpoint()
+        self.llm = get_backend(backend, model, preferred={"lmstudio": "mistral-7b-instruct-v0.3"},
+                               concurrency=workers)
+        self.summary_cache = shared_summary_cache()
+        self.model = SentenceTransformer(EMBED_MODEL, trust_remote_code=True)
+        self.conn = iris.connect("127.0.0.1", 1972, "DEMO", "_SYSTEM", "ISCDEMO")
+        # Shared by the workers' source reads and the writer
+        self.db_lock = threading.Lock()
+        ensure_summary_table(self.conn)
+        self.counts = {"summarized": 0, "unchanged": 0, "empty": 0, "failed": 0}
+
+    def patients(self) -> list:
+        with self.db_lock:
+            cursor = self.conn.cursor()
+            cursor.execute(PATIENTS_SQL)
+            return [tuple(row) for row in cursor.fetchall()]
+
+    def source_hash(self, texts_by_type: dict) -> str:
+        """
+        Hash of everything a patient's summary is built from: the source
+        texts, the prompt versions and the model.
+        """
+        header = f"{self.llm.name}:{self.llm.model}\0{SECTION_TEMPLATE}\0{FINAL_TEMPLATE}"
+        digest = hashlib.sha256(header.encode("utf-8"))
+        for rtype in self.resource_types:
+            for text in texts_by_type.get(rtype, []):
+                digest.update(f"\0{rtype}\0{text}".encode("utf-8"))
+        return digest.hexdigest()
+
+    def summarize_patient(self, patient_id: str, lastname: str, firstname: str) -> tuple:
+        """
+        Returns (status, PatientSummary or None) with status "summarized",
+        "unchanged" or "empty". Raises LLMError if any call failed, so a
+        patient is never stored with a partial summary.
+        """
+        with self.db_lock:
+            texts_by_type = fetch_texts_by_type(self.conn, patient_id, self.resource_types)
+        if not any(texts_by_type.values()):
+            return "empty", None
+        source_hash = self.source_hash(texts_by_type)
+        if self.checkpoint.done.get(patient_id) == source_hash:
+            return "unchanged", None
+
+        partials = []
+        for rtype in self.resource_types:
+            texts = texts_by_type.get(rtype, [])
+            if not texts:
+                continue
+            context = truncate_to_tokens("\n".join(texts), SECTION_INPUT_TOKENS)
+            summary = self.summary_cache.complete(self.llm, section_prompt(rtype, context),
+                                                  SECTION_TEMPLATE, patient_id)
+            partials.append(clip_summary(summary))
+
+        final_input = truncate_to_tokens("\n".join(partials), FINAL_INPUT_TOKENS)
+        final = self.summary_cache.complete(self.llm, final_prompt(final_input), FINAL_TEMPLATE, patient_id)
+        return "summarized", PatientSummary(patient_id, lastname, firstname, source_hash, final.strip())
+
+    def write(self, summaries: list) -> None:
+        """
+        Embeds a batch of final summaries and upserts them, then marks the
+        patients done in the checkpoint.
+        """
+        texts = [s.text[:MAX_SUMMARY_CHARS] for s in summaries]
+        embeddings = encode_vectors(self.model.encode(texts, batch_size=len(texts)))
+        generated_at = datetime.now(timezone.utc).isoformat(timespec="seconds")
+        model = f"{self.llm.name}:{self.llm.model}"
+        rows = [[SUMMARY_ID_PREFIX + s.patient_id, text, emb, s.patient_id, s.patient_lastname, s.patient_firstname,
+                 s.source_hash, model, generated_at]
+                for s, text, emb in zip(summaries, texts, embeddings)]
+        with self.db_lock:
+            cursor = self.conn.cursor()
+            cursor.executemany(DELETE_SUMMARY_SQL, [[SUMMARY_ID_PREFIX + s.patient_id] for s in summaries])
+            cursor.executemany(INSERT_SUMMARY_SQL, rows)
+            self.conn.commit()
+        for s in summaries:
+            self.checkpoint.done[s.patient_id] = s.source_hash
+            self.checkpoint.failed.pop(s.patient_id, None)
+        self.checkpoint.save()
+
+    def collect(self, future, patient: tuple, pending: list) -> None:
+        """
+        Records a finished patient's outcome; summaries go to `pending`.
+        """
+        patient_id, lastname, firstname = patient
+        try:
+            status, summary = future.result()
+        except Exception as e:
+            # LLM, IRIS or embedding errors fail this patient only
+            self.fail([patient_id], e)
+            print(f"❌ {patient_id} {lastname}, {firstname}: {e}")
+            return
+        self.counts[status] += 1
+        if summary is not None:
+            print(f"✅ {patient_id} {lastname}, {firstname}: summarized")
+            pending.append(summary)
+
+    def fail(self, patient_ids: list, error: Exception) -> None:
+        self.counts["failed"] += len(patient_ids)
+        for patient_id in patient_ids:
+            self.checkpoint.failed[patient_id] = f"{type(error).__name__}: {error}"
+
+    def flush(self, summaries: list) -> None:
+        """
+        write() that marks the batch's patients failed instead of raising.
+        """
+        if not summaries:
+            return
+        try:
+            self.write(summaries)
+        except Exception as e:
+            # counted as summarized when they came back; move them to failed
+            self.counts["summarized"] -= len(summaries)
+            self.fail([s.patient_id for s in summaries], e)
+            print(f"❌ Failed to store {len(summaries)} summaries: {e}")
+
+    def run(self, patient_ids: list = None, limit: int = None) -> dict:
+        patients = self.patients()
+        if patient_ids:
+            wanted = set(patient_ids)
+            patients = [p for p in patients if p[0] in wanted]
+        patients = patients[:limit]
+        print(f"Summarizing {len(patients)} patients with {self.workers} workers on "
+              f"{self.llm.name}/{self.llm.model}")
+
+        started = time.perf_counter()
+        pending = []
+        queued = list(reversed(patients))
+        in_flight = {}
+        window = self.workers * IN_FLIGHT_PER_WORKER
+        pool = ThreadPoolExecutor(max_workers=self.workers)
+        try:
+            while True:
+                while queued and len(in_flight) < window:
+                    patient = queued.pop()
+                    in_flight[pool.submit(self.summarize_patient, *patient)] = patient
+                if not in_flight:
+                    break
+                finished, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    self.collect(future, in_flight.pop(future), pending)
+                if len(pending) >= self.write_batch:
+                    self.flush(pending)
+                    pending = []
+        finally:
+            # On KeyboardInterrupt or an unexpected error: drop the calls not
+            # started yet, let the running ones finish and keep their
+            # summaries, then store and checkpoint everything finished
+            pool.shutdown(wait=True, cancel_futures=True)
+            for future, patient in in_flight.items():
+                if not future.cancelled():
+                    self.collect(future, patient, pending)
+            self.flush(pending)
+            self.checkpoint.save()
+
+        elapsed = time.perf_counter() - started
+        print(f"Done in {elapsed:.1f}s: {self.counts['summarized']} summarized, "
+              f"{self.counts['unchanged']} unchanged, {self.counts['empty']} without data, "
+              f"{self.counts['failed']} failed")
+        if self.counts["summarized"]:
+            print(f"  {60.0 * self.counts['summarized'] / elapsed:.1f} patients/min")
+        self.llm.stats.report()
+        self.summary_cache.report()
+        return dict(self.counts)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Precompute patient summaries into PatientSummaryVectors")
+    parser.add_argument("--workers", type=int, default=DEFAULT_WORKERS, help="patients summarized in parallel")
+    parser.add_argument("--backend", help="LLM backend (default: FHIR_LLM_BACKEND or lmstudio)")
+    parser.add_argument("--model", help="LLM model name")
+    parser.add_argument("--patient", action="append", help="only this patient id (repeatable)")
+    parser.add_argument("--limit", type=int, default=None, help="only the first N patients")
+    parser.add_argument("--checkpoint", default=CHECKPOINT_PATH)
+    parser.add_argument("--restart", action="store_true", help="ignore the checkpoint and redo every patient")
+    parser.add_argument("--write-batch", type=int, default=DEFAULT_WRITE_BATCH)
+    args = parser.parse_args()
+
+    checkpoint = BatchCheckpoint(args.checkpoint)
+    if args.restart:
+        checkpoint.done, checkpoint.failed = {}, {}
+    job = PatientSummaryBatch(backend=args.backend, model=args.model, workers=args.workers,
+                              checkpoint=checkpoint, write_batch=args.write_batch)
+    try:
+        job.run(args.patient, args.limit)
+    except KeyboardInterrupt:
+        checkpoint.save()
+        print(f"Stopped; {len(checkpoint.done)} patients done, rerun to resume")
@@ -0,0 +1,236 @@
+import time
+import sqlite3
+import hashlib
+import argparse
+import threading
+
+DEFAULT_PATH = "summary_cache.sqlite"
+# Eviction bounds: least recently used summaries go first past either one
+MAX_ENTRIES = 20000
+MAX_BYTES = 64 * 1024 * 1024
+
+
+def prompt_hash(prompt: str, config: dict = None) -> str:
+    """
+    Hash of everything that determines an answer besides the model: the
+    prompt (template wording plus the source text it embeds) and any
+    generation settings.
+    """
+    digest = hashlib.sha256(prompt.encode("utf-8"))
+    for name, value in sorted((config or {}).items()):
+        digest.update(f"\0{name}={value}".encode("utf-8"))
+    return digest.hexdigest()
+
+
+class SummaryCache:
+    """
+    Persistent cache of LLM summaries in SQLite, keyed by (model, template,
+    prompt hash). `template` names and versions the prompt kind (e.g.
+    "revised-section/v1"); bump it to retire entries when a prompt changes
+    in a way its wording does not show. Because the source text is part of
+    the hashed prompt, changed resources miss automatically; entries also
+    carry the patient id so invalidate_patient() can drop them eagerly.
+
+    Size is bounded by `max_entries` and `max_bytes`, evicting the least
+    recently used summaries. Safe to share across threads.
+    """
+    def __init__(self, path: str = DEFAULT_PATH, max_entries: int = MAX_ENTRIES,
+                 max_bytes: int = MAX_BYTES):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.saved_seconds = 0.0
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("""
+            CREATE TABLE IF NOT EXISTS summaries (
+                model TEXT NOT NULL,
+                template TEXT NOT NULL,
+                prompt_hash TEXT NOT NULL,
+                patient_id TEXT,
+                summary TEXT NOT NULL,
+                bytes INTEGER NOT NULL,
+                seconds REAL NOT NULL,
+                created REAL NOT NULL,
+                last_used REAL NOT NULL,
+                hits INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (model, template, prompt_hash)
+            )
+        """)
+        self.db.execute("CREATE INDEX IF NOT EXISTS summaries_patient ON summaries (patient_id)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS summaries_last_used ON summaries (last_used)")
+        self.db.commit()
+
+    def get(self, model: str, template: str, key: str):
+        with self.lock:
+            row = self.db.execute(
+                "SELECT summary, seconds FROM summaries WHERE model = ? AND template = ? AND prompt_hash = ?",
+                (model, template, key)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self.saved_seconds += row[1]
+            self.db.execute(
+                "UPDATE summaries SET last_used = ?, hits = hits + 1 "
+                "WHERE model = ? AND template = ? AND prompt_hash = ?",
+                (time.time(), model, template, key)
+            )
+            self.db.commit()
+            return row[0]
+
+    def put(self, model: str, template: str, key: str, summary: str,
+            patient_id: str = None, seconds: float = 0.0) -> None:
+        now = time.time()
+        with self.lock:
+            self.db.execute(
+                "INSERT OR REPLACE INTO summaries "
+                "(model, template, prompt_hash, patient_id, summary, bytes, seconds, created, last_used) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (model, template, key, patient_id, summary, len(summary.encode("utf-8")), seconds, now, now)
+            )
+            self._evict()
+            self.db.commit()
+
+    def _evict(self) -> None:
+        # caller holds self.lock
+        count, size = self.db.execute("SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM summaries").fetchone()
+        if count <= self.max_entries and size <= self.max_bytes:
+            return
+        removed = 0
+        rows = self.db.execute("SELECT rowid, bytes FROM summaries ORDER BY last_used").fetchall()
+        doomed = []
+        for rowid, nbytes in rows:
+            if count - removed <= self.max_entries and size <= self.max_bytes:
+                break
+            doomed.append((rowid,))
+            removed += 1
+            size -= nbytes
+        self.db.executemany("DELETE FROM summaries WHERE rowid = ?", doomed)
+        self.evictions += removed
+
+    def complete(self, llm, prompt: str, template: str, patient_id: str = None,
+                 stream=None, **config) -> str:
+        """
+        Cache-aware llm.complete(prompt, stream, **config) for an
+        llmbackend.LLMBackend. A hit is pushed through `stream` at once so
+        the widget fills the same way as for a generated answer; empty
+        answers and LLMErrors are never cached.
+        """
+        model = f"{llm.name}:{llm.model}"
+        key = prompt_hash(prompt, config)
+        summary = self.get(model, template, key)
+        if summary is not None:
+            if stream is not None:
+                stream.begin()
+                stream.push(summary)
+                stream.end()
+            return summary
+        started = time.perf_counter()
+        summary = llm.complete(prompt, stream, **config)
+        if summary.strip():
+            self.put(model, template, key, summary, patient_id, time.perf_counter() - started)
+        return summary
+
+    def invalidate_patient(self, patient_id: str) -> int:
+        """
+        Drops every summary generated from `patient_id`'s data; returns the
+        number removed.
+        """
+        with self.lock:
+            removed = self.db.execute("DELETE FROM summaries WHERE patient_id = ?", (patient_id,)).rowcount
+            self.db.commit()
+        return removed
+
+    def invalidate_template(self, template: str) -> int:
+        with self.lock:
+            removed = self.db.execute("DELETE FROM summaries WHERE template = ?", (template,)).rowcount
+            self.db.commit()
+        return removed
+
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self) -> dict:
+        with self.lock:
+            count, size = self.db.execute("SELECT COUNT(*), COALESCE(SUM(bytes), 0) FROM summaries").fetchone()
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "entries": count,
+            "bytes": size,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "hit_rate": self.hit_rate(),
+            "saved_seconds": self.saved_seconds,
+        }
+
+    def summary(self) -> str:
+        s = self.stats()
+        return (f"summary cache {s['hits']} hits / {s['misses']} misses ({s['hit_rate']:.0%}), "
+                f"~{s['saved_seconds']:.0f}s of LLM time saved")
+
+    def report(self) -> None:
+        s = self.stats()
+        print(f"Summary cache: hits={s['hits']} misses={s['misses']} hit_rate={s['hit_rate']:.1%} "
+              f"evictions={s['evictions']} entries={s['entries']}/{s['max_entries']} "
+              f"size={s['bytes'] / 1024:.0f}KiB/{s['max_bytes'] / 1024:.0f}KiB "
+              f"saved={s['saved_seconds']:.1f}s")
+
+    def close(self) -> None:
+        with self.lock:
+            if self.db is not None:
+                self.db.close()
+                self.db = None
+
+
+_shared = {}
+_shared_lock = threading.Lock()
+
+
+def shared_summary_cache(path: str = DEFAULT_PATH) -> SummaryCache:
+    """
+    Returns the process-wide cache for `path`, so every app and worker in
+    the process shares one connection and one set of counters.
+    """
+    with _shared_lock:
+        if path not in _shared:
+            _shared[path] = SummaryCache(path)
+        return _shared[path]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Inspect or trim the persistent LLM summary cache")
+    parser.add_argument("command", choices=["stats", "invalidate", "clear"])
+    parser.add_argument("--path", default=DEFAULT_PATH)
+    parser.add_argument("--patient", action="append", help="patient id to invalidate (repeatable)")
+    parser.add_argument("--template", help="prompt template to invalidate")
+    args = parser.parse_args()
+
+    cache = SummaryCache(args.path)
+    if args.command == "stats":
+        by_template = cache.db.execute(
+            "SELECT template, COUNT(*), SUM(hits), SUM(seconds) FROM summaries GROUP BY template ORDER BY template"
+        ).fetchall()
+        cache.report()
+        for template, count, hits, seconds in by_template:
+            print(f"  {template:<32} entries={count:<6} hits={hits:<6} generation={seconds:8.1f}s")
+    elif args.command == "invalidate":
+        if not args.patient and not args.template:
+            parser.error("invalidate needs --patient or --template")
+        for patient_id in args.patient or []:
+            print(f"🧹 Removed {cache.invalidate_patient(patient_id)} summaries for patient {patient_id}")
+        if args.template:
+            print(f"🧹 Removed {cache.invalidate_template(args.template)} summaries for template {args.template}")
+    else:
+        with cache.lock:
+            removed = cache.db.execute("DELETE FROM summaries").rowcount
+            cache.db.commit()
+        print(f"🧹 Removed {removed} summaries")
+    cache.close()
@@ -0,0 +1,201 @@
+import re
+import time
+import asyncio
+import threading
+from ragretrieval import TEXT_COLUMN, text_value
+
+SUMMARY_TABLE = "PatientVectors"
+FETCH_BATCH_SIZE = 500
+LOG_FLUSH_LINES = 200
+# Parallel LLM calls per patient; match what the LM Studio / OpenAI backend can serve
+SUMMARY_CONCURRENCY = 4
+
+# Per-resource-type and final prompts shared by FHIRSummaryRevised and the
+# summarybatch job, so both hit the same summary cache entries
+SECTION_TEMPLATE = "revised-section/v1"
+FINAL_TEMPLATE = "revised-final/v1"
+SECTION_INPUT_TOKENS = 1500
+FINAL_INPUT_TOKENS = 2000
+SECTION_MAX_WORDS = 100
+SECTION_MAX_SENTENCES = 5
+
+
+def section_prompt(rtype: str, text: str) -> str:
+    return (
+        f"You are a clinical summarization AI. Your task is to generate a concise summary of the patient's {rtype} data below.\n\n"
+        "The summary must be:\n"
+        f"- No more than {SECTION_MAX_SENTENCES} sentences.\n"
+        f"- No more than {SECTION_MAX_WORDS} words.\n"
+        "- Avoid repeating metadata or codes.\n"
+        "- Use natural language.\n\n"
+        f"--- BEGIN {rtype} DATA ---\n{text}\n--- END DATA ---\n\n"
+        f"Summary:"
+    )
+
+
+def final_prompt(text: str) -> str:
+    return (
+        "You are a clinical summarization AI. Using the following section summaries, create a concise, readable 1–2 paragraph overview of the patient's overall clinical picture."
+        f"\n\n{text}\n\nFinal Summary:"
+    )
+
+
+def clip_summary(summary: str, max_words: int = SECTION_MAX_WORDS,
+                 max_sentences: int = SECTION_MAX_SENTENCES) -> str:
+    """
+    Enforces the section limits the model was asked for but may ignore.
+    """
+    summary = summary.strip()
+    words = summary.split()
+    if len(words) > max_words:
+        summary = " ".join(words[:max_words]) + "..."
+    sentences = re.split(r'(?<=[.!?]) +', summary)
+    if len(sentences) > max_sentences:
+        summary = " ".join(sentences[:max_sentences]) + "..."
+    return summary
+
+
+class BufferedFileLog:
+    """
+    Append-only log file that collects lines in memory and writes them in
+    one go every `flush_lines` lines, on flush() and on close(), instead of
+    reopening the file for every message. The file is truncated on open.
+    """
+    def __init__(self, path: str, flush_lines: int = LOG_FLUSH_LINES):
+        self.path = path
+        self.flush_lines = flush_lines
+        self.lines = []
+        self.lock = threading.Lock()
+        open(path, "w", encoding="utf-8").close()
+
+    def write(self, message: str) -> None:
+        with self.lock:
+            self.lines.append(message)
+            if len(self.lines) >= self.flush_lines:
+                self._flush()
+
+    def _flush(self) -> None:
+        # caller holds self.lock
+        if self.lines:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write("\n".join(self.lines) + "\n")
+            self.lines = []
+
+    def flush(self) -> None:
+        with self.lock:
+            self._flush()
+
+    def close(self) -> None:
+        self.flush()
+
+
+def fetch_texts_by_type(conn, patient_id: str, resource_types: list, log=None,
+                        table: str = SUMMARY_TABLE, batch_size: int = FETCH_BATCH_SIZE) -> dict:
+    """
+    Reads every resource text for a patient across `resource_types` with a
+    single query ordered by resource_type, pulling rows with fetchmany(), and
+    returns {resource_type: [text, ...]}. Values are normalized with
+    ragretrieval.text_value; blank or non-text rows are skipped and counted,
+    and `log` (any callable taking a str) gets one line per type rather than
+    one per row.
+    """
+    texts = {rtype: [] for rtype in resource_types}
+    skipped = {rtype: 0 for rtype in resource_types}
+    placeholders = ", ".join("?" for _ in resource_types)
+    cursor = conn.cursor()
+    try:
+        cursor.execute(f"""
+            SELECT resource_type, {TEXT_COLUMN}
+            FROM {table}
+            WHERE patient_id = ? AND resource_type IN ({placeholders})
+            ORDER BY resource_type
+        """, [patient_id] + list(resource_types))
+        while True:
+            rows = cursor.fetchmany(batch_size)
+            if not rows:
+                break
+            for rtype, val in rows:
+                text = text_value(val)
+                if text.strip():
+                    texts[rtype].append(text)
+                else:
+                    skipped[rtype] += 1
+    finally:
+        cursor.close()
+
+    if log is not None:
+        for rtype in resource_types:
+            note = f" ({skipped[rtype]} blank/non-text rows skipped)" if skipped[rtype] else ""
+            log(f"Texts for {rtype}: count = {len(texts[rtype])}{note}")
+    return texts
+
+
+class SummaryScheduler:
+    """
+    Runs independent blocking summarization calls (one per resource type) on
+    worker threads, at most `concurrency` at a time, and hands each result to
+    `on_result` on the event loop as soon as it finishes so Textual widgets
+    can be updated in place. concurrency=1 reproduces the serial behaviour.
+
+    Keeps the wall time of the parallel phase and the summed time of the
+    individual calls for report(). The summed time approximates a serial
+    run; for an exact baseline run once with concurrency=1, since a
+    saturated backend stretches each call.
+    """
+    def __init__(self, concurrency: int = SUMMARY_CONCURRENCY):
+        self.concurrency = max(1, concurrency)
+        self.calls = 0
+        self.call_seconds = 0.0
+        self.wall_seconds = 0.0
+        self.final_seconds = 0.0
+        self.started = None
+
+    async def run(self, jobs: list, on_result=None) -> dict:
+        """
+        `jobs` is a list of (key, func, *args). Returns {key: result} in job
+        order. A job that raises yields an "[ERROR: ...]" string instead, so
+        one failed type does not abort the rest.
+        """
+        if self.started is None:
+            self.started = time.perf_counter()
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def one(key, func, *args):
+            async with semaphore:
+                started = time.perf_counter()
+                try:
+                    result = await asyncio.to_thread(func, *args)
+                except Exception as e:
+                    result = f"[ERROR: summarization failed for {key}: {type(e).__name__}: {e}]"
+                self.calls += 1
+                self.call_seconds += time.perf_counter() - started
+                return key, result
+
+        started = time.perf_counter()
+        results = {}
+        for finished in asyncio.as_completed([one(*job) for job in jobs]):
+            key, result = await finished
+            results[key] = result
+            if on_result is not None:
+                on_result(key, result)
+        self.wall_seconds += time.perf_counter() - started
+        return {job[0]: results[job[0]] for job in jobs}
+
+    async def run_final(self, func, *args):
+        """
+        Runs the final merge call and records its time.
+        """
+        if self.started is None:
+            self.started = time.perf_counter()
+        started = time.perf_counter()
+        try:
+            return await asyncio.to_thread(func, *args)
+        finally:
+            self.final_seconds += time.perf_counter() - started
+
+    def report(self) -> str:
+        end_to_end = time.perf_counter() - self.started if self.started is not None else 0.0
+        speedup = self.call_seconds / self.wall_seconds if self.wall_seconds > 0 else 0.0
+        return (f"{self.calls} summary calls in {self.wall_seconds:.1f}s at concurrency "
+                f"{self.concurrency} (summed call time {self.call_seconds:.1f}s, {speedup:.1f}x); "
+                f"final merge {self.final_seconds:.1f}s; end-to-end {end_to_end:.1f}s")
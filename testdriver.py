@@ -1,9 +1,10 @@
 from regex import R
 import iris
-import tiktoken
 from sentence_transformers import SentenceTransformer
-import lmstudio as lms
+from llmbackend import get_backend
 from typing import List, Tuple
+from ragretrieval import VectorRetriever
+from embeddingcache import shared_cache
 
 # ─── CONFIGURATION ─────────────────────────────────────────────────────────────
 
@@ -28,48 +29,28 @@ def count_table_rows(conn):
     cur.execute(f"SELECT COUNT(*) FROM {VECTOR_TABLE}")
     return cur.fetchone()[0]
 
-def embed_text(model, text: str) -> List[float]:
-    enc = tiktoken.encoding_for_model("gpt-3.5-turbo")
-    tokens = enc.encode(text)
-    # optionally truncate tokens here
-    vec = model.encode(text).tolist()
-    return vec
 
-
-client = lms.Client()
-llm = client.llm.model("mistral-7b-instruct-v0.3")
+llm = get_backend(preferred={"lmstudio": "mistral-7b-instruct-v0.3"})
 # Embedding model
 embedder = SentenceTransformer(EMBED_MODEL, trust_remote_code=True)
+query_cache = shared_cache(embedder, EMBED_MODEL)
 conn = iris.connect("127.0.0.1", 1972, "DEMO", "_SYSTEM", "ISCDEMO")
 
 
 def main(fhir_id: str, query: str) -> str:
-        # 1) embed the query
-        vec = embed_text(embedder, query)
-        csv = ",".join(f"{x:.8f}" for x in vec)
-
-        # 2) retrieve top-K passages for this patient
-        sql = f"""
-          SELECT TOP {TOP_K}
-            resource_id,
-            patient_lastname,
-            patient_firstname, 
-            CAST(resourcetext AS VARCHAR(4000)), 
-            VECTOR_COSINE(embedding, TO_VECTOR(?,DOUBLE)) AS score
-          FROM {VECTOR_TABLE}
-          WHERE patient_id = ? AND resource_type = 'Condition'
-          ORDER BY score DESC
-        """
-        cur = conn.cursor()
-        cur.execute(sql, [csv, fhir_id])
-        id_sim_pairs = cur.fetchall()
+        # 1) embed the query and 2) retrieve top-K passages for this patient
+        retriever = VectorRetriever(conn, query_cache, VECTOR_TABLE)
+        results = retriever.search(query, patient_id=fhir_id, resource_types=["Condition"], top_k=TOP_K)
 
-        if not id_sim_pairs:
+        if not results:
             return "No matching data found for that patient."
-        
-        cur = self.conn.cursor()
-    
-      
-      
+
+        for passage in results:
+            print(f"{passage.resource_type}/{passage.resource_id} ({passage.patient_firstname} "
+                  f"{passage.patient_lastname}) score={passage.score:.4f}: {passage.text[:120]}")
+        print(f"⏱️  {retriever.timings.summary()}")
+        return "\n\n".join(passage.text for passage in results)
+
+
 if __name__ == "__main__":
     main("2", "Does the patient have diabetes?")
@@ -1,5 +1,7 @@
 import iris
-import tiktoken
+from tokenutils import count_tokens
+from embeddingcache import shared_cache
+from ragretrieval import VectorRetriever, CohortSearch, retrieve_context, cohort_overlap
 from sentence_transformers import SentenceTransformer
 
 # ─── CONFIGURATION ─────────────────────────────────────────────────────────────
@@ -12,6 +14,8 @@ IRIS_PWD     = "ISCDEMO"
 VECTOR_TABLE = "SQLUser.PatientVectors"
 MODEL_NAME   = "nomic-ai/nomic-embed-text-v1.5"
 TOP_K        = 5  # number of neighbors to return by default
+TOKEN_BUDGET = 2000
+COHORT_SIZE  = 10  # distinct patients in the cohort search
 
 # ─── HELPERS ───────────────────────────────────────────────────────────────────
 
@@ -25,46 +29,35 @@ def count_table_rows(conn):
 
 def embed_text(model, text):
     # count tokens
-    enc = tiktoken.encoding_for_model("gpt-3.5-turbo")
-    tokens = enc.encode(text)
-    token_count = len(tokens)
+    token_count = count_tokens(text)
     # compute embedding
-    vec = model.encode(text).tolist()
+    vec = model.encode(text)
     return vec, token_count
 
-def vector_search(conn, embedding, top_k=TOP_K):
-    # turn Python list into comma-joined string
-    emb_csv = ",".join(f"{x:.8f}" for x in embedding)
-    sql = f"""
-      SELECT TOP {top_k}
-        patient_id,
-        patient_lastname,
-        patient_firstname,
-        resource_type,
-        resource_id,
-        VECTOR_COSINE(embedding, ?) AS cosine_distance
-      FROM {VECTOR_TABLE}
-      ORDER BY cosine_distance DESC
-    """
-    cur = conn.cursor()
-    cur.execute(sql, [emb_csv])
-    return cur.fetchall()
+def as_rows(passages):
+    # (patient_id, last, first, rtype, rid, score) rows as printed below
+    return [(p.patient_id, p.patient_lastname, p.patient_firstname, p.resource_type, p.resource_id, p.score)
+            for p in passages]
+
+def vector_search(conn, embedding, top_k=TOP_K, resource_types=None):
+    retriever = VectorRetriever(conn, None, VECTOR_TABLE)
+    return as_rows(retriever.search_vector(embedding, resource_types=resource_types, top_k=top_k))
 
 def filter_top_per_patient(results):
     """
     From a list of rows like
-      (patient_id, last, first, rtype, rid, distance)
+      (patient_id, last, first, rtype, rid, score)
     return only the best-scoring row per patient_id,
-    sorted by descending distance.
+    sorted by descending cosine similarity.
     """
     best = {}
     for row in results:
-        pid, last, first, rtype, rid, dist = row
-        # Keep this row if we haven't seen pid yet, or if this dist is lower
-        if pid not in best or dist < best[pid][-1]:
+        pid, last, first, rtype, rid, score = row
+        # Keep this row if we haven't seen pid yet, or if it scores higher
+        if pid not in best or score > best[pid][-1]:
             best[pid] = row
 
-    # Return the filtered rows sorted by distance
+    # Return the filtered rows sorted by score
     return sorted(best.values(), key=lambda row: row[-1], reverse=True)
     
 
@@ -73,6 +66,7 @@ def filter_top_per_patient(results):
 def main():
     # load model once
     model = SentenceTransformer(MODEL_NAME, trust_remote_code=True)
+    query_cache = shared_cache(model, MODEL_NAME)
     conn  = get_connection()
     
     # count total vectors
@@ -85,18 +79,36 @@ def main():
         print("No query entered, exiting.")
         return
     
-    # embed + token count
-    emb, tok_cnt = embed_text(model, query)
-    print(f"Token count for your query: {tok_cnt}")
+    # token count
+    print(f"Token count for your query: {count_tokens(query)}")
     
-    # search
-    #results = vector_search(conn, emb, top_k=10)
-    #results = vector_search(conn, emb, top_k=10)
-    results = vector_search(conn, emb, top_k=10)
-    filtered = filter_top_per_patient(results)
-    # Print
-    print(f"\nTop {len(filtered)} unique-patient results:")
-    for i, (pid, last, first, rtype, rid, dist) in enumerate(filtered, start=1):
-      print(f" {i}. {pid}, {last}, {first}, {rtype}, {rid}, cosine_distance={dist:.4f}")
+    # search the resource types the question is about, merged by score
+    retriever = VectorRetriever(conn, query_cache, VECTOR_TABLE)
+    context, passages, types = retrieve_context(retriever, query, per_type_k=10,
+                                                max_passages=10, token_budget=TOKEN_BUDGET)
+    print(f"Searched resource types: {', '.join(types)}")
+    print(f"Context: {len(passages)} passages, {count_tokens(context)} tokens ({retriever.timings.summary()})")
+
+    # distinct patients: ANN over-fetch grouped by patient, checked against
+    # the exact server-side per-patient aggregation
+    cohort = CohortSearch(retriever)
+    matches = cohort.search(query, patients=COHORT_SIZE, resource_types=types, mode="ann")
+    ann_timing, ann_rows = retriever.timings.summary(), cohort.fetched
+    exact = cohort.search(query, patients=COHORT_SIZE, resource_types=types, mode="exact")
+    print(f"\nTop {len(matches)} unique-patient results ({ann_rows} rows scanned, {ann_timing}):")
+    for i, m in enumerate(matches, start=1):
+      print(f" {i}. {m.patient_id}, {m.patient_lastname}, {m.patient_firstname}, cosine_similarity={m.score:.4f}")
+      for p in m.passages:
+        print(f"      {p.resource_type}, {p.resource_id}, {p.score:.4f}")
+    print(f"Recall vs exact per-patient search: {cohort_overlap(matches, exact):.0%} "
+          f"(exact: {retriever.timings.summary()})")
+    # without refine the candidate scan itself has to carry the texts
+    unrefined = cohort.search(query, patients=COHORT_SIZE, resource_types=types, mode="ann", refine=False)
+    blank = sum(1 for m in unrefined for p in m.passages if not p.text.strip())
+    if blank:
+      print(f"❌ Unrefined cohort search returned {blank} passages without text")
+    else:
+      print(f"✅ Unrefined cohort search returned texts for all passages ({retriever.timings.summary()})")
+    query_cache.report()
 if __name__ == "__main__":
     main()
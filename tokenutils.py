@@ -0,0 +1,68 @@
+from functools import lru_cache
+from typing import List
+import tiktoken
+
+TOKEN_MODEL = "gpt-3.5-turbo"
+BATCH_THREADS = 8
+
+
+@lru_cache(maxsize=None)
+def get_encoder(model: str = TOKEN_MODEL):
+    """
+    Returns the tiktoken encoder for `model`, loading its BPE ranks only on
+    the first call.
+    """
+    return tiktoken.encoding_for_model(model)
+
+
+def obviously_fits(text: str, max_tokens: int) -> bool:
+    """
+    Cheap upper bound that avoids running BPE: every token covers at least
+    one UTF-8 byte, so text of at most max_tokens bytes cannot exceed
+    max_tokens tokens.
+    """
+    return len(text) <= max_tokens and len(text.encode("utf-8")) <= max_tokens
+
+
+def count_tokens(text: str) -> int:
+    return len(get_encoder().encode(text))
+
+
+def count_tokens_batch(texts: List[str]) -> List[int]:
+    return [len(tokens) for tokens in get_encoder().encode_batch(texts, num_threads=BATCH_THREADS)]
+
+
+def truncate_to_tokens(text: str, max_tokens: int = 1500) -> str:
+    """
+    Clips text to its first max_tokens tokens. Text that is obviously
+    under the limit is returned as-is without an encode/decode round trip.
+    """
+    if obviously_fits(text, max_tokens):
+        return text
+    enc = get_encoder()
+    tokens = enc.encode(text)
+    if len(tokens) <= max_tokens:
+        return text
+    return enc.decode(tokens[:max_tokens])
+
+
+def truncate_batch(texts: List[str], max_tokens: int = 1500) -> List[str]:
+    """
+    Batch form of truncate_to_tokens: texts that need encoding are encoded
+    together with encode_batch.
+    """
+    enc = get_encoder()
+    result = list(texts)
+    pending = [i for i, text in enumerate(texts) if not obviously_fits(text, max_tokens)]
+    if pending:
+        encoded = enc.encode_batch([texts[i] for i in pending], num_threads=BATCH_THREADS)
+        for i, tokens in zip(pending, encoded):
+            if len(tokens) > max_tokens:
+                result[i] = enc.decode(tokens[:max_tokens])
+    return result
+
+
+def chunk_text_tokenwise(text: str, max_tokens: int = 1000) -> List[str]:
+    enc = get_encoder()
+    tokens = enc.encode(text)
+    return [enc.decode(tokens[start:start + max_tokens]) for start in range(0, len(tokens), max_tokens)]
@@ -0,0 +1,186 @@
+import time
+import argparse
+import numpy as np
+
+VECTOR_DIM = 768
+
+# Scratch table used by the IRIS benchmark; its rows are written and
+# searched the way the apps do (vectorschema.INGEST_VECTOR_PARAM into the
+# real embedding column type, searches bound as DOUBLE like ragretrieval)
+BENCHMARK_TABLE = "VectorCodecBenchmark"
+QUERY_VECTOR_PARAM = "TO_VECTOR(?,DOUBLE)"
+
+# Fixed-point decimals. Plain fixed point never produces exponent notation
+# ("1e-05"), which TO_VECTOR is not known to accept. 6 decimals bound the
+# absolute error by 5e-7: for nomic embeddings (components ~0.03) that moves
+# a cosine score by ~1e-5, well under what separates neighbours, and the
+# text is ~17% shorter than the legacy %.8f.
+DEFAULT_DIGITS = 6
+
+_ZERO, _MINUS, _DOT, _COMMA, _NEWLINE = (ord(c) for c in "0-.,\n")
+
+
+def _fixed_point(matrix: np.ndarray, digits: int) -> list:
+    """
+    Formats every row of a 2-D float array as comma-separated fixed-point
+    text without a Python-level loop over the elements: the digits of all
+    elements are computed with NumPy into one byte matrix (one column per
+    element, one row per character position), unused sign and leading-zero
+    positions are masked out and the rest decoded in one go. Rounds half
+    to even like %f, but never writes "-0.000000".
+    """
+    rows, dim = matrix.shape
+    flat = matrix.astype(np.float64).ravel()
+    scaled = np.rint(np.abs(flat) * 10.0 ** digits).astype(np.int64)
+    whole, frac = np.divmod(scaled, 10 ** digits)
+    width = len(str(int(whole.max()))) if flat.size else 1
+    # sign, whole digits, '.', fraction digits, separator
+    out = np.empty((width + digits + 3, flat.size), np.uint8)
+    keep = np.ones(out.shape, bool)
+    out[0] = _MINUS
+    keep[0] = (flat < 0) & (scaled > 0)
+    for pos in range(width + digits + 1, width + 1, -1):
+        frac, digit = np.divmod(frac, 10)
+        out[pos] = digit + _ZERO
+    out[width + 1] = _DOT
+    for pos in range(width, 0, -1):
+        whole, digit = np.divmod(whole, 10)
+        out[pos] = digit + _ZERO
+    # drop leading zeros of the whole part, keeping its last digit
+    keep[1:width] = ~np.logical_and.accumulate(out[1:width] == _ZERO, axis=0)
+    out[-1] = _COMMA
+    out[-1, dim - 1::dim] = _NEWLINE
+    return out.T[keep.T].tobytes().decode("ascii").split("\n")[:rows]
+
+
+def encode_vector(vec, digits: int = DEFAULT_DIGITS) -> str:
+    """
+    Serializes an embedding (NumPy array or sequence of floats) as the
+    comma-separated text TO_VECTOR expects, with `digits` decimals in plain
+    fixed-point notation.
+    """
+    arr = np.asarray(vec, dtype=np.float32).reshape(1, -1)
+    return _fixed_point(arr, digits)[0]
+
+
+def encode_vectors(matrix, digits: int = DEFAULT_DIGITS) -> list:
+    """
+    Encodes every row of a 2-D array, e.g. the result of model.encode(list),
+    in a single vectorized pass.
+    """
+    matrix = np.asarray(matrix, dtype=np.float32)
+    if matrix.size == 0:
+        return [""] * matrix.shape[0] if matrix.ndim == 2 else []
+    return _fixed_point(matrix, digits)
+
+
+def decode_vector(text) -> np.ndarray:
+    """
+    Parses vector text (with or without surrounding brackets), as returned
+    by IRIS or written by encode_vector, into a float32 array.
+    """
+    if not isinstance(text, str):
+        return np.asarray(text, dtype=np.float32)
+    return np.array(text.strip().strip("[]").split(","), dtype=np.float32)
+
+
+def legacy_encode_vector(vec) -> str:
+    # The string path this module replaces; kept for the benchmark
+    return ",".join(f"{x:.8f}" for x in np.asarray(vec).tolist())
+
+
+def _time(fn, repeat: int) -> float:
+    started = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - started) / repeat
+
+
+def _percent_format(vec) -> str:
+    # %-operation over a repeated format string: the per-element path the
+    # vectorized formatter is compared against
+    return ",".join([f"%.{DEFAULT_DIGITS}f"] * len(vec)) % tuple(np.asarray(vec).tolist())
+
+
+def benchmark_encoding(repeat: int = 2000, batch: int = 64) -> None:
+    rng = np.random.default_rng(0)
+    vec = (rng.standard_normal(VECTOR_DIM) / 30).astype(np.float32)
+    matrix = (rng.standard_normal((batch, VECTOR_DIM)) / 30).astype(np.float32)
+    legacy = legacy_encode_vector(vec)
+    encoded = encode_vector(vec)
+    legacy_us = _time(lambda: legacy_encode_vector(vec), repeat) * 1e6
+    percent_us = _time(lambda: _percent_format(vec), repeat) * 1e6
+    encode_us = _time(lambda: encode_vector(vec), repeat) * 1e6
+    batch_us = _time(lambda: encode_vectors(matrix), max(1, repeat // batch)) * 1e6 / batch
+    decoded = decode_vector(encoded)
+    a, b = decoded.astype(np.float64), vec.astype(np.float64)
+    cosine = float(np.dot(a, b) / (np.linalg.norm(a) * np.linalg.norm(b)))
+    print(f"Encoding one {VECTOR_DIM}-dim vector ({repeat} runs):")
+    print(f"  {'legacy f-string %.8f':<25}: {legacy_us:8.1f}us  {len(legacy)} chars")
+    print(f"  {f'%-format %.{DEFAULT_DIGITS}f':<25}: {percent_us:8.1f}us")
+    print(f"  {f'encode_vector %.{DEFAULT_DIGITS}f':<25}: {encode_us:8.1f}us  {len(encoded)} chars "
+          f"({100.0 * (len(encoded) - len(legacy)) / len(legacy):+.1f}% size, {legacy_us / encode_us:.1f}x faster)")
+    print(f"  {f'encode_vectors x{batch}':<25}: {batch_us:8.1f}us per vector ({legacy_us / batch_us:.1f}x faster)")
+    print(f"  {'max abs error legacy':<25}: {np.max(np.abs(decode_vector(legacy) - vec)):.2e}")
+    print(f"  {f'max abs error %.{DEFAULT_DIGITS}f':<25}: {np.max(np.abs(decoded - vec)):.2e}")
+    print(f"  {'cosine(decoded, original)':<25}: 1 - {1.0 - cosine:.1e}")
+    print(f"  {'matches %-format':<25}: {encoded == _percent_format(vec)}")
+    print(f"  {'exponent notation':<25}: {'e' in encoded.lower()}")
+
+
+def benchmark_iris(rows: int = 500, queries: int = 50) -> None:
+    """
+    Times bulk insert and top-5 cosine queries through the legacy string
+    path and encode_vector against a scratch table in IRIS, using the
+    vector tables' embedding column type and the ingest and search
+    parameter forms. Also reads the stored vectors back to check that IRIS
+    parsed the encoded text to the original values.
+    """
+    import iris
+    from vectorschema import VECTOR_TABLE_COLUMNS, INGEST_VECTOR_PARAM
+    column_type = dict(VECTOR_TABLE_COLUMNS)["embedding"]
+    conn = iris.connect("127.0.0.1", 1972, "DEMO", "_SYSTEM", "ISCDEMO")
+    cur = conn.cursor()
+    table = BENCHMARK_TABLE
+    vectors = (np.random.default_rng(1).standard_normal((rows, VECTOR_DIM)) / 30).astype(np.float32)
+    try:
+        cur.execute(f"CREATE TABLE {table} (id INT, embedding {column_type})")
+        print(f"  column {column_type}, insert {INGEST_VECTOR_PARAM}, search {QUERY_VECTOR_PARAM}")
+        for label, encode in (("legacy", legacy_encode_vector), ("codec", encode_vector)):
+            cur.execute(f"DELETE FROM {table}")
+            conn.commit()
+            started = time.perf_counter()
+            cur.executemany(f"INSERT INTO {table} (id, embedding) VALUES (?, {INGEST_VECTOR_PARAM})",
+                            [[i, encode(v)] for i, v in enumerate(vectors)])
+            conn.commit()
+            insert_seconds = time.perf_counter() - started
+
+            started = time.perf_counter()
+            for v in vectors[:queries]:
+                cur.execute(f"""
+                    SELECT TOP 5 id, VECTOR_COSINE(embedding, {QUERY_VECTOR_PARAM}) AS score
+                    FROM {table} ORDER BY score DESC
+                """, [encode(v)])
+                cur.fetchall()
+            query_seconds = time.perf_counter() - started
+
+            cur.execute(f"SELECT id, embedding FROM {table} WHERE id < ?", [queries])
+            stored = {i: decode_vector(text) for i, text in cur.fetchall()}
+            error = max(float(np.max(np.abs(stored[i] - vectors[i]))) for i in stored)
+            print(f"  {label:<7} insert {rows} rows: {insert_seconds:7.3f}s   "
+                  f"{queries} queries: {query_seconds:7.3f}s   stored max abs error {error:.2e}")
+    finally:
+        cur.execute(f"DROP TABLE {table}")
+        conn.commit()
+        conn.close()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark vector text encoding for IRIS TO_VECTOR")
+    parser.add_argument("--iris", action="store_true", help="also time inserts and queries against IRIS")
+    parser.add_argument("--rows", type=int, default=500)
+    args = parser.parse_args()
+    benchmark_encoding()
+    if args.iris:
+        print("IRIS round trips:")
+        benchmark_iris(args.rows)
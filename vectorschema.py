@@ -0,0 +1,362 @@
+import os
+import time
+import random
+import argparse
+import numpy as np
+from vectorcodec import VECTOR_DIM, encode_vector
+from fhirrows import RESOURCE_TYPES
+
+PATIENT_VECTOR_TABLES = ["PatientVectors", "PatientVectorsDemo"]
+
+VECTOR_TABLE_COLUMNS = [
+    ("patient_id", "VARCHAR(75)"),
+    ("patient_lastname", "VARCHAR(75)"),
+    ("patient_firstname", "VARCHAR(75)"),
+    ("resource_type", "VARCHAR(50)"),
+    ("resource_id", "VARCHAR(75)"),
+    ("embedding", f"VECTOR(DOUBLE, {VECTOR_DIM})"),
+    ("resourcetext", "VARCHAR(4000)"),
+    ("content_hash", "VARCHAR(64)"),
+    ("version_id", "VARCHAR(64)"),
+    ("last_updated", "VARCHAR(40)"),
+]
+
+# Parameter form every ingest path writes embeddings with (the encoded
+# float32 text into the DOUBLE columns); searches bind TO_VECTOR(?,DOUBLE)
+INGEST_VECTOR_PARAM = "TO_VECTOR(?,FLOAT)"
+
+# resourcetext comes back from the driver as a stream handle (or a
+# one-element list) unless it is converted to a string server-side; every
+# query selects it through this expression and reads it through
+# ragretrieval.text_value().
+TEXT_COLUMN = "CAST(resourcetext AS VARCHAR(4000))"
+
+# Change-tracking columns added to tables created before incremental indexing
+TRACKING_COLUMNS = {name: sql_type for name, sql_type in VECTOR_TABLE_COLUMNS[-3:]}
+
+# One precomputed LLM summary per patient (summarybatch) or demo note
+SUMMARY_VECTOR_TABLE = "PatientSummaryVectors"
+SUMMARY_VECTOR_INDEX = "idx_summary_vectors"
+SUMMARY_TABLE_COLUMNS = [
+    ("summary_id", "VARCHAR(75) PRIMARY KEY"),
+    ("summary_text", "VARCHAR(4000)"),
+    ("embedding", f"VECTOR(DOUBLE, {VECTOR_DIM})"),
+    ("patient_id", "VARCHAR(75)"),
+    ("patient_lastname", "VARCHAR(75)"),
+    ("patient_firstname", "VARCHAR(75)"),
+    ("source_hash", "VARCHAR(64)"),
+    ("model", "VARCHAR(100)"),
+    ("generated_at", "VARCHAR(40)"),
+]
+
+# (suffix, columns, unique) for the secondary indexes. IRIS has no
+# declarative table partitioning; leading every lookup index with
+# patient_id keeps each patient's rows clustered in the index the same way.
+SECONDARY_INDEXES = [
+    # natural key: one row per resource per patient (the upsert key). Its
+    # (patient_id, resource_type) prefix also serves the summary apps'
+    # WHERE patient_id = ? AND resource_type IN (...) and RAG's patient filter
+    ("ResourceKey", ["patient_id", "resource_type", "resource_id"], True),
+    # lookups of a resource across patients
+    ("ResourceId", ["resource_id"], False),
+]
+VECTOR_INDEX = "vector_index"
+
+# The queries the apps run most, for EXPLAIN and the benchmark
+HOT_QUERIES = {
+    # summarysupport.fetch_texts_by_type: every type of one patient in one query
+    "summary texts": f"""SELECT resource_type, {TEXT_COLUMN} FROM {{table}}
+                         WHERE patient_id = ? AND resource_type IN ({', '.join('?' for _ in RESOURCE_TYPES)})
+                         ORDER BY resource_type""",
+    "incremental state": "SELECT resource_type, resource_id, content_hash FROM {table} WHERE patient_id = ?",
+    "resource lookup": f"SELECT patient_id, {TEXT_COLUMN} FROM {{table}} WHERE resource_id = ?",
+    "rag top-k": """SELECT TOP 4 resource_id, VECTOR_COSINE(embedding, TO_VECTOR(?,DOUBLE)) AS score
+                    FROM {table} WHERE patient_id = ? AND resource_type = ? ORDER BY score DESC""",
+}
+
+
+def index_name(table: str, suffix: str) -> str:
+    return f"{table}{suffix}Idx"
+
+
+def table_exists(cursor, table: str) -> bool:
+    cursor.execute("SELECT COUNT(*) FROM INFORMATION_SCHEMA.TABLES WHERE TABLE_NAME = ?", [table])
+    (count,) = cursor.fetchone()
+    return count > 0
+
+
+def existing_columns(cursor, table: str) -> set:
+    cursor.execute("SELECT COLUMN_NAME FROM INFORMATION_SCHEMA.COLUMNS WHERE TABLE_NAME = ?", [table])
+    return {name.lower() for (name,) in cursor.fetchall()}
+
+
+def existing_indexes(cursor, table: str) -> set:
+    cursor.execute("SELECT INDEX_NAME FROM INFORMATION_SCHEMA.INDEXES WHERE TABLE_NAME = ?", [table])
+    return {name.lower() for (name,) in cursor.fetchall()}
+
+
+class MigrationRequired(RuntimeError):
+    """
+    Raised when a table needs a destructive migration (such as removing
+    duplicate rows) that is only run by `python vectorschema.py migrate`.
+    """
+
+
+def count_duplicate_rows(cursor, table: str) -> int:
+    """
+    Counts the rows that remove_duplicate_rows would delete.
+    """
+    cursor.execute(f"""
+        SELECT COUNT(*) FROM {table}
+        WHERE %ID NOT IN (
+            SELECT MAX(%ID) FROM {table}
+            GROUP BY patient_id, resource_type, resource_id
+        )
+    """)
+    (count,) = cursor.fetchone()
+    return count or 0
+
+
+def remove_duplicate_rows(cursor, table: str) -> int:
+    """
+    Keeps the newest row (highest %ID) per (patient_id, resource_type,
+    resource_id) so the unique key can be created on tables loaded before
+    rows were upserted. Returns the number of rows removed.
+    """
+    cursor.execute(f"""
+        DELETE FROM {table}
+        WHERE %ID NOT IN (
+            SELECT MAX(%ID) FROM {table}
+            GROUP BY patient_id, resource_type, resource_id
+        )
+    """)
+    return cursor.rowcount if cursor.rowcount and cursor.rowcount > 0 else 0
+
+
+def create_secondary_indexes(conn, table: str, dedupe: bool = False) -> list:
+    """
+    Creates the SECONDARY_INDEXES that do not exist yet; returns their names.
+    Duplicate rows block the unique key: with dedupe they are removed first,
+    otherwise MigrationRequired is raised and nothing is deleted.
+    """
+    cursor = conn.cursor()
+    present = existing_indexes(cursor, table)
+    created = []
+    for suffix, columns, unique in SECONDARY_INDEXES:
+        name = index_name(table, suffix)
+        if name.lower() in present:
+            continue
+        if unique and dedupe:
+            removed = remove_duplicate_rows(cursor, table)
+            if removed:
+                print(f"🧹 Removed {removed} duplicate rows from '{table}' before adding its unique key")
+        elif unique:
+            duplicates = count_duplicate_rows(cursor, table)
+            if duplicates:
+                conn.commit()
+                raise MigrationRequired(
+                    f"'{table}' has {duplicates} duplicate rows, so its unique key {name} can not be created. "
+                    f"Run `python vectorschema.py migrate --table {table}` to keep the newest row per resource."
+                )
+        kind = "UNIQUE INDEX" if unique else "INDEX"
+        cursor.execute(f"CREATE {kind} {name} ON TABLE {table} ({', '.join(columns)})")
+        created.append(name)
+        print(f"✅ Created {kind.lower()} {name} on {table} ({', '.join(columns)})")
+    conn.commit()
+    return created
+
+
+def drop_secondary_indexes(conn, table: str) -> None:
+    cursor = conn.cursor()
+    present = existing_indexes(cursor, table)
+    for suffix, _columns, _unique in SECONDARY_INDEXES:
+        name = index_name(table, suffix)
+        if name.lower() in present:
+            cursor.execute(f"DROP INDEX {name} ON TABLE {table}")
+    conn.commit()
+
+
+def ensure_vector_table(conn, table: str, secondary_indexes: bool = True, dedupe: bool = False) -> None:
+    """
+    Creates a patient vector table with its HNSW index if missing, adds any
+    columns older versions of the table lack, and creates the secondary
+    indexes and unique key. Safe to run on every startup: rows are only
+    deleted with dedupe (the migrate command).
+    """
+    cursor = conn.cursor()
+    if not table_exists(cursor, table):
+        columns = ",\n".join(f"    {name} {sql_type}" for name, sql_type in VECTOR_TABLE_COLUMNS)
+        cursor.execute(f"CREATE TABLE {table} (\n{columns}\n)")
+        cursor.execute(f"""
+            CREATE INDEX {VECTOR_INDEX}
+            ON TABLE {table} (embedding)
+            AS HNSW(Distance='Cosine')
+        """)
+        print(f"Table '{table}' and HNSW index created.")
+    else:
+        print(f"Table '{table}' already exists.")
+        present = existing_columns(cursor, table)
+        for column, sql_type in TRACKING_COLUMNS.items():
+            if column not in present:
+                cursor.execute(f"ALTER TABLE {table} ADD {column} {sql_type}")
+                print(f"Added column '{column}' to '{table}'.")
+    conn.commit()
+    if secondary_indexes:
+        create_secondary_indexes(conn, table, dedupe=dedupe)
+
+
+def ensure_summary_table(conn, table: str = SUMMARY_VECTOR_TABLE) -> None:
+    """
+    Creates the patient summary table with its HNSW index if missing and
+    adds the per-patient columns to tables created for the demo summaries
+    (whose summary_id was VARCHAR(10), too short for FHIR ids).
+    """
+    cursor = conn.cursor()
+    if not table_exists(cursor, table):
+        columns = ",\n".join(f"    {name} {sql_type}" for name, sql_type in SUMMARY_TABLE_COLUMNS)
+        cursor.execute(f"CREATE TABLE {table} (\n{columns}\n)")
+        cursor.execute(f"""
+            CREATE INDEX {SUMMARY_VECTOR_INDEX}
+            ON {table} (embedding)
+            AS HNSW(Distance='Cosine')
+        """)
+        print(f"✅ Created {table} + HNSW index")
+    else:
+        print(f"ℹ️  Table {table} already exists")
+        present = existing_columns(cursor, table)
+        for column, sql_type in SUMMARY_TABLE_COLUMNS[3:]:
+            if column not in present:
+                cursor.execute(f"ALTER TABLE {table} ADD {column} {sql_type}")
+                print(f"Added column '{column}' to '{table}'.")
+        try:
+            cursor.execute(f"ALTER TABLE {table} ALTER COLUMN summary_id VARCHAR(75)")
+        except Exception as e:
+            print(f"⚠️  Could not widen {table}.summary_id: {e}")
+    conn.commit()
+    if index_name(table, "Patient").lower() not in existing_indexes(cursor, table):
+        cursor.execute(f"CREATE INDEX {index_name(table, 'Patient')} ON TABLE {table} (patient_id)")
+        conn.commit()
+
+
+def explain(conn, sql: str) -> str:
+    """
+    Returns the IRIS query plan for `sql` (as produced by EXPLAIN).
+    """
+    cursor = conn.cursor()
+    cursor.execute(f"EXPLAIN {sql}")
+    return "\n".join(str(value) for row in cursor.fetchall() for value in row)
+
+
+def report_query_plans(conn, table: str) -> None:
+    for label, template in HOT_QUERIES.items():
+        print(f"── {label} ──")
+        try:
+            print(explain(conn, template.format(table=table)))
+        except Exception as e:
+            print(f"❌ EXPLAIN failed: {e}")
+
+
+def load_benchmark_table(conn, table: str, directory: str, limit: int = None) -> list:
+    """
+    Loads flattened resources from the bundles in `directory` into `table`
+    with random unit vectors (lookup latency does not depend on the vector
+    values, and this skips loading the embedding model). Returns the
+    (patient_id, resource_type, resource_id) keys loaded.
+    """
+    from bulkloader import list_bundle_files, load_bundle_rows
+    from fhirvectorflattened import INSERT_SQL, VECTOR_TABLE
+
+    insert_sql = INSERT_SQL.replace(VECTOR_TABLE, table)
+    rng = np.random.default_rng(0)
+    keys = []
+    cursor = conn.cursor()
+    for path in list_bundle_files(directory)[:limit]:
+        rows = load_bundle_rows(path)
+        vectors = rng.standard_normal((len(rows), VECTOR_DIM)).astype(np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        cursor.executemany(insert_sql, [row[:5] + [encode_vector(vec)] + row[5:]
+                                        for row, vec in zip(rows, vectors)])
+        conn.commit()
+        keys.extend(tuple(row[0:1] + row[3:5]) for row in rows)
+    print(f"Loaded {len(keys)} resources from {directory} into '{table}'")
+    return keys
+
+
+def time_hot_queries(conn, table: str, keys: list, samples: int = 200) -> dict:
+    """
+    Mean latency in ms of each HOT_QUERIES entry over `samples` random keys.
+    """
+    rng = random.Random(1)
+    picks = [rng.choice(keys) for _ in range(samples)]
+    query_vec = encode_vector(np.ones(VECTOR_DIM, dtype=np.float32) / np.sqrt(VECTOR_DIM))
+    params_for = {
+        "summary texts": lambda k: [k[0]] + RESOURCE_TYPES,
+        "incremental state": lambda k: [k[0]],
+        "resource lookup": lambda k: [k[2]],
+        "rag top-k": lambda k: [query_vec, k[0], k[1]],
+    }
+    cursor = conn.cursor()
+    timings = {}
+    for label, template in HOT_QUERIES.items():
+        sql = template.format(table=table)
+        started = time.perf_counter()
+        for key in picks:
+            cursor.execute(sql, params_for[label](key))
+            cursor.fetchall()
+        timings[label] = 1000.0 * (time.perf_counter() - started) / samples
+    return timings
+
+
+def benchmark(conn, directory: str, limit: int = None, samples: int = 200,
+              table: str = "PatientVectorsBenchmark") -> None:
+    """
+    Loads `directory` into a scratch table with only the HNSW index, times
+    the hot queries, adds the secondary indexes, and times them again.
+    """
+    cursor = conn.cursor()
+    if table_exists(cursor, table):
+        cursor.execute(f"DROP TABLE {table}")
+        conn.commit()
+    ensure_vector_table(conn, table, secondary_indexes=False)
+    try:
+        keys = load_benchmark_table(conn, table, directory, limit)
+        before = time_hot_queries(conn, table, keys, samples)
+        create_secondary_indexes(conn, table)
+        after = time_hot_queries(conn, table, keys, samples)
+        print(f"Mean lookup latency over {samples} random keys:")
+        print(f"  {'query':<20} {'HNSW only':>12} {'+ secondary':>12} {'speedup':>9}")
+        for label in HOT_QUERIES:
+            speedup = before[label] / after[label] if after[label] > 0 else 0.0
+            print(f"  {label:<20} {before[label]:10.2f}ms {after[label]:10.2f}ms {speedup:8.1f}x")
+        report_query_plans(conn, table)
+    finally:
+        cursor.execute(f"DROP TABLE {table}")
+        conn.commit()
+
+
+if __name__ == "__main__":
+    import iris
+
+    parser = argparse.ArgumentParser(description="Create, migrate and inspect the patient vector tables")
+    parser.add_argument("command", choices=["migrate", "explain", "benchmark"])
+    parser.add_argument("--table", action="append",
+                        help="table to act on (repeatable; default: all patient vector tables)")
+    parser.add_argument("--directory", default="100Set", help="bundles to load for the benchmark")
+    parser.add_argument("--limit", type=int, default=None, help="only load the first N bundles")
+    parser.add_argument("--samples", type=int, default=200, help="lookups per query in the benchmark")
+    args = parser.parse_args()
+
+    conn = iris.connect("127.0.0.1", 1972, "DEMO", "_SYSTEM", "ISCDEMO")
+    if args.command == "migrate":
+        for table in args.table or PATIENT_VECTOR_TABLES:
+            ensure_vector_table(conn, table, dedupe=True)
+        if not args.table:
+            ensure_summary_table(conn)
+    elif args.command == "explain":
+        for table in args.table or PATIENT_VECTOR_TABLES:
+            report_query_plans(conn, table)
+    else:
+        if not os.path.isdir(args.directory):
+            parser.error(f"bundle directory '{args.directory}' not found")
+        benchmark(conn, args.directory, args.limit, args.samples)
+    conn.close()